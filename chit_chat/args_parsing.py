@@ -24,6 +24,10 @@ def process_abbreviation_in_1_entry(key, value, method_name):
         if isinstance(value, int):
             new_value = {'type': 'fixed', 'value': value}
         set_controller_name_in_specs(new_value, 'num_unrollings')
+    if key == 'grad_accumulation_steps':
+        if isinstance(value, int):
+            new_value = {'type': 'fixed', 'value': value}
+        set_controller_name_in_specs(new_value, 'grad_accumulation_steps')
     if key == 'checkpoint_steps':
         if isinstance(value, list):
             new_value = {'type': 'true_on_steps', 'steps': value}
@@ -32,6 +36,12 @@ def process_abbreviation_in_1_entry(key, value, method_name):
         else:
             new_value = {'type': 'always_false'}
         set_controller_name_in_specs(new_value, 'checkpoint_steps')
+    if key == 'trace_steps':
+        if isinstance(value, list):
+            new_value = {'type': 'true_on_steps', 'steps': value}
+        elif isinstance(value, int):
+            new_value = {'type': 'periodic_truth', 'period': value}
+        set_controller_name_in_specs(new_value, 'trace_steps')
     if key == 'learning_rate':
         set_controller_name_in_specs(new_value, 'learning_rate')
     if key == 'debug':
@@ -728,6 +738,29 @@ def formalize_and_create_insertions_for_build_hps(hps):
     return hp_combinations, post_processed_combination_insertions
 
 
+def move_feedable_build_hps(build_hps, other_hps, feedable_hp_names):
+    """Build hyperparameters which can be fed to placeholders are moved to other hyperparameters as
+    'additional_placeholder' hyperparameters, so that pupil is not rebuilt for their every value. Only hyperparameters
+    without list indices and shares are moved"""
+    build_hps = construct(build_hps)
+    other_hps = construct(other_hps)
+    for hp_name in list(build_hps.keys()):
+        if hp_name not in feedable_hp_names or hp_name in other_hps:
+            continue
+        hp_values_and_specs = build_hps[hp_name]
+        if isinstance(hp_values_and_specs, list):
+            values = hp_values_and_specs
+        elif hp_values_and_specs.get('list_indices') is None and hp_values_and_specs.get('share') is None \
+                and isinstance(hp_values_and_specs.get('varying'), list):
+            values = hp_values_and_specs['varying']
+        else:
+            continue
+        other_hps[hp_name] = {'hp_type': 'additional_placeholder',
+                              'varying': {'value': values}}
+        del build_hps[hp_name]
+    return build_hps, other_hps
+
+
 def insert_not_build_hp(kwargs, one_hp_insertion):
     if one_hp_insertion['hp_type'] == 'built-in':
         if one_hp_insertion['list_index'] is None:
@@ -1,4 +1,7 @@
+import os
 import time
+import asyncio
+import json
 import numpy as np
 import re
 import queue
@@ -10,14 +13,20 @@ from collections import OrderedDict
 
 import tensorflow as tf
 from tensorflow.python import debug as tf_debug
+from tensorflow.python.client import timeline
+from tensorflow.core.framework import variable_pb2
 from some_useful_functions import InvalidArgumentError
 from some_useful_functions import (construct, add_index_to_filename_if_needed, match_two_dicts, create_path,
                                    check_if_key_in_nested_dict, add_missing_to_list, print_and_log,
-                                   apply_temperature, sample, is_int)
+                                   is_int, op_time_by_name_scope, hash_nested,
+                                   load_results_cache, append_to_results_cache, dataset_text, register_dataset,
+                                   id2char, char2id, ChatStateStore, PrefixStateCache, model_fingerprint)
 from args_parsing import parse_1_set_of_kwargs, parse_train_method_arguments, \
     formalize_and_create_insertions_for_build_hps, formalize_and_create_insertions_for_other_hps, \
-    create_all_args_for_launches, configure_args_for_launches
+    create_all_args_for_launches, configure_args_for_launches, move_feedable_build_hps
 from handler import Handler
+from sampling import get_rng, sample_ids, sample_one_hot
+from metrics import Stats
 from subword_nmt.apply_bpe import BPE
 from bpe import prepare_for_bpe, bpe_post_processing
 
@@ -71,6 +80,21 @@ class Controller(object):
 
         elif self._specifications['type'] == 'linear':
             self.get = self._linear
+        elif self._specifications['type'] == 'plateau':
+            self.get = self._plateau
+        elif self._specifications['type'] == 'diverged':
+            self.get = self._diverged
+        elif self._specifications['type'] == 'early_stopping':
+            self._condition_controllers = list()
+            for condition_specs in self._specifications['conditions']:
+                self._condition_controllers.append(Controller(self._storage, condition_specs))
+            self.get = self._early_stopping
+        elif self._specifications['type'] == 'reduce_on_plateau':
+            self._value = self._specifications['init']
+            self._best = None
+            self._num_bad_results = 0
+            self._num_processed_results = 0
+            self.get = self._reduce_on_plateau
 
     def _changes_detector(self):
         something_changed = False
@@ -120,6 +144,77 @@ class Controller(object):
     def _always_false():
         return False
 
+    def _monitored_results(self):
+        """Returns list of results (validation means or collected train results) specified by 'dataset_name' and
+        'result_type' entries of specifications. If results are not collected yet empty list is returned"""
+        dataset_name = self._specifications['dataset_name']
+        result_type = self._specifications['result_type']
+        if dataset_name not in self._storage or result_type not in self._storage[dataset_name]:
+            return list()
+        return self._storage[dataset_name][result_type]
+
+    def _is_improvement(self, value, best):
+        min_delta = self._specifications.get('min_delta', 0.)
+        if self._specifications.get('mode', 'min') == 'min':
+            return value < best - min_delta
+        else:
+            return value > best + min_delta
+
+    def _plateau(self):
+        """Returns True if monitored result has not improved by more than min_delta during last 'patience'
+        results"""
+        values = self._monitored_results()
+        best = None
+        num_bad_results = 0
+        for value in values:
+            if best is None or self._is_improvement(value, best):
+                best = value
+                num_bad_results = 0
+            else:
+                num_bad_results += 1
+        return num_bad_results >= self._specifications['patience']
+
+    def _diverged(self):
+        """Returns True if last monitored result is NaN or infinite or is worse than 'threshold'"""
+        values = self._monitored_results()
+        if len(values) == 0:
+            return False
+        last = values[-1]
+        if not np.isfinite(last):
+            return True
+        threshold = self._specifications.get('threshold')
+        if threshold is None:
+            return False
+        if self._specifications.get('mode', 'min') == 'min':
+            return last > threshold
+        else:
+            return last < threshold
+
+    def _early_stopping(self):
+        if 'limit' in self._specifications and self._storage['step'] > self._specifications['limit']:
+            return False
+        for controller in self._condition_controllers:
+            if controller.get():
+                return False
+        return True
+
+    def _reduce_on_plateau(self):
+        """Multiplies value by 'factor' every time monitored result has not improved during 'patience' results.
+        Every result is processed once so value does not depend on number of get calls"""
+        values = self._monitored_results()
+        for value in values[self._num_processed_results:]:
+            if self._best is None or self._is_improvement(value, self._best):
+                self._best = value
+                self._num_bad_results = 0
+            else:
+                self._num_bad_results += 1
+                if self._num_bad_results >= self._specifications['patience']:
+                    self._value = max(self._value * self._specifications['factor'],
+                                      self._specifications.get('min_value', 0.))
+                    self._num_bad_results = 0
+        self._num_processed_results = len(values)
+        return self._value
+
     @property
     def name(self):
         return self._specifications['name']
@@ -270,6 +365,67 @@ def identity_tensor(**kwargs):
         return value
 
 
+class _PipeWriter(object):
+    """Has put method like multiprocessing.Queue but sends objects through pipe connection. Used for passing
+    answers of chat processes to event loop"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def put(self, obj):
+        self._connection.send(obj)
+
+
+class _BeamSearch(object):
+    """Beam search decoding which is advanced one step at a time. Alive beams are rows of serving graph batch:
+    inputs method returns ids of the last tokens of alive beams and states attribute holds their states. Predictions
+    and new states computed for these rows are passed to update method. When done is True the best beam (scores are
+    normalized by beam length) is returned by result method"""
+
+    def __init__(self, states, prediction, beam_width, max_length=250, stop_id=-1):
+        log_probs = np.log(np.reshape(prediction, [-1]) + 1e-20)
+        ids = np.argsort(-log_probs)[:beam_width]
+        self._beam_width = beam_width
+        self._max_length = max_length
+        self._stop_id = stop_id
+        self._beams = [[int(id_)] for id_ in ids]
+        self._scores = log_probs[ids]
+        self._finished = list()
+        self.states = [np.repeat(state, len(self._beams), axis=0) for state in states]
+        self.done = False
+
+    def inputs(self):
+        return np.array([beam[-1] for beam in self._beams])
+
+    def update(self, predictions, new_states):
+        alive = list()
+        for beam_idx, beam in enumerate(self._beams):
+            if beam[-1] == self._stop_id or len(beam) >= self._max_length:
+                self._finished.append(
+                    (self._scores[beam_idx] / len(beam), beam,
+                     [state[beam_idx:beam_idx + 1] for state in new_states],
+                     predictions[beam_idx:beam_idx + 1]))
+            else:
+                alive.append(beam_idx)
+        if len(self._finished) >= self._beam_width or len(alive) == 0:
+            self.done = True
+            return None
+        alive = np.array(alive)
+        candidate_scores = self._scores[alive][:, None] + np.log(predictions[alive] + 1e-20)
+        best = np.argsort(-candidate_scores, axis=None)[:self._beam_width - len(self._finished)]
+        rows, new_ids = np.unravel_index(best, candidate_scores.shape)
+        self._beams = [self._beams[alive[row]] + [int(id_)] for row, id_ in zip(rows, new_ids)]
+        self._scores = candidate_scores[rows, new_ids]
+        self.states = [state[alive[rows]] for state in new_states]
+        return None
+
+    def result(self):
+        """Returns ids of tokens of the best beam, state after feeding all these tokens and prediction made after
+        the last of them"""
+        _, ids, states, prediction = max(self._finished, key=lambda finished_beam: finished_beam[0])
+        return ids, states, prediction
+
+
 class Environment(object):
 
     @staticmethod
@@ -342,6 +498,17 @@ class Environment(object):
         # continues generating after that
         self._fuses = list()
 
+        # States of pupil after feeding frequently used prefixes (e. g. greeting). Cache is cleared when pupil
+        # variables are initialized
+        self._prefix_cache = PrefixStateCache()
+
+        # Random generator used for sampling replicas and fuse continuations
+        self._sampling_rng = get_rng()
+
+        # Initializers of state variables of frozen graph loaded with load_frozen_graph. If frozen graph is not
+        # loaded the attribute is None
+        self._frozen_initializers = None
+
         # An attribute holding session. Default value when there is no active sessions is None
         self._session = None
 
@@ -389,7 +556,10 @@ class Environment(object):
                            'gpu_memory': None,
                            'allow_growth': False,
                            'log_device_placement': False,
-                           'visible_device_list': ""},
+                           'visible_device_list': "",
+                           'intra_op_parallelism_threads': 0,
+                           'inter_op_parallelism_threads': 0,
+                           'use_per_session_threads': False},
             start_specs={'restore_path': None,
                          'save_path': None,
                          'result_types': self.put_result_types_in_correct_order(
@@ -406,7 +576,10 @@ class Environment(object):
                              'train_dataset': default_dataset,
                              'batch_size': {'type': 'fixed', 'value': 64, 'name': 'batch_size'},
                              'train_batch_kwargs': dict(),
+                             'grad_accumulation_steps': {'type': 'fixed', 'value': 1,
+                                                         'name': 'grad_accumulation_steps'},
                              'checkpoint_steps': None,
+                             'trace_steps': None,
                              'debug': None,
                              'validation_datasets': None,
                              'validation_additions_to_feed_dict': list(),
@@ -435,7 +608,10 @@ class Environment(object):
                            'gpu_memory': None,
                            'allow_growth': False,
                            'log_device_placement': False,
-                           'visible_device_list': ""},
+                           'visible_device_list': "",
+                           'intra_op_parallelism_threads': 0,
+                           'inter_op_parallelism_threads': 0,
+                           'use_per_session_threads': False},
             start_specs={'restore_path': None,
                          'save_path': None,
                          'print_results': True,
@@ -446,6 +622,7 @@ class Environment(object):
                          'vocabulary': self._vocabulary},
             work=dict(additions_to_feed_dict=list(),
                       debug=None,
+                      trace_steps=None,
                       validation_datasets=None,
                       validation_batch_size=1,
                       validate_tokens_by_chars=False,
@@ -454,6 +631,7 @@ class Environment(object):
                       fuses=None,
                       fuse_tensors=construct(fuse_tensors),
                       fuse_file_name=None,
+                      fuse_batch_size=1,
                       example_length=None,
                       example_tensors=construct(example_tensors),
                       replicas=None,
@@ -492,6 +670,99 @@ class Environment(object):
         self._hooks.update(default_hooks)
         self._register_default_builders()
 
+    def _build_or_load_frozen(self, kwargs_for_building, frozen_graph_path):
+        if frozen_graph_path is None:
+            self._build(kwargs_for_building)
+        else:
+            self.load_frozen_graph(frozen_graph_path)
+
+    @staticmethod
+    def _hook_to_frozen_spec(hook):
+        """Returns JSON serializable description of hook used for finding hook in imported frozen graph"""
+        if isinstance(hook, (list, tuple)):
+            return [Environment._hook_to_frozen_spec(h) for h in hook]
+        if isinstance(hook, tf.Variable):
+            return {'variable': hook.name, 'initializer': hook.initializer.name, 'snapshot': hook.value().name}
+        return hook.name
+
+    @staticmethod
+    def _frozen_spec_node_names(spec):
+        if isinstance(spec, list):
+            return sum([Environment._frozen_spec_node_names(s) for s in spec], list())
+        if isinstance(spec, dict):
+            return [name.split(':')[0] for name in spec.values()]
+        return [spec.split(':')[0]]
+
+    def _frozen_spec_to_hook(self, spec, graph):
+        if isinstance(spec, list):
+            return [self._frozen_spec_to_hook(s, graph) for s in spec]
+        if isinstance(spec, dict):
+            variable_def = variable_pb2.VariableDef(
+                variable_name=spec['variable'], initializer_name=spec['initializer'], snapshot_name=spec['snapshot'])
+            variable = tf.Variable(variable_def=variable_def)
+            self._frozen_initializers.append(variable.initializer)
+            return variable
+        if ':' in spec:
+            return graph.get_tensor_by_name(spec)
+        return graph.get_operation_by_name(spec)
+
+    def export_frozen_graph(self,
+                            restore_path,
+                            save_path,
+                            hook_names=('validation_inputs', 'validation_predictions', 'reset_validation_state',
+                                        'randomize_sample_state', 'validation_state_variables', 'dropout',
+                                        'prefill_inputs', 'prefill_predictions', 'generation_start_predictions',
+                                        'generation_temperature', 'generation_max_length', 'generation_stop_id',
+                                        'generated_ids', 'generation_predictions', 'serving_inputs',
+                                        'serving_states', 'serving_new_states', 'serving_predictions')):
+        """Saves inference only graph. Pupil has to be built (preferably with regime='inference'). Weights restored
+        from restore_path are converted to constants, only subgraph needed for computing hook_names hooks is kept
+        (training ops, optimizer slots and saver are stripped) and constants are folded. State variables remain
+        variables so validation state can be saved and reset. Graph is written to save_path/graph.pb and hooks
+        names to save_path/manifest.json. The result can be loaded with load_frozen_graph instead of calling build.
+        Args:
+            restore_path: path to checkpoint
+            save_path: path to directory where frozen graph is saved
+            hook_names: names of hooks which are kept. Hooks absent in pupil are skipped"""
+        # graph transforms are not included in every TensorFlow build, so they are imported only for export
+        from tensorflow.tools.graph_transforms import TransformGraph
+        self._start_session(False, False, None, False, '')
+        self._initialize_pupil(restore_path)
+        specs = dict()
+        for name in hook_names:
+            if self._hooks.get(name) is not None:
+                specs[name] = self._hook_to_frozen_spec(self._hooks[name])
+        output_node_names = add_missing_to_list(
+            list(), sum([self._frozen_spec_node_names(spec) for spec in specs.values()], list()))
+        state_variable_names = [variable.op.name for variable in self._hooks.get('validation_state_variables', [])]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self._session, self._session.graph.as_graph_def(), output_node_names,
+            variable_names_blacklist=state_variable_names)
+        input_node_names = [node.name for node in graph_def.node
+                            if node.op in ['Placeholder', 'PlaceholderWithDefault']]
+        graph_def = TransformGraph(
+            graph_def, input_node_names, output_node_names, ['fold_constants(ignore_errors=true)'])
+        self._close_session()
+        create_path(save_path)
+        with open(os.path.join(save_path, 'graph.pb'), 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        with open(os.path.join(save_path, 'manifest.json'), 'w') as f:
+            json.dump({'hooks': specs}, f, indent=2)
+
+    def load_frozen_graph(self, path):
+        """Imports graph saved by export_frozen_graph into default graph and sets hooks. Used instead of build.
+        Variables do not have to be restored: restore_path passed to inference and telegram should be None"""
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            specs = json.load(f)['hooks']
+        graph_def = tf.GraphDef()
+        with open(os.path.join(path, 'graph.pb'), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+        graph = tf.get_default_graph()
+        self._frozen_initializers = list()
+        for name, spec in specs.items():
+            self._hooks[name] = self._frozen_spec_to_hook(spec, graph)
+
     def _split_to_loss_and_not_loss_names(self, names):
         loss_names = list()
         not_loss_names = list()
@@ -668,8 +939,18 @@ class Environment(object):
             return self.default_test_method_args
         return None
 
-    def _start_session(self, allow_soft_placement, log_device_placement, gpu_memory, allow_growth, visible_device_list):
-        """Starts new session with specified parameters. If there is opend session closes it"""
+    def _start_session(self,
+                       allow_soft_placement,
+                       log_device_placement,
+                       gpu_memory,
+                       allow_growth,
+                       visible_device_list,
+                       intra_op_parallelism_threads=0,
+                       inter_op_parallelism_threads=0,
+                       use_per_session_threads=False):
+        """Starts new session with specified parameters. If there is opend session closes it.
+        intra_op_parallelism_threads and inter_op_parallelism_threads equal to 0 mean that TensorFlow chooses number
+        of threads. Thread pools are created once per process unless use_per_session_threads is True"""
         if self._session is not None:
             print('Warning: there is an opened session already. Closing it')
             self._session.close()
@@ -679,11 +960,21 @@ class Environment(object):
                                 gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_memory,
                                                           allow_growth=allow_growth,
                                                           visible_device_list=visible_device_list),
-                                log_device_placement=log_device_placement
+                                log_device_placement=log_device_placement,
+                                intra_op_parallelism_threads=intra_op_parallelism_threads,
+                                inter_op_parallelism_threads=inter_op_parallelism_threads,
+                                use_per_session_threads=use_per_session_threads
                                 )
         # config.gpu_options.per_process_gpu_memory_fraction = gpu_memory
         self._session = tf.Session(config=config)
 
+    @staticmethod
+    def _threading_session_specs(session_specs):
+        return dict(
+            intra_op_parallelism_threads=session_specs['intra_op_parallelism_threads'],
+            inter_op_parallelism_threads=session_specs['inter_op_parallelism_threads'],
+            use_per_session_threads=session_specs['use_per_session_threads'])
+
     def _close_session(self):
         self._session.close()
         self._session = None
@@ -720,12 +1011,40 @@ class Environment(object):
         elif model_type == 'meta_optimizer':
             self._hooks['saver'].save(self._session, path)
 
-    def _initialize_pupil(self, restore_path):
+    def _initialize_pupil(self, restore_path, feed_dict=None):
+        if self._frozen_initializers is not None:
+            # weights of frozen graph are constants. Only state variables are initialized
+            self._session.run(self._frozen_initializers)
+            self._prefix_cache.clear()
+            return None
         if restore_path is not None:
             print('restoring from %s' % restore_path)
-        self._session.run(tf.global_variables_initializer())
+        self._session.run(tf.global_variables_initializer(), feed_dict=feed_dict)
         if restore_path is not None:
             self._hooks['saver'].restore(self._session, restore_path)
+        self._prefix_cache.clear()
+
+    def _run_with_trace(self, operations, feed_dict, traces_path, trace_name):
+        """Runs operations with full trace RunOptions and saves collected trace to traces_path"""
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        res = self._session.run(operations, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+        self._save_trace(run_metadata, traces_path, trace_name)
+        return res
+
+    @staticmethod
+    def _save_trace(run_metadata, traces_path, trace_name):
+        """Writes Chrome trace JSON timeline (it can be opened at chrome://tracing) and a summary of op times
+        by name scopes"""
+        create_path(traces_path)
+        chrome_trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        with open(traces_path + '/timeline_%s.json' % trace_name, 'w') as f:
+            f.write(chrome_trace)
+        scope_times = op_time_by_name_scope(run_metadata.step_stats)
+        with open(traces_path + '/op_time_by_scope_%s.txt' % trace_name, 'w') as f:
+            f.write('%s %s %s\n' % ('time_ms', 'num_ops', 'name_scope'))
+            for scope, (micros, num_ops) in sorted(scope_times.items(), key=lambda item: -item[1][0]):
+                f.write('%.3f %s %s\n' % (micros / 1000., num_ops, scope))
 
     def test(self,
              **kwargs):
@@ -748,7 +1067,8 @@ class Environment(object):
                             session_specs['log_device_placement'],
                             session_specs['gpu_memory'],
                             session_specs['allow_growth'],
-                            session_specs['visible_device_list'])
+                            session_specs['visible_device_list'],
+                            **self._threading_session_specs(session_specs))
         self._initialize_pupil(start_specs['restore_path'])
         add_feed_dict = dict()
         # print("(Environment.test)work['additions_to_feed_dict']:", work['additions_to_feed_dict'])
@@ -773,11 +1093,18 @@ class Environment(object):
                                 verbose=start_specs['verbose'])
         # print('(Environment.test)self._storage:', self._storage)
         self._handler.log_launch()
+        if work['trace_steps'] is not None and start_specs['save_path'] is not None:
+            trace_steps = work['trace_steps']
+            traces_path = start_specs['save_path'] + '/traces'
+        else:
+            trace_steps = None
+            traces_path = None
         empty_batch_gen = batch_generator_class('', 1, vocabulary=start_specs['vocabulary'])
         if work['fuses'] is not None:
             fuse_res = self._on_fuses(empty_batch_gen,
                                       work['fuses'],
-                                      additional_feed_dict=add_feed_dict)
+                                      additional_feed_dict=add_feed_dict,
+                                      batch_size=work['fuse_batch_size'])
         else:
             fuse_res = None
 
@@ -787,12 +1114,14 @@ class Environment(object):
             if work['validate_tokens_by_chars']:
                 _ = self._validate_by_chars(
                     batch_generator_class, validation_dataset, work['validation_batch_size'],
-                    work['valid_batch_kwargs'], additional_feed_dict=add_feed_dict)
+                    work['valid_batch_kwargs'], additional_feed_dict=add_feed_dict,
+                    trace_steps=trace_steps, traces_path=traces_path)
             else:
                 # print('(Environment.test)self._storage:', self._storage)
                 _ = self._validate(
                     batch_generator_class, validation_dataset, work['validation_batch_size'],
-                    work['valid_batch_kwargs'], additional_feed_dict=add_feed_dict)
+                    work['valid_batch_kwargs'], additional_feed_dict=add_feed_dict,
+                    trace_steps=trace_steps, traces_path=traces_path)
         if work['example_length'] is not None:
             example_res = list()
             for validation_dataset in validation_datasets:
@@ -811,41 +1140,195 @@ class Environment(object):
         self._close_session()
         return fuse_res, example_res
 
+    def _truncated_normal(self, shape):
+        """Normal distribution (stddev=1.) samples with values further than 2 stddevs resampled as in
+        tf.truncated_normal"""
+        values = self._sampling_rng.normal(size=shape)
+        out = np.abs(values) > 2.
+        while np.any(out):
+            values[out] = self._sampling_rng.normal(size=np.sum(out))
+            out = np.abs(values) > 2.
+        return values
+
+    def _on_fuses_batched(self,
+                          batch_generator,
+                          fuses,
+                          batch_size,
+                          training_step=None,
+                          additional_feed_dict=None):
+        """Processes all repeats of all fuses with serving graph. Batch rows are repeats of fuses and all rows of a
+        batch advance in lockstep: a row feeds its prompt characters and then generated characters. Row is removed
+        from batch when its 'new_line' or 'limit' stop condition is met. States of rows are gathered before every
+        step and scattered after it. Results are passed to Handler in the original order of fuses and repeats."""
+        if additional_feed_dict is None:
+            additional_feed_dict = dict()
+        character_positions_in_vocabulary = batch_generator.character_positions_in_vocabulary
+        new_line_id = character_positions_in_vocabulary.get('\n', -1)
+        rows = list()
+        for fuse_idx, fuse in enumerate(fuses):
+            prompt = [char2id(char, character_positions_in_vocabulary) for char in fuse['text']]
+            sampling = dict(
+                temperature=fuse.get('temperature', 0.), top_k=fuse.get('top_k'), top_p=fuse.get('top_p'))
+            for _ in range(fuse['num_repeats']):
+                rows.append(dict(fuse_idx=fuse_idx, fuse=fuse, prompt=prompt, sampling=sampling,
+                                 num_fed=0, generated=list()))
+        state_shapes = [state.get_shape().as_list()[1:] for state in self._hooks['serving_states']]
+        for start in range(0, len(rows), batch_size):
+            print('Number of processed fuse repeats:', start)
+            batch_rows = rows[start:start + batch_size]
+            # state is randomized or reset as in _on_fuses method
+            if 'randomize_sample_state' in self._hooks:
+                states = [self._truncated_normal([len(batch_rows)] + shape) for shape in state_shapes]
+            else:
+                states = [np.zeros([len(batch_rows)] + shape) for shape in state_shapes]
+            active = [row_idx for row_idx, row in enumerate(batch_rows) if len(row['prompt']) > 0]
+            while len(active) > 0:
+                input_ids = list()
+                for row_idx in active:
+                    row = batch_rows[row_idx]
+                    if row['num_fed'] < len(row['prompt']):
+                        input_ids.append(row['prompt'][row['num_fed']])
+                    else:
+                        input_ids.append(row['generated'][-1])
+                feed_dict = dict(additional_feed_dict.items())
+                feed_dict[self._hooks['serving_inputs']] = np.array(input_ids)
+                for placeholder, state in zip(self._hooks['serving_states'], states):
+                    feed_dict[placeholder] = state[active]
+                res = self._session.run(
+                    [self._hooks['serving_predictions']] + self._hooks['serving_new_states'], feed_dict=feed_dict)
+                predictions, new_states = res[0], res[1:]
+                for state, new_state in zip(states, new_states):
+                    state[active] = new_state
+                still_active = list()
+                for row_idx, prediction in zip(active, predictions):
+                    row = batch_rows[row_idx]
+                    max_num_of_chars = row['fuse']['max_num_of_chars']
+                    if row['num_fed'] < len(row['prompt']):
+                        row['num_fed'] += 1
+                        if row['num_fed'] < len(row['prompt']):
+                            still_active.append(row_idx)
+                            continue
+                        if max_num_of_chars == 0:
+                            continue
+                    row['generated'].append(self._sample_id(prediction, **row['sampling']))
+                    # number of fed generated characters is compared to limit as in _on_fuses method
+                    num_generated_fed = len(row['generated']) - 1
+                    if num_generated_fed >= max_num_of_chars - 1:
+                        continue
+                    if row['fuse']['fuse_stop'] == 'new_line' and num_generated_fed > 0 \
+                            and row['generated'][-1] == new_line_id:
+                        continue
+                    still_active.append(row_idx)
+                active = still_active
+        for fuse_idx, _ in enumerate(fuses):
+            self._handler.set_processed_fuse_index(fuse_idx)
+            for row in rows:
+                if row['fuse_idx'] == fuse_idx:
+                    self._handler.add_fuse_result(
+                        ''.join([id2char(id_, batch_generator.vocabulary) for id_ in row['generated']]))
+            self._handler.set_processed_fuse_index(None)
+        res = self._handler.dispense_fuse_results(training_step)
+        return res
+
     def _on_fuses(self,
                   batch_generator,
                   fuses,
                   training_step=None,
-                  additional_feed_dict=None):
+                  additional_feed_dict=None,
+                  batch_size=1):
+        """Feeds fuses to pupil and generates continuations. If batch_size is greater than 1, fuse tensors are not
+        requested and pupil has serving graph, repeats of fuses are processed in batches (_on_fuses_batched
+        method)"""
         if additional_feed_dict is None:
             additional_feed_dict = dict()
+        if batch_size > 1 and self._hooks.get('serving_inputs') is not None \
+                and not self._handler.fuse_tensors_are_scheduled() \
+                and all([fuse.get('beam_width', 1) == 1 for fuse in fuses]):
+            return self._on_fuses_batched(batch_generator, fuses, batch_size, training_step=training_step,
+                                          additional_feed_dict=additional_feed_dict)
+        # prompts are fed in one session call if no tensors are requested on prompt characters
+        use_prefill = self._prefill_is_available() and not self._handler.fuse_tensors_are_scheduled()
+        use_generation = use_prefill and self._generation_is_available()
         for fuse_idx, fuse in enumerate(fuses):
             if fuse_idx % 100 == 0:
                 print('Number of processed fuses:', fuse_idx)
             self._handler.set_processed_fuse_index(fuse_idx)
+            # continuation is greedy if temperature is not specified
+            fuse_sampling = dict(
+                temperature=fuse.get('temperature', 0.), top_k=fuse.get('top_k'), top_p=fuse.get('top_p'))
             for repeat_idx in range(fuse['num_repeats']):
                 if 'randomize_sample_state' in self._hooks:
                     self._session.run(self._hooks['randomize_sample_state'])
                 elif 'reset_validation_state' in self._hooks:
                     self._session.run(self._hooks['reset_validation_state'])
                 # print("fuse['text']:", [fuse['text']])
-                for char_idx, char in enumerate(fuse['text']):
-                    vec = batch_generator.char2vec(char, batch_generator.character_positions_in_vocabulary)
-                    feed_dict = {self._hooks['validation_inputs']: vec}
-                    feed_dict.update(additional_feed_dict)
-                    fuse_operations = self._handler.get_tensors('fuse', char_idx)
-                    # print('(_on_fuses)feed_dict:', feed_dict)
-                    fuse_res = self._session.run(fuse_operations, feed_dict=feed_dict)
-                    if char_idx == len(fuse['text']) - 1 and fuse['max_num_of_chars'] > 0:
+                if use_prefill:
+                    char_idx = len(fuse['text']) - 1
+                    # tensor order has to be set for processing results
+                    _ = self._handler.get_tensors('fuse', char_idx)
+                    feeds = [batch_generator.char2vec(char, batch_generator.character_positions_in_vocabulary)
+                             for char in fuse['text']]
+                    prompt_prediction = self._prefill(feeds, additional_feed_dict)
+                    fuse_res = [self._sample(prompt_prediction, **fuse_sampling)]
+                    if fuse['max_num_of_chars'] > 0:
                         self._handler.start_fuse_accumulation()
                     self._handler.process_results(char_idx, fuse_res, regime='fuse')
+                else:
+                    for char_idx, char in enumerate(fuse['text']):
+                        vec = batch_generator.char2vec(char, batch_generator.character_positions_in_vocabulary)
+                        feed_dict = {self._hooks['validation_inputs']: vec}
+                        feed_dict.update(additional_feed_dict)
+                        fuse_operations = self._handler.get_tensors('fuse', char_idx)
+                        # print('(_on_fuses)feed_dict:', feed_dict)
+                        fuse_res = self._session.run(fuse_operations, feed_dict=feed_dict)
+                        if char_idx == len(fuse['text']) - 1 and fuse['max_num_of_chars'] > 0:
+                            prompt_prediction = fuse_res[0]
+                            fuse_res[0] = self._sample(fuse_res[0], **fuse_sampling)
+                            self._handler.start_fuse_accumulation()
+                        self._handler.process_results(char_idx, fuse_res, regime='fuse')
                 # self._handler.start_fuse_accumulation()
-                if fuse['fuse_stop'] == 'limit':
+                if fuse.get('beam_width', 1) > 1 and fuse['max_num_of_chars'] > 0:
+                    if fuse['fuse_stop'] == 'new_line':
+                        stop_id = batch_generator.character_positions_in_vocabulary.get('\n', -1)
+                    else:
+                        stop_id = -1
+                    # beam search starts from not sampled prediction
+                    ids, _ = self._beam_search_from_variables(
+                        prompt_prediction, additional_feed_dict, fuse['beam_width'],
+                        max_length=fuse['max_num_of_chars'], stop_id=stop_id)
+                    # text predicted greedily after prompt is replaced by the best beam
+                    self._handler.start_fuse_accumulation()
+                    for char_idx, id_ in enumerate(ids, start=len(fuse['text']) - 1):
+                        pred = np.zeros(np.reshape(fuse_res[0], (1, -1)).shape)
+                        pred[0, id_] = 1.
+                        self._handler.process_results(char_idx, [pred], regime='fuse')
+                elif use_generation and fuse['max_num_of_chars'] > 1 \
+                        and fuse_sampling['top_k'] is None and fuse_sampling['top_p'] is None:
+                    if fuse['fuse_stop'] == 'new_line':
+                        stop_id = batch_generator.character_positions_in_vocabulary.get('\n', -1)
+                    else:
+                        stop_id = -1
+                    ids, last_prediction = self._generate_in_graph(
+                        fuse_res[0], additional_feed_dict, temperature=fuse_sampling['temperature'],
+                        max_length=fuse['max_num_of_chars'] - 1, stop_id=stop_id)
+                    # every fed token except the first one is a prediction of pupil
+                    preds = list()
+                    for id_ in ids[1:]:
+                        pred = np.zeros(np.reshape(last_prediction, (1, -1)).shape)
+                        pred[0, id_] = 1.
+                        preds.append(pred)
+                    if ids[-1] != stop_id:
+                        preds.append(self._sample(last_prediction, **fuse_sampling))
+                    for char_idx, pred in enumerate(preds, start=len(fuse['text'])):
+                        self._handler.process_results(char_idx, [pred], regime='fuse')
+                elif fuse['fuse_stop'] == 'limit':
                     for char_idx in range(len(fuse['text']), len(fuse['text']) + fuse['max_num_of_chars'] - 1):
                         vec = batch_generator.pred2vec(fuse_res[0])
                         feed_dict = {self._hooks['validation_inputs']: vec}
                         feed_dict.update(additional_feed_dict)
                         fuse_operations = self._handler.get_tensors('fuse', char_idx)
                         fuse_res = self._session.run(fuse_operations, feed_dict=feed_dict)
+                        fuse_res[0] = self._sample(fuse_res[0], **fuse_sampling)
                         self._handler.process_results(char_idx, fuse_res, regime='fuse')
                 elif fuse['fuse_stop'] == 'new_line':
                     char = None
@@ -857,6 +1340,7 @@ class Environment(object):
                         feed_dict.update(additional_feed_dict)
                         fuse_operations = self._handler.get_tensors('fuse', char_idx)
                         fuse_res = self._session.run(fuse_operations, feed_dict=feed_dict)
+                        fuse_res[0] = self._sample(fuse_res[0], **fuse_sampling)
                         self._handler.process_results(char_idx, fuse_res, regime='fuse')
                         char = batch_generator.vec2char(fuse_res[0], batch_generator.vocabulary)[0]
                         # print('char:', char)
@@ -876,7 +1360,7 @@ class Environment(object):
                              training_step=None):
         if additional_feed_dict is None:
             additional_feed_dict = dict()
-        example_batches = batch_generator_class(validation_dataset[0], 1, **valid_batch_kwargs)
+        example_batches = batch_generator_class(dataset_text(validation_dataset[0]), 1, **valid_batch_kwargs)
         self._handler.start_example_accumulation()
         for c_idx in range(min(example_length, example_batches.get_dataset_length()) + 1):
             inputs, _ = example_batches.next()
@@ -904,15 +1388,21 @@ class Environment(object):
                   additional_feed_dict=dict(),
                   save_to_file=None,
                   save_to_storage=None,
-                  print_results=None):
+                  print_results=None,
+                  trace_steps=None,
+                  traces_path=None):
         # print('valid_batch_kwargs:', valid_batch_kwargs)
         if 'reset_validation_state' in self._hooks:
             self._session.run(self._hooks['reset_validation_state'])
         #print('batch_generator_class:', batch_generator_class)
-        valid_batches = batch_generator_class(validation_dataset[0], validation_batch_size, **valid_batch_kwargs)
+        valid_batches = batch_generator_class(
+            dataset_text(validation_dataset[0]), validation_batch_size, **valid_batch_kwargs)
         length = valid_batches.get_dataset_length()
         inputs, labels = valid_batches.next()
         step = 0
+        # validation steps are counted separately from training steps stored in self._storage
+        trace_storage = dict(step=step)
+        trace_controller = Controller(trace_storage, trace_steps) if trace_steps is not None else None
         self._handler.start_accumulation(validation_dataset[1], training_step=training_step)
         while step < length:
             validation_operations = self._handler.get_tensors('validation', step)
@@ -920,7 +1410,13 @@ class Environment(object):
                          self._hooks['validation_labels']: labels}
             if isinstance(additional_feed_dict, dict):
                 feed_dict.update(additional_feed_dict)
-            valid_res = self._session.run(validation_operations, feed_dict=feed_dict)
+            trace_storage['step'] = step
+            if trace_controller is not None and trace_controller.get():
+                valid_res = self._run_with_trace(
+                    validation_operations, feed_dict, traces_path,
+                    'validation_%s_%s' % (validation_dataset[1], step))
+            else:
+                valid_res = self._session.run(validation_operations, feed_dict=feed_dict)
             self._handler.process_results(training_step, valid_res, regime='validation')
             step += 1
             inputs, labels = valid_batches.next()
@@ -940,17 +1436,23 @@ class Environment(object):
             additional_feed_dict=None,
             save_to_file=None,
             save_to_storage=None,
-            print_results=None):
+            print_results=None,
+            trace_steps=None,
+            traces_path=None):
         if additional_feed_dict is None:
             additional_feed_dict = dict()
         # print('valid_batch_kwargs:', valid_batch_kwargs)
         if 'reset_validation_state' in self._hooks:
             self._session.run(self._hooks['reset_validation_state'])
         #print('batch_generator_class:', batch_generator_class)
-        valid_batches = batch_generator_class(validation_dataset[0], validation_batch_size, **valid_batch_kwargs)
+        valid_batches = batch_generator_class(
+            dataset_text(validation_dataset[0]), validation_batch_size, **valid_batch_kwargs)
         length = valid_batches.get_dataset_length()
         inputs, labels, correct_tokens = valid_batches.next_with_tokens()
         step = 0
+        # validation steps are counted separately from training steps stored in self._storage
+        trace_storage = dict(step=step)
+        trace_controller = Controller(trace_storage, trace_steps) if trace_steps is not None else None
         self._handler.start_accumulation(validation_dataset[1], training_step=training_step)
         while step < length:
             validation_operations = self._handler.get_tensors('validation', step)
@@ -958,7 +1460,13 @@ class Environment(object):
                          self._hooks['validation_labels']: labels}
             if isinstance(additional_feed_dict, dict):
                 feed_dict.update(additional_feed_dict)
-            valid_res = self._session.run(validation_operations, feed_dict=feed_dict)
+            trace_storage['step'] = step
+            if trace_controller is not None and trace_controller.get():
+                valid_res = self._run_with_trace(
+                    validation_operations, feed_dict, traces_path,
+                    'validation_%s_%s' % (validation_dataset[1], step))
+            else:
+                valid_res = self._session.run(validation_operations, feed_dict=feed_dict)
             self._handler.process_results(training_step, valid_res, correct_tokens[0], regime='validation_by_chars')
             step += 1
             inputs, labels, correct_tokens = valid_batches.next_with_tokens()
@@ -1064,11 +1572,25 @@ class Environment(object):
             valid_add_feed_dict[self._hooks[addition['placeholder']]] = addition['value']
         return valid_add_feed_dict
 
+    def _feed_train_batch(self, feed_dict, batch):
+        train_inputs, train_labels = batch
+        if isinstance(self._hooks['inputs'], list):
+            for input_tensor, input_value in zip(self._hooks['inputs'], train_inputs):
+                feed_dict[input_tensor] = input_value
+        else:
+            feed_dict[self._hooks['inputs']] = train_inputs
+        if isinstance(self._hooks['labels'], list):
+            for label_tensor, label_value in zip(self._hooks['labels'], train_labels):
+                feed_dict[label_tensor] = label_value
+        else:
+            feed_dict[self._hooks['labels']] = train_labels
+
     def _train(self,
                run_specs,
                checkpoints_path,
                batch_generator_class,
-               init_step=0):
+               init_step=0,
+               traces_path=None):
         """It is a method that does actual training and responsible for one training pass through dataset. It is called
         from train method (maybe several times)
         Args:
@@ -1091,7 +1613,8 @@ class Environment(object):
         for addition in train_feed_dict_additions:
             additional_controllers.append(Controller(self._storage, addition['value']))
 
-        if train_specs['stop']['type'] == 'limit_steps':
+        if train_specs['stop']['type'] == 'limit_steps' or \
+                (train_specs['stop']['type'] == 'early_stopping' and 'limit' in train_specs['stop']):
             train_specs['stop']['limit'] += init_step
         should_continue = Controller(self._storage, train_specs['stop'])
 
@@ -1128,6 +1651,17 @@ class Environment(object):
             it_is_time_to_create_checkpoint = Controller(self._storage,
                                                          {'type': 'always_false'})
 
+        if train_specs['trace_steps'] is not None and traces_path is not None:
+            if train_specs['trace_steps']['type'] == 'true_on_steps':
+                for idx in range(len(train_specs['trace_steps']['steps'])):
+                    train_specs['trace_steps']['steps'][idx] += init_step
+            it_is_time_to_trace = Controller(self._storage, train_specs['trace_steps'])
+        else:
+            it_is_time_to_trace = Controller(self._storage,
+                                             {'type': 'always_false'})
+
+        grad_accumulation_steps_controller = Controller(self._storage, train_specs['grad_accumulation_steps'])
+
         batch_size_controller = Controller(self._storage, train_specs['batch_size'])
         batch_size_change_tracker_specs = Controller.create_change_tracking_specifications(train_specs['batch_size'])
         batch_size_should_change = Controller(self._storage, batch_size_change_tracker_specs)
@@ -1169,7 +1703,7 @@ class Environment(object):
 
         batch_size = batch_size_controller.get()
         tb_kwargs = self._build_batch_kwargs(train_batch_kwargs)
-        train_batches = batch_generator_class(train_specs['train_dataset'][0], batch_size, **tb_kwargs)
+        train_batches = batch_generator_class(dataset_text(train_specs['train_dataset'][0]), batch_size, **tb_kwargs)
         feed_dict = dict()
         while should_continue.get():
             if should_start_debugging.get():
@@ -1188,25 +1722,29 @@ class Environment(object):
                 self._create_checkpoint(step, checkpoints_path)
 
             learning_rate = learning_rate_controller.get()
-            train_inputs, train_labels = train_batches.next()
             feed_dict[self._hooks['learning_rate']] = learning_rate
-            if isinstance(self._hooks['inputs'], list):
-                for input_tensor, input_value in zip(self._hooks['inputs'], train_inputs):
-                    feed_dict[input_tensor] = input_value
-            else:
-                feed_dict[self._hooks['inputs']] = train_inputs
-            if isinstance(self._hooks['labels'], list):
-                for label_tensor, label_value in zip(self._hooks['labels'], train_labels):
-                    feed_dict[label_tensor] = label_value
-            else:
-                feed_dict[self._hooks['labels']] = train_labels
             for addition, add_controller in zip(train_feed_dict_additions, additional_controllers):
                 feed_dict[self._hooks[addition['placeholder']]] = add_controller.get()
-            train_operations = self._handler.get_tensors('train', step)
+
+            grad_accumulation_steps = grad_accumulation_steps_controller.get()
+            accumulate = grad_accumulation_steps > 1
+            if accumulate and self._hooks.get('accumulate_grads') is None:
+                raise InvalidArgumentError(
+                    'Pupil has to be built with gradient_accumulation=True if grad_accumulation_steps > 1',
+                    grad_accumulation_steps, 'grad_accumulation_steps', '1')
+            for _ in range(grad_accumulation_steps - 1):
+                self._feed_train_batch(feed_dict, train_batches.next())
+                self._session.run(self._hooks['accumulate_grads'], feed_dict=feed_dict)
+
+            self._feed_train_batch(feed_dict, train_batches.next())
+            train_operations = self._handler.get_tensors('train', step, with_accumulated_grads=accumulate)
             # print('train_operations:', train_operations)
             # print('feed_dict:', feed_dict)
 
-            train_res = self._session.run(train_operations, feed_dict=feed_dict)
+            if it_is_time_to_trace.get():
+                train_res = self._run_with_trace(train_operations, feed_dict, traces_path, 'train_%s' % step)
+            else:
+                train_res = self._session.run(train_operations, feed_dict=feed_dict)
             # here loss is given in bits per input (BPI)
 
             self._handler.process_results(step, train_res, regime='train')
@@ -1275,6 +1813,11 @@ class Environment(object):
                     put ops on available devices
                 gpu_memory: memory fraction tensorflow allowed to allocate. If None all available memory is allocated
                 log_device_placement: If True device placements are printed to console
+                intra_op_parallelism_threads: number of threads used inside one op. 0 means that TensorFlow chooses
+                    it
+                inter_op_parallelism_threads: number of ops executed in parallel. 0 means that TensorFlow chooses it
+                use_per_session_threads: if True thread pools are created for session instead of reusing process
+                    wide pools (thread settings of sessions started later are ignored otherwise)
                 restore_path: If provided graph will be restored from checkpoint
                 save_path: path to directory where all results are saved
                 result_types: specifies what types of results should be collected. loss, perplexity, accuracy, bpc are
@@ -1291,13 +1834,34 @@ class Environment(object):
                         init: float, initial learning rate
                         decay: a factor on which learning rate is multiplied every period of steps
                         period: number of steps after which learning rate is being decreased
+                    reduce on plateau:
+                        type: str 'reduce_on_plateau'
+                        init: float, initial learning rate
+                        factor: a factor on which learning rate is multiplied if monitored result stopped improving
+                        patience: number of results without improvement after which learning rate is decreased
+                        dataset_name: name of dataset which results are monitored ('train' for results collected
+                            while training)
+                        result_type: monitored result type (e.g. 'loss')
+                        min_delta: minimal change counted as improvement. Default is 0.
+                        mode: 'min' or 'max'. Default is 'min'
+                        min_value: learning rate is not decreased below min_value. Default is 0.
                 additions_to_feed_dict: If your model requires some special placeholders filling (e. g. probability
                     distribution for a stochastic node) it is provided through additions_to_feed_dict. It is a
                     dictionary which keys are tensor aliases in _pupil_hooks attribute and values are dictionaries
                     of the same structure as learning_rate
                 stop: specifies when learning should be stopped. It is either an integer (number of steps after which
                     learning is being stopped) or a dictionary of the same structure as learning_rate where you may
-                    specify custom way of learning interruption
+                    specify custom way of learning interruption. For early stopping use dictionary
+                        type: str 'early_stopping'
+                        limit: number of steps after which learning is stopped anyway (optional)
+                        conditions: list of controller specifications. Learning is stopped when any of them is True.
+                            Following types are useful:
+                            plateau: True if result has not improved during 'patience' results. Entries are
+                                'dataset_name', 'result_type', 'patience', 'min_delta' and 'mode' (same as for
+                                reduce_on_plateau)
+                            diverged: True if last result is NaN or infinite or worse than 'threshold' (optional).
+                                Entries are 'dataset_name', 'result_type', 'threshold' and 'mode'. NaN values are
+                                skipped when validation means are computed so use 'train' dataset for NaN detection
                 train_dataset: A dataset on which model will be trained. It can be a name of dataset provided earlier to
                     Environment constructor or just something what you wish to pass to batch generator (file name, str,
                     etc.)
@@ -1308,7 +1872,13 @@ class Environment(object):
                     construction for training (any of batch generator parameters can be provided as key word args
                     separately if their processing is described in _process_batch_kwargs_shortcut method. Now it is only
                     'vocabulary' and 'num_unrollings')
+                grad_accumulation_steps: integer or dictionary of the same type as learning_rate. If it is greater
+                    than 1 gradients are accumulated over grad_accumulation_steps batches and applied once per step.
+                    Pupil has to be built with gradient_accumulation=True. Default is 1
                 checkpoint_steps: list of steps on which checpoints should be created
+                trace_steps: list of steps (or period as integer) on which training step is run with full trace.
+                    Chrome trace timeline and op times grouped by name scopes are saved to save_path/traces. Default
+                    is None
                 debug: step on which tfdbg should be activated. Default is None
                 validation_dataset_names: list of dataset names used for validation (datasets have to provided to
                     Environment instance separately. Now only through constructor
@@ -1359,15 +1929,117 @@ class Environment(object):
                                 session_specs['log_device_placement'],
                                 session_specs['gpu_memory'],
                                 session_specs['allow_growth'],
-                                session_specs['visible_device_list'])
+                                session_specs['visible_device_list'],
+                                **self._threading_session_specs(session_specs))
         self._train_repeatedly(start_specs, run_specs_set)
         if close_session:
             self._close_session()
 
+    def tune_session_threads(self,
+                             *args,
+                             candidates=None,
+                             num_warmup_steps=3,
+                             num_timed_steps=10,
+                             set_as_default=False,
+                             **kwargs):
+        """Times several training steps of current model under candidate thread settings and returns the fastest
+        one. Every candidate is tried in a new session with use_per_session_threads=True because otherwise thread
+        pools created by the first session are reused by all following sessions.
+        Args:
+            args, kwargs: same as for train method. Only session_specs, restore_path, batch_generator_class and
+                the first set of train_specs are used
+            candidates: list of dictionaries with keys 'intra_op_parallelism_threads' and
+                'inter_op_parallelism_threads'. By default intra op threads are powers of 2 not exceeding number of
+                available cores and inter op threads are 1 and 2
+            num_warmup_steps: number of steps which are not timed
+            num_timed_steps: number of timed steps
+            set_as_default: if True the fastest thread settings are set in default session_specs of train and test
+                methods
+        Returns:
+            dictionary with the fastest thread settings"""
+        tmp_output = parse_train_method_arguments(self,
+                                                  args,
+                                                  kwargs,
+                                                  set_passed_parameters_as_default=False)
+        session_specs = tmp_output['session_specs']
+        start_specs = tmp_output['start_specs']
+        train_specs = construct(tmp_output['run'][0]['train_specs'])
+        if candidates is None:
+            candidates = list()
+            num_threads = 1
+            while num_threads <= mp.cpu_count():
+                for inter_op_threads in [1, 2]:
+                    candidates.append({'intra_op_parallelism_threads': num_threads,
+                                       'inter_op_parallelism_threads': inter_op_threads})
+                num_threads *= 2
+
+        self.flush_storage()
+        self.set_in_storage(step=0)
+        feed_dict = {self._hooks['learning_rate']: Controller(self._storage, train_specs['learning_rate']).get()}
+        for addition in train_specs['additions_to_feed_dict']:
+            feed_dict[self._hooks[addition['placeholder']]] = Controller(self._storage, addition['value']).get()
+        train_batch_kwargs = dict()
+        for key, batch_arg in train_specs['train_batch_kwargs'].items():
+            if isinstance(batch_arg, dict) and 'type' in batch_arg:
+                train_batch_kwargs[key] = Controller(self._storage, batch_arg)
+            else:
+                train_batch_kwargs[key] = batch_arg
+        batch_size = Controller(self._storage, train_specs['batch_size']).get()
+        train_batches = start_specs['batch_generator_class'](
+            dataset_text(train_specs['train_dataset'][0]), batch_size, **self._build_batch_kwargs(train_batch_kwargs))
+
+        best_time = None
+        best_candidate = None
+        for candidate in candidates:
+            self._start_session(session_specs['allow_soft_placement'],
+                                session_specs['log_device_placement'],
+                                session_specs['gpu_memory'],
+                                session_specs['allow_growth'],
+                                session_specs['visible_device_list'],
+                                intra_op_parallelism_threads=candidate['intra_op_parallelism_threads'],
+                                inter_op_parallelism_threads=candidate['inter_op_parallelism_threads'],
+                                use_per_session_threads=True)
+            self._initialize_pupil(start_specs['restore_path'])
+            for _ in range(num_warmup_steps):
+                self._feed_train_batch(feed_dict, train_batches.next())
+                self._session.run(self._hooks['train_op'], feed_dict=feed_dict)
+            start_time = time.time()
+            for _ in range(num_timed_steps):
+                self._feed_train_batch(feed_dict, train_batches.next())
+                self._session.run(self._hooks['train_op'], feed_dict=feed_dict)
+            step_time = (time.time() - start_time) / num_timed_steps
+            self._close_session()
+            print('intra_op_parallelism_threads: %s, inter_op_parallelism_threads: %s, time per step: %.4f s' %
+                  (candidate['intra_op_parallelism_threads'], candidate['inter_op_parallelism_threads'], step_time))
+            if best_time is None or step_time < best_time:
+                best_time = step_time
+                best_candidate = candidate
+        best = {'intra_op_parallelism_threads': best_candidate['intra_op_parallelism_threads'],
+                'inter_op_parallelism_threads': best_candidate['inter_op_parallelism_threads'],
+                'use_per_session_threads': True}
+        print('fastest thread settings:', best)
+        if set_as_default:
+            self._default_train_method_args['session_specs'].update(best)
+            self._default_test_method_args['session_specs'].update(best)
+        return best
+
+    def _initialization_feed_dict(self, run_specs_set):
+        """Values of hyperparameters which pupil class feeds to variables initializer are taken from
+        additions_to_feed_dict of the first run specs"""
+        feed_dict = dict()
+        if len(run_specs_set) == 0 or not hasattr(self._pupil_class, 'get_feedable_hyperparameters'):
+            return feed_dict
+        feedable = self._pupil_class.get_feedable_hyperparameters()
+        self.set_in_storage(step=0)
+        for addition in run_specs_set[0]['train_specs']['additions_to_feed_dict']:
+            if feedable.get(addition['placeholder']) == 'initialization':
+                feed_dict[self._hooks[addition['placeholder']]] = Controller(self._storage, addition['value']).get()
+        return feed_dict
+
     def _train_repeatedly(self, start_specs, run_specs_set):
         # initializing model
         self.flush_storage()
-        self._initialize_pupil(start_specs['restore_path'])
+        self._initialize_pupil(start_specs['restore_path'], feed_dict=self._initialization_feed_dict(run_specs_set))
 
         # print('start_specs:', start_specs)
 
@@ -1384,14 +2056,17 @@ class Environment(object):
         if start_specs['save_path'] is not None:
             checkpoints_path = start_specs['save_path'] + '/checkpoints'
             create_path(checkpoints_path)
+            traces_path = start_specs['save_path'] + '/traces'
         else:
             checkpoints_path = None
+            traces_path = None
         init_step = 0
         for run_specs in run_specs_set:
             init_step = self._train(run_specs,
                                     checkpoints_path,
                                     start_specs['batch_generator_class'],
-                                    init_step=init_step)
+                                    init_step=init_step,
+                                    traces_path=traces_path)
         if checkpoints_path is not None:
             self._create_checkpoint('final', checkpoints_path)
         self._handler.log_finish_time()
@@ -1402,8 +2077,11 @@ class Environment(object):
                                              kwargs_for_building,
                                              session_specs,
                                              args_for_launches,
-                                             evaluation):
-
+                                             evaluation,
+                                             task_idx=0):
+        """Builds pupil once and trains and evaluates it with all sets of arguments from args_for_launches. Results
+        are put into queue as tuples (task_idx, launch_idx, result). When all launches are finished
+        (task_idx, None, None) is put into queue"""
         self._build(kwargs_for_building)
         #print('args_for_launches:', args_for_launches)
         all_tensor_aliases = self._all_tensor_aliases_from_train_method_arguments(
@@ -1414,7 +2092,8 @@ class Environment(object):
                             session_specs['log_device_placement'],
                             session_specs['gpu_memory'],
                             session_specs['allow_growth'],
-                            session_specs['visible_device_list'])
+                            session_specs['visible_device_list'],
+                            **self._threading_session_specs(session_specs))
         datasets = dict(evaluation['datasets'].items())
         if 'train' in datasets:
             del datasets['train']
@@ -1424,7 +2103,7 @@ class Environment(object):
             eval_batch_gen_class = evaluation['batch_gen_class']
 
         additional_feed_dict = self._form_validation_additional_feed_dict([], [], evaluation['additional_feed_dict'])
-        for start_specs, run_specs_set in args_for_launches:
+        for launch_idx, (start_specs, run_specs_set) in enumerate(args_for_launches):
             result = dict()
             self._train_repeatedly(start_specs, run_specs_set)
             if 'train' in evaluation['datasets']:
@@ -1451,7 +2130,158 @@ class Environment(object):
                                        print_results=False)
                 result[dataset_name] = means
             #print('result in process:', result)
-            queue.put(result)
+            queue.put((task_idx, launch_idx, result))
+        queue.put((task_idx, None, None))
+
+    def _launch_task_worker(self,
+                            queue,
+                            task_idx,
+                            cpus,
+                            kwargs_for_building,
+                            session_specs,
+                            args_for_launches,
+                            evaluation):
+        """Target of grid search worker process. Pins process to cpus and sets session thread numbers
+        (if they were not specified by user) before launching"""
+        session_specs = construct(session_specs)
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+            if session_specs['intra_op_parallelism_threads'] == 0:
+                session_specs['intra_op_parallelism_threads'] = len(cpus)
+            if session_specs['inter_op_parallelism_threads'] == 0:
+                session_specs['inter_op_parallelism_threads'] = min(2, len(cpus))
+            session_specs['use_per_session_threads'] = True
+        self._several_launches_without_rebuilding(
+            queue, kwargs_for_building, session_specs, args_for_launches, evaluation, task_idx=task_idx)
+
+    @staticmethod
+    def _split_launch_tasks(tasks, num_workers):
+        """If there are less tasks than workers launches of every task are distributed between several tasks so
+        that all workers are busy. Every task is processed in separate process with pupil rebuilding"""
+        if len(tasks) == 0 or len(tasks) >= num_workers:
+            return tasks
+        num_chunks = -(-num_workers // len(tasks))
+        split_tasks = list()
+        for task in tasks:
+            num_launches = len(task['args_for_launches'])
+            chunk_size = max(1, -(-num_launches // num_chunks))
+            for start in range(0, num_launches, chunk_size):
+                split_task = dict()
+                for key, value in task.items():
+                    if key == 'kwargs_for_building':
+                        split_task[key] = value
+                    else:
+                        split_task[key] = value[start:start + chunk_size]
+                split_tasks.append(split_task)
+        return split_tasks
+
+    @staticmethod
+    def _distribute_cpus(num_workers, cpus_per_worker):
+        """Returns list of cpu sets for workers. If num_workers is 1 and cpus_per_worker is not specified process
+        is not pinned"""
+        if num_workers == 1 and cpus_per_worker is None:
+            return [None]
+        if hasattr(os, 'sched_getaffinity'):
+            available = sorted(os.sched_getaffinity(0))
+        else:
+            return [None] * num_workers
+        if cpus_per_worker is None:
+            cpus_per_worker = max(1, len(available) // num_workers)
+        cpu_sets = list()
+        for worker_idx in range(num_workers):
+            start = worker_idx * cpus_per_worker
+            cpu_sets.append(set(available[(start + i) % len(available)] for i in range(cpus_per_worker)))
+        return cpu_sets
+
+    def _launch_hash(self, kwargs_for_building, launch_args, hp_combination, evaluation):
+        """Hash of full launch configuration. Evaluation save path is not included so that results can be reused
+        by sweeps saving results to different directories"""
+        evaluation = dict([(key, value) for key, value in evaluation.items() if key != 'save_path'])
+        return hash_nested(dict(pupil_class=self._pupil_class,
+                                kwargs_for_building=kwargs_for_building,
+                                launch_args=launch_args,
+                                hp_combination=hp_combination,
+                                evaluation=evaluation))
+
+    def _skip_cached_launches(self, tasks, evaluation, cache):
+        """Computes hashes of launches, passes cached results to self._handler and removes cached launches from
+        tasks"""
+        remaining_tasks = list()
+        for task in tasks:
+            remaining = dict(kwargs_for_building=task['kwargs_for_building'],
+                             args_for_launches=list(),
+                             hp_combinations=list(),
+                             hashes=list())
+            for launch_args, hp_combination in zip(task['args_for_launches'], task['hp_combinations']):
+                hash_value = self._launch_hash(task['kwargs_for_building'], launch_args, hp_combination, evaluation)
+                if hash_value in cache:
+                    if hp_combination is not None:
+                        self._handler.process_results(hp_combination, cache[hash_value], regime='several_launches')
+                else:
+                    remaining['args_for_launches'].append(launch_args)
+                    remaining['hp_combinations'].append(hp_combination)
+                    remaining['hashes'].append(hash_value)
+            if len(remaining['args_for_launches']) > 0:
+                remaining_tasks.append(remaining)
+        return remaining_tasks
+
+    def _run_launch_tasks(self,
+                          tasks,
+                          session_specs,
+                          evaluation,
+                          num_workers=1,
+                          cpus_per_worker=None,
+                          results_cache_path=None):
+        """Runs tasks in at most num_workers processes simultaneously. Task is a dictionary with entries
+        'kwargs_for_building', 'args_for_launches', 'hp_combinations' and 'hashes'. Launch results are passed to
+        self._handler in order of completion. Only parent process writes to Handler files. If results_cache_path is
+        provided results of launches are appended to results cache
+        Returns:
+            results: dictionary which keys are tuples (task_idx, launch_idx) and values are launch results
+            failed: list of indices of tasks which processes failed"""
+        results_queue = mp.Queue()
+        cpu_sets = self._distribute_cpus(num_workers, cpus_per_worker)
+        free_slots = list(range(num_workers))
+        pending = list(range(len(tasks)))
+        running = dict()
+        results = dict()
+        failed = list()
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(free_slots) > 0:
+                task_idx = pending.pop(0)
+                slot = free_slots.pop(0)
+                task = tasks[task_idx]
+                self.mp_debug_flag += 1
+                p = mp.Process(target=self._launch_task_worker,
+                               args=(results_queue, task_idx, cpu_sets[slot], task['kwargs_for_building'],
+                                     session_specs, task['args_for_launches'], evaluation))
+                p.start()
+                running[task_idx] = (p, slot)
+            try:
+                task_idx, launch_idx, res = results_queue.get(timeout=1.)
+            except queue.Empty:
+                for task_idx, (p, slot) in list(running.items()):
+                    if p.exitcode is not None and p.exitcode != 0:
+                        print('Warning: grid search process for task %s failed with exit code %s' %
+                              (task_idx, p.exitcode))
+                        failed.append(task_idx)
+                        del running[task_idx]
+                        free_slots.append(slot)
+                continue
+            if launch_idx is None:
+                if task_idx in running:
+                    p, slot = running.pop(task_idx)
+                    p.join()
+                    free_slots.append(slot)
+            else:
+                results[(task_idx, launch_idx)] = res
+                hp_combination = tasks[task_idx]['hp_combinations'][launch_idx]
+                if hp_combination is not None:
+                    self._handler.process_results(hp_combination, res, regime='several_launches')
+                hash_value = tasks[task_idx]['hashes'][launch_idx]
+                if results_cache_path is not None and hash_value is not None:
+                    append_to_results_cache(results_cache_path, hash_value, res)
+        return results, failed
 
     @staticmethod
     def _check_hp_in_additional_feed_dict(additions, tensor_alias):
@@ -1474,27 +2304,43 @@ class Environment(object):
                     return False
         return True
 
-    def grid_search(self,
-                    evaluation,
-                    kwargs_for_building,
-                    build_hyperparameters=None,
-                    other_hyperparameters=None,
-                    **kwargs):
-        if build_hyperparameters is None:
-            build_hyperparameters = dict()
-        if other_hyperparameters is None:
-            other_hyperparameters = dict()
-        self._store_launch_parameters(evaluation=evaluation,
-                                      kwargs_for_building=kwargs_for_building,
-                                      build_hyperparameters=build_hyperparameters,
-                                      other_hyperparameters=other_hyperparameters,
-                                      kwargs=kwargs)
-        tmp_output = parse_train_method_arguments(self,
-                                                  [],
-                                                  kwargs,
-                                                  set_passed_parameters_as_default=False)
-        session_specs = tmp_output['session_specs']
-
+    @staticmethod
+    def _register_launch_datasets(evaluation, kwargs, registry_path):
+        """Replaces dataset texts in evaluation specs and train method kwargs with DatasetHandle instances
+        referencing texts saved in registry_path"""
+        evaluation = dict(evaluation.items())
+        datasets = dict()
+        for name, dataset in evaluation['datasets'].items():
+            if dataset is not None and isinstance(dataset[0], str):
+                dataset = [register_dataset(dataset[0], registry_path), dataset[1]]
+            datasets[name] = dataset
+        evaluation['datasets'] = datasets
+        kwargs = dict(kwargs.items())
+        if 'train_dataset_text' in kwargs:
+            kwargs['train_dataset_text'] = register_dataset(kwargs['train_dataset_text'], registry_path)
+        if 'validation_dataset_texts' in kwargs:
+            kwargs['validation_dataset_texts'] = [register_dataset(text, registry_path)
+                                                  for text in kwargs['validation_dataset_texts']]
+        if 'train_dataset' in kwargs and isinstance(kwargs['train_dataset'], (list, tuple)) \
+                and isinstance(kwargs['train_dataset'][0], str):
+            kwargs['train_dataset'] = [register_dataset(kwargs['train_dataset'][0], registry_path),
+                                       kwargs['train_dataset'][1]]
+        if 'validation_datasets' in kwargs and isinstance(kwargs['validation_datasets'], list):
+            kwargs['validation_datasets'] = [
+                [register_dataset(text, registry_path), name] if isinstance(text, str) else [text, name]
+                for text, name in kwargs['validation_datasets']]
+        return evaluation, kwargs
+
+    def _create_launch_tasks(self, kwargs_for_building, build_hyperparameters, other_hyperparameters, kwargs):
+        """Creates launch tasks for all combinations of hyperparameters. Launches with same build hyperparameters
+        are gathered in one task.
+        Returns:
+            hps: list of hyperparameter names
+            tasks: list of dictionaries with entries 'kwargs_for_building', 'args_for_launches', 'hp_combinations'
+                and 'hashes'"""
+        if hasattr(self._pupil_class, 'get_feedable_hyperparameters'):
+            build_hyperparameters, other_hyperparameters = move_feedable_build_hps(
+                build_hyperparameters, other_hyperparameters, self._pupil_class.get_feedable_hyperparameters())
         build_hp_combs, build_insertions = formalize_and_create_insertions_for_build_hps(build_hyperparameters)
         other_hp_combs, other_insertions = formalize_and_create_insertions_for_other_hps(other_hyperparameters)
         # print('Environment.grid_search')
@@ -1510,16 +2356,9 @@ class Environment(object):
             hps.extend(list(build_hp_combs[0].keys()))
         if len(other_hp_combs) > 0:
             hps.extend(list(other_hp_combs[0].keys()))
-        self._handler = Handler(self,
-                                self._hooks,
-                                'several_launches',
-                                evaluation['save_path'],
-                                evaluation['result_types'],
-                                eval_dataset_names=list(evaluation['datasets'].keys()),
-                                hyperparameters=hps)
-        self._handler.log_launch()
         # print('build_insertions:', build_insertions)
         # print('build_hp_combs:', build_hp_combs)
+        tasks = list()
         if len(build_hp_combs) > 0:
             for one_set_of_insertions_and_shares, build_hp_comb in zip(build_insertions, build_hp_combs):
                 # print('one_set_of_insertions_and_shares:', one_set_of_insertions_and_shares)
@@ -1532,54 +2371,260 @@ class Environment(object):
                 build_kwargs = self._pupil_class.form_kwargs(construct(kwargs_for_building),
                                                              only_build_insertions)
                 parsed = configure_args_for_launches(self, args_for_launches, shares)
-                queue = mp.Queue()
                 # from some_useful_functions import nested2string
                 # print('build_kwargs:', nested2string(build_kwargs))
                 # print('parsed:', nested2string(parsed))
-                self.mp_debug_flag += 1
-                p = mp.Process(target=self._several_launches_without_rebuilding,
-                               args=(queue, build_kwargs, session_specs, parsed, evaluation))
-                p.start()
+                hp_combinations = list()
                 if len(other_hp_combs) > 0:
-                    for idx, other_hp_comb in enumerate(other_hp_combs):
+                    for other_hp_comb in other_hp_combs:
                         hp_combination = construct(build_hp_comb)
                         hp_combination.update(other_hp_comb)
-                        res = queue.get()
-                        # print('\nidx: %s\nres: %s' % (idx, res))
-                        # print('hp_combination:', hp_combination)
-                        # print('res:', res)
-                        self._handler.process_results(hp_combination, res, regime='several_launches')
+                        hp_combinations.append(hp_combination)
                 else:
-                    hp_combination = construct(build_hp_comb)
-                    res = queue.get()
-                    self._handler.process_results(hp_combination, res, regime='several_launches')
-                p.join()
+                    hp_combinations.append(construct(build_hp_comb))
+                tasks.append(dict(kwargs_for_building=build_kwargs,
+                                  args_for_launches=parsed,
+                                  hp_combinations=hp_combinations,
+                                  hashes=[None] * len(parsed)))
         else:
             parsed = configure_args_for_launches(self, args_for_launches, list())
-            queue = mp.Queue()
-            # from some_useful_functions import nested2string
-            # print('build_kwargs:', nested2string(build_kwargs))
-            # print('parsed:', nested2string(parsed))
-            self.mp_debug_flag += 1
-            p = mp.Process(target=self._several_launches_without_rebuilding,
-                           args=(queue, kwargs_for_building, session_specs, parsed, evaluation))
-            p.start()
+            hp_combinations = list()
             if len(other_hp_combs) > 0:
-                for idx, other_hp_comb in enumerate(other_hp_combs):
+                for other_hp_comb in other_hp_combs:
                     hp_combination = OrderedDict()
                     hp_combination.update(other_hp_comb)
-                    res = queue.get()
-                    # print('\nidx: %s\nres: %s' % (idx, res))
-                    # print('hp_combination:', hp_combination)
-                    # print('res:', res)
-                    self._handler.process_results(hp_combination, res, regime='several_launches')
+                    hp_combinations.append(hp_combination)
             else:
-                pass
-            p.join()
+                hp_combinations.append(None)
+            tasks.append(dict(kwargs_for_building=kwargs_for_building,
+                              args_for_launches=parsed,
+                              hp_combinations=hp_combinations,
+                              hashes=[None] * len(parsed)))
+        return hps, tasks
+
+    def grid_search(self,
+                    evaluation,
+                    kwargs_for_building,
+                    build_hyperparameters=None,
+                    other_hyperparameters=None,
+                    num_workers=1,
+                    cpus_per_worker=None,
+                    use_results_cache=False,
+                    results_cache_path=None,
+                    datasets_registry_path=None,
+                    **kwargs):
+        """Trains and evaluates pupil for all combinations of hyperparameters. Launches with same build
+        hyperparameters are processed in one process without rebuilding.
+        Args:
+            evaluation: dictionary specifying datasets, result types and save path of evaluation
+            kwargs_for_building: default pupil build arguments
+            build_hyperparameters: hyperparameters passed to pupil constructor. If pupil class declares some of them
+                feedable (get_feedable_hyperparameters method) they are fed to placeholders and pupil is not rebuilt
+                for every their value
+            other_hyperparameters: hyperparameters passed to train method
+            num_workers: number of launch processes run simultaneously
+            cpus_per_worker: number of cpus every worker process is pinned to. By default available cpus are
+                distributed evenly between workers if num_workers > 1. Session thread numbers not specified in
+                kwargs are set according to cpus_per_worker
+            use_results_cache: if True results of every launch are appended to results cache and launches which
+                results are already in cache are not performed. Cached results are passed to Handler as if launch
+                was performed. Launches are identified by hash of build kwargs, train method arguments (including
+                datasets), hyperparameters and evaluation specs (see useful_functions.canonical_form for supported
+                values). Lambdas, nested functions and objects which can not be pickled can not be hashed and
+                TypeError is raised if they are passed with use_results_cache=True
+            results_cache_path: path to results cache file. Default is evaluation['save_path']/results_cache.jsonl.
+                Common cache file can be used by several overlapping sweeps
+            datasets_registry_path: if provided dataset texts from evaluation and kwargs are saved to this
+                directory and launches get only references to them (DatasetHandle), so that big texts are not copied
+                and pickled for every launch
+            kwargs: train method arguments"""
+        if build_hyperparameters is None:
+            build_hyperparameters = dict()
+        if other_hyperparameters is None:
+            other_hyperparameters = dict()
+        self._store_launch_parameters(evaluation=evaluation,
+                                      kwargs_for_building=kwargs_for_building,
+                                      build_hyperparameters=build_hyperparameters,
+                                      other_hyperparameters=other_hyperparameters,
+                                      kwargs=kwargs)
+        if datasets_registry_path is not None:
+            evaluation, kwargs = self._register_launch_datasets(evaluation, kwargs, datasets_registry_path)
+        tmp_output = parse_train_method_arguments(self,
+                                                  [],
+                                                  kwargs,
+                                                  set_passed_parameters_as_default=False)
+        session_specs = tmp_output['session_specs']
+
+        hps, tasks = self._create_launch_tasks(
+            kwargs_for_building, build_hyperparameters, other_hyperparameters, kwargs)
+        self._handler = Handler(self,
+                                self._hooks,
+                                'several_launches',
+                                evaluation['save_path'],
+                                evaluation['result_types'],
+                                eval_dataset_names=list(evaluation['datasets'].keys()),
+                                hyperparameters=hps)
+        self._handler.log_launch()
+        if use_results_cache:
+            if results_cache_path is None:
+                results_cache_path = evaluation['save_path'] + '/results_cache.jsonl'
+            tasks = self._skip_cached_launches(tasks, evaluation, load_results_cache(results_cache_path))
+        else:
+            results_cache_path = None
+        tasks = self._split_launch_tasks(tasks, num_workers)
+        self._run_launch_tasks(tasks, session_specs, evaluation,
+                               num_workers=num_workers, cpus_per_worker=cpus_per_worker,
+                               results_cache_path=results_cache_path)
 
         self._handler.log_finish_time()
         self._handler.close()
 
+    def successive_halving(self,
+                           evaluation,
+                           kwargs_for_building,
+                           build_hyperparameters=None,
+                           other_hyperparameters=None,
+                           min_budget=100,
+                           eta=3,
+                           max_rounds=None,
+                           target_dataset=None,
+                           target_result_type='loss',
+                           mode='min',
+                           num_workers=1,
+                           cpus_per_worker=None,
+                           datasets_registry_path=None,
+                           **kwargs):
+        """Successive halving hyperparameter search. All combinations of hyperparameters are trained for min_budget
+        steps and evaluated with evaluation specs. Best 1/eta of candidates survive and are trained further from their
+        final checkpoints. In round r survivors are trained up to min_budget * eta**r steps in total. Search finishes
+        when 1 candidate is left or max_rounds rounds are done. Candidates with same build hyperparameters are
+        trained in one process without rebuilding. Every candidate saves its results and checkpoints to
+        evaluation['save_path']/candidates/<candidate index>. Note that learning rate and other controllers are
+        restarted every round, so launches with one set of train specs and fixed controllers are expected
+        Args:
+            evaluation, kwargs_for_building, build_hyperparameters, other_hyperparameters, num_workers,
+                cpus_per_worker, datasets_registry_path, kwargs: same as in grid_search method. 'stop' in kwargs is
+                ignored
+            min_budget: number of steps in the first round
+            eta: number of candidates is divided by eta every round and budget is multiplied by eta
+            max_rounds: maximum number of rounds. Default is unlimited
+            target_dataset: name of evaluation dataset on which candidates are compared. Default is first not
+                'train' dataset in evaluation['datasets']
+            target_result_type: result type on which candidates are compared
+            mode: 'min' if smaller target result is better, 'max' otherwise
+        Returns:
+            list of tuples (hp_combination, results, budget) for candidates left after the last round sorted from
+            the best to the worst"""
+        if build_hyperparameters is None:
+            build_hyperparameters = dict()
+        if other_hyperparameters is None:
+            other_hyperparameters = dict()
+        self._store_launch_parameters(evaluation=evaluation,
+                                      kwargs_for_building=kwargs_for_building,
+                                      build_hyperparameters=build_hyperparameters,
+                                      other_hyperparameters=other_hyperparameters,
+                                      kwargs=kwargs)
+        if datasets_registry_path is not None:
+            evaluation, kwargs = self._register_launch_datasets(evaluation, kwargs, datasets_registry_path)
+        tmp_output = parse_train_method_arguments(self,
+                                                  [],
+                                                  kwargs,
+                                                  set_passed_parameters_as_default=False)
+        session_specs = tmp_output['session_specs']
+        if target_dataset is None:
+            target_dataset = [name for name in evaluation['datasets'].keys() if name != 'train'][0]
+        if target_dataset not in evaluation['datasets']:
+            raise InvalidArgumentError(
+                'target_dataset has to be one of evaluation datasets', target_dataset, 'target_dataset',
+                str(list(evaluation['datasets'].keys())))
+        if target_result_type not in evaluation['result_types']:
+            raise InvalidArgumentError(
+                'target_result_type has to be one of evaluation result types', target_result_type,
+                'target_result_type', str(evaluation['result_types']))
+
+        hps, tasks = self._create_launch_tasks(
+            kwargs_for_building, build_hyperparameters, other_hyperparameters, kwargs)
+        budget_hp = ('search', 'budget', None, None)
+        hps.append(budget_hp)
+        self._handler = Handler(self,
+                                self._hooks,
+                                'several_launches',
+                                evaluation['save_path'],
+                                evaluation['result_types'],
+                                eval_dataset_names=list(evaluation['datasets'].keys()),
+                                hyperparameters=hps)
+        self._handler.log_launch()
+
+        candidates = list()
+        for build_idx, task in enumerate(tasks):
+            for launch_args, hp_combination in zip(task['args_for_launches'], task['hp_combinations']):
+                if hp_combination is None:
+                    hp_combination = OrderedDict()
+                candidates.append(dict(build_idx=build_idx,
+                                       launch_args=launch_args,
+                                       hp_combination=hp_combination,
+                                       save_path=evaluation['save_path'] + '/candidates/%s' % len(candidates)))
+
+        survivors = list(range(len(candidates)))
+        trained_steps = 0
+        round_idx = 0
+        ranked = list()
+        while True:
+            budget = min_budget * eta**round_idx
+            round_tasks = dict()
+            for candidate_idx in survivors:
+                candidate = candidates[candidate_idx]
+                start_specs, run_specs_set = construct(candidate['launch_args'])
+                start_specs['save_path'] = candidate['save_path']
+                if round_idx > 0:
+                    start_specs['restore_path'] = candidate['save_path'] + '/checkpoints/final'
+                for run_specs in run_specs_set:
+                    run_specs['train_specs']['stop'] = {'type': 'limit_steps',
+                                                        'limit': budget - trained_steps,
+                                                        'name': 'stop'}
+                hp_combination = construct(candidate['hp_combination'])
+                hp_combination[budget_hp] = budget
+                build_idx = candidate['build_idx']
+                if build_idx not in round_tasks:
+                    round_tasks[build_idx] = dict(kwargs_for_building=tasks[build_idx]['kwargs_for_building'],
+                                                  args_for_launches=list(),
+                                                  hp_combinations=list(),
+                                                  hashes=list(),
+                                                  candidate_indices=list())
+                round_task = round_tasks[build_idx]
+                round_task['args_for_launches'].append((start_specs, run_specs_set))
+                round_task['hp_combinations'].append(hp_combination)
+                round_task['hashes'].append(None)
+                round_task['candidate_indices'].append(candidate_idx)
+            round_tasks = self._split_launch_tasks(list(round_tasks.values()), num_workers)
+            print('\nsuccessive halving round %s: %s candidates, budget %s steps' % (round_idx, len(survivors), budget))
+            results, _ = self._run_launch_tasks(round_tasks, session_specs, evaluation,
+                                                num_workers=num_workers, cpus_per_worker=cpus_per_worker)
+            ranked = list()
+            for (task_idx, launch_idx), res in results.items():
+                candidate_idx = round_tasks[task_idx]['candidate_indices'][launch_idx]
+                ranked.append((res[target_dataset][target_result_type], candidate_idx, res))
+            finished = set([candidate_idx for _, candidate_idx, _ in ranked])
+            for candidate_idx in survivors:
+                if candidate_idx not in finished:
+                    print('successive halving round %s: candidate %s %s failed and dropped out' %
+                          (round_idx, candidate_idx, dict(candidates[candidate_idx]['hp_combination'])),
+                          file=sys.stderr)
+            ranked.sort(key=lambda item: item[0], reverse=(mode == 'max'))
+            trained_steps = budget
+            round_idx += 1
+            num_survivors = max(1, len(ranked) // eta)
+            if len(ranked) <= 1 or (max_rounds is not None and round_idx >= max_rounds):
+                break
+            survivors = [candidate_idx for _, candidate_idx, _ in ranked[:num_survivors]]
+
+        self._handler.log_finish_time()
+        self._handler.close()
+        final = list()
+        for _, candidate_idx, res in ranked:
+            final.append((candidates[candidate_idx]['hp_combination'], res, trained_steps))
+        return final
+
     @staticmethod
     def _prepare_replica(replica, batch_generator_class, bpe_codes, batch_gen_args):
         if getattr(batch_generator_class, 'make_pairs', None) is not None:
@@ -1626,7 +2671,16 @@ class Environment(object):
                   temperature=0.,
                   first_speaker='human',
                   bpe_codes=None,
-                  batch_gen_args=None):
+                  batch_gen_args=None,
+                  beam_width=1,
+                  top_k=None,
+                  top_p=None,
+                  sampling_seed=None,
+                  intra_op_parallelism_threads=0,
+                  inter_op_parallelism_threads=0,
+                  use_per_session_threads=False):
+        if sampling_seed is not None:
+            self.set_sampling_seed(sampling_seed)
         if additions_to_feed_dict is None:
             feed_dict_base = dict()
         else:
@@ -1641,8 +2695,11 @@ class Environment(object):
                             log_device_placement,
                             gpu_memory,
                             allow_growth,
-                            visible_device_list)
-        if restore_path is None:
+                            visible_device_list,
+                            intra_op_parallelism_threads=intra_op_parallelism_threads,
+                            inter_op_parallelism_threads=inter_op_parallelism_threads,
+                            use_per_session_threads=use_per_session_threads)
+        if restore_path is None and self._frozen_initializers is None:
             print_and_log('Skipping variables restoring. Continuing on current variables values', fn=log_path)
         else:
             self._initialize_pupil(restore_path)
@@ -1656,57 +2713,83 @@ class Environment(object):
 
         sample_prediction = self._hooks['validation_predictions']
         sample_input = self._hooks['validation_inputs']
+        stats = Stats()
+        stats_path = os.path.splitext(log_path)[0] + '_stats.json'
         while not self._build_replica(human_replica) == 'FINISH':
+            ingest_start = time.time()
             # print('(Environment.inference)human_replica:', human_replica)
             # print('(Environment.inference)self._build_replica(human_replica):', self._build_replica(human_replica))
             if len(human_replica) > 0:
                 # print('(Environment.inference)human_replica:', human_replica)
                 print_and_log('Human: ' + self._build_replica(human_replica), _print=False, fn=log_path)
+            if self._prefill_is_available():
+                feeds = [batch_generator_class.char2vec(char, character_positions_in_vocabulary, 0, 2)
+                         for char in human_replica + '\n']
+                prediction = self._prefill(feeds, feed_dict_base)
+            else:
                 for char in human_replica:
                     feed = batch_generator_class.char2vec(char, character_positions_in_vocabulary, 0, 2)
-                    feed_char = batch_generator_class.vec2char_fast(np.reshape(feed, (1, -1)), vocabulary)[0]
-                    print('feed.shape:', feed.shape)
                     feed_dict = dict(feed_dict_base.items())
                     feed_dict[sample_input] = feed
-                    excess_pred = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
-                    excess_char = batch_generator_class.vec2char(np.reshape(excess_pred, (1, -1)), vocabulary)[0]
-                    print('char:%s|||feed_char:%s|||excess_char:%s|||' % (char, feed_char, excess_char))
-            feed = batch_generator_class.char2vec('\n', character_positions_in_vocabulary, 0, 2)
-            feed_dict = dict(feed_dict_base.items())
-            feed_dict[sample_input] = feed
-            prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
-            if temperature != 0.:
-                prediction = apply_temperature(prediction, -1, temperature)
-                prediction = sample(prediction, -1)
-            counter = 0
-            char = batch_generator_class.vec2char(np.reshape(prediction, (1, -1)), vocabulary)[0]
-            # print('char:', char)
-            bot_replica = ''
-            if char != '\n':
-                bot_replica += char
-            # print('ord(\'\\n\'):', ord('\n'))
-            while char != '\n' and counter < 500:
-                # print('char:', repr(char))
-                # print('prediction:\n', prediction)
-                feed = batch_generator_class.pred2vec(prediction, 1, 2, batch_gen_args)
-                # print('feed:\n', feed)
-                # print('prediction after sampling:', prediction)
-                # print('feed:', feed)
+                    _ = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
+                feed = batch_generator_class.char2vec('\n', character_positions_in_vocabulary, 0, 2)
                 feed_dict = dict(feed_dict_base.items())
                 feed_dict[sample_input] = feed
                 prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
-                # print('prediction before sampling:', prediction)
-                if temperature != 0.:
-                    prediction = apply_temperature(prediction, -1, temperature)
-                    # print('prediction after temperature:', prediction)
-                    prediction = sample(prediction, -1)
+            generation_start = time.time()
+            # beam search starts from not sampled prediction
+            if beam_width == 1:
+                prediction = self._sample(prediction, temperature, top_k=top_k, top_p=top_p)
+            if beam_width > 1:
+                ids, _ = self._beam_search_from_variables(
+                    prediction, feed_dict_base, beam_width, max_length=501,
+                    stop_id=character_positions_in_vocabulary.get('\n', -1))
+                bot_replica = ''
+                for id_ in ids:
+                    char = id2char(id_, vocabulary)
+                    if char != '\n':
+                        bot_replica += char
+            elif self._generation_is_available() and top_k is None and top_p is None:
+                ids, _ = self._generate_in_graph(
+                    prediction, feed_dict_base, temperature=temperature, max_length=501,
+                    stop_id=character_positions_in_vocabulary.get('\n', -1))
+                bot_replica = ''
+                for id_ in ids:
+                    char = id2char(id_, vocabulary)
+                    if char != '\n':
+                        bot_replica += char
+            else:
+                counter = 0
                 char = batch_generator_class.vec2char(np.reshape(prediction, (1, -1)), vocabulary)[0]
+                # print('char:', char)
+                bot_replica = ''
                 if char != '\n':
-                    # print('char != \'\\n\', counter = %s' % counter)
-                    # print('ord(char):', ord(char))
                     bot_replica += char
-                counter += 1
+                # print('ord(\'\\n\'):', ord('\n'))
+                while char != '\n' and counter < 500:
+                    # print('char:', repr(char))
+                    # print('prediction:\n', prediction)
+                    feed = batch_generator_class.pred2vec(prediction, 1, 2, batch_gen_args)
+                    # print('feed:\n', feed)
+                    # print('prediction after sampling:', prediction)
+                    # print('feed:', feed)
+                    feed_dict = dict(feed_dict_base.items())
+                    feed_dict[sample_input] = feed
+                    prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
+                    # print('prediction before sampling:', prediction)
+                    prediction = self._sample(prediction, temperature, top_k=top_k, top_p=top_p)
+                    char = batch_generator_class.vec2char(np.reshape(prediction, (1, -1)), vocabulary)[0]
+                    if char != '\n':
+                        # print('char != \'\\n\', counter = %s' % counter)
+                        # print('ord(char):', ord(char))
+                        bot_replica += char
+                    counter += 1
+            generation_end = time.time()
             print_and_log('Bot: ' + self._build_replica(bot_replica), fn=log_path)
+            stats.add('latency', generation_end - ingest_start)
+            self._add_generation_stats(stats, ingest_time=generation_start - ingest_start,
+                                       generation_time=generation_end - generation_start, tokens=len(bot_replica))
+            stats.save(stats_path)
             feed = batch_generator_class.char2vec('\n', character_positions_in_vocabulary, 1, 2)
             feed_dict = dict(feed_dict_base.items())
             feed_dict[sample_input] = feed
@@ -1716,63 +2799,211 @@ class Environment(object):
             human_replica = self._prepare_replica(human_replica, batch_generator_class, bpe_codes, batch_gen_args)
         with open(log_path, 'a') as fd:
             fd.write('\n*********************')
+        print(stats.format_summary())
         self._close_session()
 
+    def _sample(self, prediction, temperature, top_k=None, top_p=None):
+        """Samples one hot vectors from prediction with temperature, top-k and nucleus (top-p) filtering. If
+        temperature is 0 prediction is returned unchanged (greedy decoding)"""
+        if temperature == 0.:
+            return prediction
+        return sample_one_hot(
+            prediction, temperature=temperature, top_k=top_k, top_p=top_p, rng=self._sampling_rng)
+
+    def set_sampling_seed(self, seed):
+        """Sets seed of generator used for sampling in inference, chats and fuses"""
+        self._sampling_rng = get_rng(seed)
+
+    def _prefill_is_available(self):
+        return self._hooks.get('prefill_predictions') is not None
+
+    def _prefill(self, feeds, feed_dict_base):
+        """Passes sequence of validation inputs through pupil in one session call. Pupil state is updated
+        as if inputs were fed one by one.
+        Args:
+            feeds: list of validation inputs (numpy arrays of shape [1, 1, ...])
+            feed_dict_base: dictionary with additional placeholders values
+        Returns:
+            prediction made after the last input"""
+        feed_dict = dict(feed_dict_base.items())
+        feed_dict[self._hooks['prefill_inputs']] = np.concatenate(feeds, axis=0)
+        return self._session.run(self._hooks['prefill_predictions'], feed_dict=feed_dict)
+
+    def _generation_is_available(self):
+        return self._hooks.get('generated_ids') is not None
+
+    def _generate_in_graph(self, prediction, feed_dict_base, temperature=0., max_length=250, stop_id=-1):
+        """Generates sequence in one session call. First token is sampled from prediction, each next token is
+        sampled from pupil prediction after feeding previous one.
+        Args:
+            prediction: numpy array of shape [1, vocabulary_size]
+            feed_dict_base: dictionary with additional placeholders values
+            temperature: sampling temperature. If 0 argmax is used
+            max_length: maximum number of fed tokens
+            stop_id: generation stops after token with this id is fed
+        Returns:
+            list of fed token ids and prediction made after the last of them"""
+        feed_dict = dict(feed_dict_base.items())
+        feed_dict[self._hooks['generation_start_predictions']] = np.reshape(prediction, (1, -1))
+        feed_dict[self._hooks['generation_temperature']] = temperature
+        feed_dict[self._hooks['generation_max_length']] = max_length
+        feed_dict[self._hooks['generation_stop_id']] = stop_id
+        ids, last_prediction = self._session.run(
+            [self._hooks['generated_ids'], self._hooks['generation_predictions']], feed_dict=feed_dict)
+        return list(ids), last_prediction
+
+    def _beam_search(self, states, prediction, feed_dict_base, beam_width, max_length=250, stop_id=-1):
+        """Beam search decoding. Beams are batch rows of serving graph (see _BeamSearch). After every step states of
+        beams which are kept are gathered from states of all beams.
+        Args:
+            states: list of numpy arrays of shape [1, num_nodes]. Pupil state after prompt
+            prediction: prediction made after prompt. Numpy array of shape [1, vocabulary_size]
+            feed_dict_base: dictionary with additional placeholders values
+            beam_width: number of kept beams
+            max_length: maximum number of tokens in beam
+            stop_id: beam is finished after token with this id
+        Returns:
+            ids of tokens of the best beam (scores are normalized by beam length), pupil state after feeding all
+            these tokens and prediction made after the last of them"""
+        if self._hooks.get('serving_inputs') is None:
+            raise InvalidArgumentError(
+                'Beam search requires pupil with serving graph', beam_width, 'beam_width', '1')
+        search = _BeamSearch(states, prediction, beam_width, max_length=max_length, stop_id=stop_id)
+        while not search.done:
+            feed_dict = dict(feed_dict_base.items())
+            feed_dict[self._hooks['serving_inputs']] = search.inputs()
+            for placeholder, state in zip(self._hooks['serving_states'], search.states):
+                feed_dict[placeholder] = state
+            res = self._session.run(
+                [self._hooks['serving_predictions']] + self._hooks['serving_new_states'], feed_dict=feed_dict)
+            search.update(res[0], res[1:])
+        return search.result()
+
+    def _beam_search_from_variables(self, prediction, feed_dict_base, beam_width, max_length=250, stop_id=-1):
+        """Beam search starting from pupil validation state. Validation state is set to state of the best beam"""
+        state_variables = self._hooks['validation_state_variables']
+        states = self._session.run(state_variables)
+        ids, states, prediction = self._beam_search(
+            states, prediction, feed_dict_base, beam_width, max_length=max_length, stop_id=stop_id)
+        for variable, value in zip(state_variables, states):
+            variable.load(value, session=self._session)
+        return ids, prediction
+
     def _feed_replica(self, replica, batch_generator_class,
-                      character_positions_in_vocabulary, temperature,
+                      character_positions_in_vocabulary,
                       feed_dict_base, speaker, bpe_codes, batch_gen_args):
+        """Feeds replica and new line to pupil. Returns prediction made after new line. Prediction is not sampled,
+        so it can be used both for sampling and for beam search"""
         replica = self._prepare_replica(replica, batch_generator_class, bpe_codes, batch_gen_args)
         if speaker == 'bot':
             flag = 1
         else:
             flag = 0
-        sample_input = self._hooks['validation_inputs']
-        sample_prediction = self._hooks['validation_predictions']
-        for char in replica:
-            feed = batch_generator_class.char2vec(char, character_positions_in_vocabulary, flag, 2)
-            # print('feed.shape:', feed.shape)
+        if self._prefill_is_available():
+            feeds = [batch_generator_class.char2vec(char, character_positions_in_vocabulary, flag, 2)
+                     for char in replica + '\n']
+            prediction = self._prefill(feeds, feed_dict_base)
+        else:
+            sample_input = self._hooks['validation_inputs']
+            sample_prediction = self._hooks['validation_predictions']
+            for char in replica:
+                feed = batch_generator_class.char2vec(char, character_positions_in_vocabulary, flag, 2)
+                # print('feed.shape:', feed.shape)
+                feed_dict = dict(feed_dict_base.items())
+                feed_dict[sample_input] = feed
+                _ = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
+            feed = batch_generator_class.char2vec('\n', character_positions_in_vocabulary, flag, 2)
             feed_dict = dict(feed_dict_base.items())
             feed_dict[sample_input] = feed
-            _ = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
-        feed = batch_generator_class.char2vec('\n', character_positions_in_vocabulary, flag, 2)
-        feed_dict = dict(feed_dict_base.items())
-        feed_dict[sample_input] = feed
-        prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
-        if temperature != 0.:
-            prediction = apply_temperature(prediction, -1, temperature)
-            prediction = sample(prediction, -1)
+            prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
         return prediction
 
+    def _feed_cached_replica(self, replica, batch_generator_class, character_positions_in_vocabulary,
+                             feed_dict_base, speaker, bpe_codes, batch_gen_args, key):
+        """Feeds replica to pupil which state was reset. If state obtained after feeding replica is in prefix cache
+        it is loaded instead of feeding. key is a prefix cache key which has to define replica, pupil weights and
+        feed_dict_base"""
+        state_variables = self._hooks.get('validation_state_variables')
+        if state_variables is None:
+            _ = self._feed_replica(
+                replica, batch_generator_class,
+                character_positions_in_vocabulary, feed_dict_base, speaker, bpe_codes, batch_gen_args)
+            return None
+        states = self._prefix_cache.get(key)
+        if states is None:
+            _ = self._feed_replica(
+                replica, batch_generator_class,
+                character_positions_in_vocabulary, feed_dict_base, speaker, bpe_codes, batch_gen_args)
+            self._prefix_cache.put(key, self._session.run(state_variables))
+        else:
+            for variable, value in zip(state_variables, states):
+                variable.load(value, session=self._session)
+        return None
+
+    @staticmethod
+    def _prefix_key_base(restore_path, frozen_graph_path, additions_to_feed_dict):
+        """Beginning of keys of prefix states cache. Prefix states depend on pupil weights and additional feed dict.
+        Weights are identified by path and fingerprint of files they are loaded from"""
+        model_path = restore_path if frozen_graph_path is None else frozen_graph_path
+        fingerprint = None if model_path is None else model_fingerprint(model_path)
+        return 'replica', model_path, fingerprint, additions_to_feed_dict
+
     def _generate_replica(self, prediction, batch_generator_class, vocabulary,
-                          character_positions_in_vocabulary, temperature, feed_dict_base, speaker, batch_gen_args):
+                          character_positions_in_vocabulary, temperature, feed_dict_base, speaker, batch_gen_args,
+                          beam_width=1, top_k=None, top_p=None, partial_replies=None, on_partial=None):
+        """Generates replica from not sampled prediction. If on_partial is provided it is called with beginning of
+        replica every partial_replies tokens (or after every word if partial_replies is 'word'). Beam search replicas
+        are not streamed"""
         if speaker == 'bot':
             flag = 1
         else:
             flag = 0
         counter = 0
+        last_partial = 0
         char = None
         bot_replica = ""
         sample_input = self._hooks['validation_inputs']
         sample_prediction = self._hooks['validation_predictions']
-        # print('ord(\'\\n\'):', ord('\n'))
-        while char != '\n' and counter < 250:
-            feed = batch_generator_class.pred2vec(prediction, flag, 2, batch_gen_args)
-            # print('prediction after sampling:', prediction)
-            # print('feed:', feed)
-            feed_dict = dict(feed_dict_base.items())
-            feed_dict[sample_input] = feed
-            prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
-            # print('prediction before sampling:', prediction)
-            if temperature != 0.:
-                prediction = apply_temperature(prediction, -1, temperature)
-                # print('prediction after temperature:', prediction)
-                prediction = sample(prediction, -1)
-            char = batch_generator_class.vec2char(np.reshape(feed, (1, -1)), vocabulary)[0]
-            if char != '\n':
-                # print('char != \'\\n\', counter = %s' % counter)
-                # print('ord(char):', ord(char))
-                bot_replica += char
-            counter += 1
+        if beam_width == 1:
+            prediction = self._sample(prediction, temperature, top_k=top_k, top_p=top_p)
+        if beam_width > 1:
+            ids, prediction = self._beam_search_from_variables(
+                prediction, feed_dict_base, beam_width, max_length=250,
+                stop_id=character_positions_in_vocabulary.get('\n', -1))
+            for id_ in ids:
+                char = id2char(id_, vocabulary)
+                if char != '\n':
+                    bot_replica += char
+        elif self._generation_is_available() and top_k is None and top_p is None and on_partial is None:
+            ids, prediction = self._generate_in_graph(
+                prediction, feed_dict_base, temperature=temperature, max_length=250,
+                stop_id=character_positions_in_vocabulary.get('\n', -1))
+            for id_ in ids:
+                char = id2char(id_, vocabulary)
+                if char != '\n':
+                    bot_replica += char
+            prediction = self._sample(prediction, temperature, top_k=top_k, top_p=top_p)
+        else:
+            # print('ord(\'\\n\'):', ord('\n'))
+            while char != '\n' and counter < 250:
+                feed = batch_generator_class.pred2vec(prediction, flag, 2, batch_gen_args)
+                # print('prediction after sampling:', prediction)
+                # print('feed:', feed)
+                feed_dict = dict(feed_dict_base.items())
+                feed_dict[sample_input] = feed
+                prediction = sample_prediction.eval(feed_dict=feed_dict, session=self._session)
+                # print('prediction before sampling:', prediction)
+                prediction = self._sample(prediction, temperature, top_k=top_k, top_p=top_p)
+                char = batch_generator_class.vec2char(np.reshape(feed, (1, -1)), vocabulary)[0]
+                if char != '\n':
+                    # print('char != \'\\n\', counter = %s' % counter)
+                    # print('ord(char):', ord(char))
+                    bot_replica += char
+                counter += 1
+                if on_partial is not None and char != '\n' and \
+                        self._partial_reply_is_due(char, counter - last_partial, partial_replies):
+                    on_partial(bot_replica)
+                    last_partial = counter
         feed = batch_generator_class.char2vec('\n', character_positions_in_vocabulary, flag, 2)
         feed_dict = dict(feed_dict_base.items())
         feed_dict[sample_input] = feed
@@ -1794,9 +3025,20 @@ class Environment(object):
             bpe_codes,
             batch_gen_args,
             inq,
-            outq):
+            outq,
+            chat_id=None,
+            chat_states_path=None,
+            prefix_states_path=None,
+            beam_width=1,
+            top_k=None,
+            top_p=None,
+            frozen_graph_path=None,
+            partial_replies=None,
+            session_threads=None):
         # print('entered _one_chat')
-        self._build(kwargs_for_building)
+        # sampling generator state is copied from parent process, so it has to be reseeded
+        self.set_sampling_seed(None)
+        self._build_or_load_frozen(kwargs_for_building, frozen_graph_path)
         if additions_to_feed_dict is None:
             feed_dict_base = dict()
         else:
@@ -1807,41 +3049,65 @@ class Environment(object):
                             False,
                             gpu_memory,
                             allow_growth,
-                            '')
+                            '',
+                            **({} if session_threads is None else session_threads))
         self._initialize_pupil(restore_path)
         self._hooks['reset_validation_state'].run(session=self._session)
-        greeting = 'Здравствуйте, я бот.'
-        # print_and_log('Bot: ' + greeting, _print=False, fn=log_path)
-        print('(Environment.one_chat)inq:', inq)
-        _ = inq.get()
-        # _ = inq.get(block=False)
-        outq.put(greeting)
-        # print('greeting is put in queue')
-        _ = self._feed_replica(
-            greeting, batch_generator_class,
-            character_positions_in_vocabulary, temperature, feed_dict_base, 'bot', bpe_codes, batch_gen_args)
-        timeshot = time.time()
-        try:
-            human_replica = inq.get(timeout=300)
-        except queue.Empty:
-            human_replica = ''
-            pass
+        # in separate process states are not kept in memory
+        if chat_states_path is not None and self._hooks.get('validation_state_variables') is not None:
+            state_store = ChatStateStore(capacity=0, path=chat_states_path)
+            stored_states = state_store.pop(chat_id)
+        else:
+            state_store = None
+            stored_states = None
+        if stored_states is not None:
+            for variable, value in zip(self._hooks['validation_state_variables'], stored_states):
+                variable.load(value, session=self._session)
+            human_replica = inq.get()
+            timeshot = time.time()
+        else:
+            greeting = 'Здравствуйте, я бот.'
+            # print_and_log('Bot: ' + greeting, _print=False, fn=log_path)
+            print('(Environment.one_chat)inq:', inq)
+            _ = inq.get()
+            # _ = inq.get(block=False)
+            outq.put(('greeting', greeting))
+            # print('greeting is put in queue')
+            if prefix_states_path is not None:
+                self._prefix_cache = PrefixStateCache(prefix_states_path)
+            self._feed_cached_replica(
+                greeting, batch_generator_class, character_positions_in_vocabulary, feed_dict_base, 'bot',
+                bpe_codes, batch_gen_args,
+                self._prefix_key_base(restore_path, frozen_graph_path, additions_to_feed_dict) + ('bot', greeting))
+            timeshot = time.time()
+            try:
+                human_replica = inq.get(timeout=300)
+            except queue.Empty:
+                human_replica = ''
+                pass
 
         while not human_replica == '/end' and time.time() - timeshot < 290:
             # print('(start while)time.time() - timeshot =', time.time() - timeshot)
             # print('(start while)time.time() =', time.time())
             # print('(start while)timeshot =', timeshot)
-            if human_replica != '':
+            # '/start' is answered only with greeting, so it is dropped when conversation is continued
+            if human_replica != '' and human_replica != '/start':
                 # print_and_log('Human: ' + human_replica, _print=False, fn=log_path)
+                received = time.time()
                 prediction = self._feed_replica(
                     human_replica, batch_generator_class,
-                    character_positions_in_vocabulary, temperature,
+                    character_positions_in_vocabulary,
                     feed_dict_base, 'human', bpe_codes, batch_gen_args
                 )
+                ingest_end = time.time()
                 bot_replica, prediction = self._generate_replica(
                     prediction, batch_generator_class, vocabulary,
-                    character_positions_in_vocabulary, temperature, feed_dict_base, 'bot', batch_gen_args)
+                    character_positions_in_vocabulary, temperature, feed_dict_base, 'bot', batch_gen_args,
+                    beam_width=beam_width, top_k=top_k, top_p=top_p, partial_replies=partial_replies,
+                    on_partial=None if partial_replies is None else lambda text: outq.put(('partial', text)))
                 # print_and_log('Bot: ' + bot_replica, _print=False, fn=log_path)
+                outq.put(('stats', dict(received=received, ingest_time=ingest_end - received,
+                                        generation_time=time.time() - ingest_end, tokens=len(bot_replica))))
                 outq.put(bot_replica)
                 timeshot = time.time()
             try:
@@ -1851,9 +3117,384 @@ class Environment(object):
             # print('(end while)time.time() - timeshot =', time.time() - timeshot)
             # print('(end while)time.time() =', time.time())
             # print('(end while)timeshot =', timeshot)
+        if state_store is not None:
+            if human_replica == '/end':
+                state_store.remove(chat_id)
+            else:
+                state_store.put(chat_id, self._session.run(self._hooks['validation_state_variables']))
         # print('reached -1')
         outq.put(-1)
 
+    def start_serving_session(self, restore_path, gpu_memory=None, allow_growth=False,
+                              intra_op_parallelism_threads=0, inter_op_parallelism_threads=0,
+                              use_per_session_threads=False):
+        """Starts session and restores pupil variables. Session is kept open until close_serving_session is called,
+        so predict_strings can be called many times without restoring model"""
+        self._start_session(False,
+                            False,
+                            gpu_memory,
+                            allow_growth,
+                            '',
+                            intra_op_parallelism_threads=intra_op_parallelism_threads,
+                            inter_op_parallelism_threads=inter_op_parallelism_threads,
+                            use_per_session_threads=use_per_session_threads)
+        self._initialize_pupil(restore_path)
+
+    def close_serving_session(self):
+        self._close_session()
+
+    def predict_strings(self, strings, character_positions_in_vocabulary, additions_to_feed_dict=None, prefix='\n'):
+        """Feeds several strings to pupil in one batch of serving graph. Every string is fed from zero state after
+        prefix. Strings of different lengths are processed together: rows which strings are over are removed from
+        batch.
+        Args:
+            strings: list of strings
+            character_positions_in_vocabulary: dictionary mapping characters to their ids
+            additions_to_feed_dict: list of dictionaries with 'placeholder' and 'value' items
+            prefix: string fed before every string
+        Returns:
+            list of numpy arrays of shape [len(string), vocabulary_size]. Predictions made after every character"""
+        if self._hooks.get('serving_inputs') is None:
+            raise InvalidArgumentError(
+                'predict_strings requires pupil with serving graph', None, 'pupil', 'pupil with serving graph')
+        feed_dict_base = dict()
+        if additions_to_feed_dict is not None:
+            for addition in additions_to_feed_dict:
+                feed_dict_base[self._hooks[addition['placeholder']]] = addition['value']
+        sequences = [[char2id(char, character_positions_in_vocabulary) for char in prefix + string]
+                     for string in strings]
+        states = [np.zeros([len(sequences)] + state.get_shape().as_list()[1:])
+                  for state in self._hooks['serving_states']]
+        predictions = [list() for _ in sequences]
+        step = 0
+        active = [row_idx for row_idx, sequence in enumerate(sequences) if len(sequence) > 0]
+        while len(active) > 0:
+            feed_dict = dict(feed_dict_base.items())
+            feed_dict[self._hooks['serving_inputs']] = np.array([sequences[row_idx][step] for row_idx in active])
+            for placeholder, state in zip(self._hooks['serving_states'], states):
+                feed_dict[placeholder] = state[active]
+            res = self._session.run(
+                [self._hooks['serving_predictions']] + self._hooks['serving_new_states'], feed_dict=feed_dict)
+            for state, new_state in zip(states, res[1:]):
+                state[active] = new_state
+            if step >= len(prefix):
+                for row_idx, prediction in zip(active, res[0]):
+                    predictions[row_idx].append(prediction)
+            step += 1
+            active = [row_idx for row_idx in active if len(sequences[row_idx]) > step]
+        return [np.array(row_predictions) for row_predictions in predictions]
+
+    def _new_chat(self, chat_id, log_path):
+        if len(log_path) > 4 and log_path[-4:] == '.txt':
+            file_name = add_index_to_filename_if_needed(log_path, index=0)
+        else:
+            file_name = add_index_to_filename_if_needed(log_path + '/chat.txt', index=0)
+        states = [np.zeros([1] + state.get_shape().as_list()[1:], dtype=np.float32)
+                  for state in self._hooks['serving_states']]
+        return dict(
+            chat_id=chat_id,
+            file_name=file_name,
+            states=states,
+            inbox=list(),
+            # times when inbox messages were read from stdin
+            inbox_times=list(),
+            # ids of tokens which have to be fed before chat can do anything else
+            pending=list(),
+            reply_after_feeding=False,
+            generating=False,
+            next_id=None,
+            # _BeamSearch instance if reply is generated with beam search
+            beam_search=None,
+            # prefix cache key of pending tokens. State is cached when all pending tokens are fed
+            prefix_key=None,
+            bot_replica='',
+            counter=0,
+            # value of counter when the last partial reply was sent
+            partial_counter=0,
+            # times of reading replied message, start of its feeding and start of generation. Used for statistics
+            message_time=None,
+            ingest_start=None,
+            generation_start=None,
+            timeshot=time.time())
+
+    def _serving_step(self, chats, feed_dict_base):
+        """Makes one step for a batch of chats. States of chats are gathered into a batch and fed to the
+        serving graph. New states are scattered back to chats. Chat which generates reply with beam search occupies
+        one row for every alive beam, its beam search is updated with predictions and new states of these rows.
+        Args:
+            chats: list of chats (dictionaries created by _new_chat method) with 'input_id' item (not required
+                for chats with beam search)
+            feed_dict_base: dictionary with additional placeholders values
+        Returns:
+            list of predictions for chats. Numpy arrays of shape [number of chat rows, vocabulary_size]"""
+        inputs = list()
+        states = list()
+        for chat in chats:
+            if chat['beam_search'] is None:
+                inputs.append([chat['input_id']])
+                states.append(chat['states'])
+            else:
+                inputs.append(chat['beam_search'].inputs())
+                states.append(chat['beam_search'].states)
+        feed_dict = dict(feed_dict_base.items())
+        feed_dict[self._hooks['serving_inputs']] = np.concatenate(inputs, axis=0)
+        for state_idx, state in enumerate(self._hooks['serving_states']):
+            feed_dict[state] = np.concatenate([chat_states[state_idx] for chat_states in states], axis=0)
+        res = self._session.run(
+            [self._hooks['serving_predictions']] + self._hooks['serving_new_states'], feed_dict=feed_dict)
+        predictions, new_states = res[0], res[1:]
+        chat_predictions = list()
+        start = 0
+        for chat, chat_inputs in zip(chats, inputs):
+            stop = start + len(chat_inputs)
+            chat_new_states = [new_state[start:stop] for new_state in new_states]
+            if chat['beam_search'] is None:
+                chat['states'] = chat_new_states
+            else:
+                chat['beam_search'].update(predictions[start:stop], chat_new_states)
+            chat_predictions.append(predictions[start:stop])
+            start = stop
+        return chat_predictions
+
+    def _sample_id(self, prediction, temperature, top_k=None, top_p=None):
+        return int(sample_ids(np.reshape(prediction, [-1]), temperature=temperature, top_k=top_k, top_p=top_p,
+                              rng=self._sampling_rng))
+
+    def _serve_chats(self,
+                     log_path,
+                     vocabulary,
+                     character_positions_in_vocabulary,
+                     batch_generator_class,
+                     feed_dict_base,
+                     temperature,
+                     bpe_codes,
+                     batch_gen_args,
+                     state_store,
+                     chats,
+                     prefix_key_base,
+                     beam_width=1,
+                     top_k=None,
+                     top_p=None,
+                     max_replica_length=250,
+                     chat_timeout=290,
+                     partial_replies=None,
+                     stats=None,
+                     stats_interval=60):
+        """Serves all chats with one pupil. Chats are read from stdin and answers are written to stdout in CSV
+        format (the same as in per chat processes regime). On every step all chats which have pending tokens or
+        generate replicas are stepped together with one session call. States of idle chats are moved to
+        state_store and restored when chat receives a message. If beam_width is greater than 1 reply is generated
+        with beam search. Beams are stepped together with other chats, one step per session call. If
+        partial_replies is provided beginnings of replies are written every partial_replies tokens or after every
+        word (partial_replies='word'). Statistics of answers are collected in stats and saved next to chat logs every
+        stats_interval seconds."""
+
+        new_line_id = char2id('\n', character_positions_in_vocabulary)
+        greeting = 'Здравствуйте, я бот.'
+        greeting_key = prefix_key_base + ('bot', greeting)
+        writer = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
+        if stats is None:
+            stats = Stats()
+        stats_saved = time.time()
+        read_list = [sys.stdin]
+        # after end of stdin chats are served until answers to received messages are written
+        while read_list or any([len(chat['inbox']) > 0 or len(chat['pending']) > 0 or chat['generating']
+                                for chat in chats.values()]):
+            if time.time() - stats_saved > stats_interval:
+                self._save_stats(stats, chats, log_path)
+                stats_saved = time.time()
+            active = [chat for chat in chats.values() if len(chat['pending']) > 0 or chat['generating']]
+            if len(active) > 0:
+                timeout = 0
+            else:
+                timeout = .05
+            ready = select.select(read_list, [], [], timeout)[0] if read_list else []
+            if ready:
+                text = ready[0].readline()
+                if text == '':
+                    read_list.remove(ready[0])
+                    continue
+                row = csv.reader([text]).__next__()
+                if len(row) >= 2 and is_int(row[0]):
+                    chat_id, question = int(row[0]), row[1]
+                    stored_states = None
+                    if chat_id not in chats:
+                        stored_states = state_store.pop(chat_id)
+                    if stored_states is not None:
+                        # conversation is continued from stored state. '/start' and empty messages are dropped
+                        # from inbox without answer
+                        chat = self._new_chat(chat_id, log_path)
+                        chat['states'] = stored_states
+                        chat['inbox'].append(question)
+                        chat['inbox_times'].append(time.time())
+                        chats[chat_id] = chat
+                    elif chat_id not in chats:
+                        # the first message is answered with greeting the same way as in _one_chat method
+                        chat = self._new_chat(chat_id, log_path)
+                        chats[chat_id] = chat
+                        print_and_log('Bot: ' + greeting, _print=False, fn=chat['file_name'])
+                        self._write_answer(writer, chat_id, greeting, partial_replies is not None)
+                        greeting_states = self._prefix_cache.get(greeting_key)
+                        if greeting_states is None:
+                            chat['pending'] = [char2id(char, character_positions_in_vocabulary) for char in
+                                               self._prepare_replica(greeting, batch_generator_class,
+                                                                     bpe_codes, batch_gen_args) + ['\n']]
+                            chat['prefix_key'] = greeting_key
+                        else:
+                            chat['states'] = greeting_states
+                    else:
+                        chats[chat_id]['inbox'].append(question)
+                        chats[chat_id]['inbox_times'].append(time.time())
+                    stats.increment('messages')
+                    if question != '/start' and question != '/end':
+                        print_and_log('Human: ' + question, _print=False, fn=chats[chat_id]['file_name'])
+
+            for chat_id in list(chats.keys()):
+                chat = chats[chat_id]
+                if len(chat['pending']) == 0 and not chat['generating']:
+                    if len(chat['inbox']) > 0:
+                        human_replica = chat['inbox'].pop(0)
+                        message_time = chat['inbox_times'].pop(0)
+                        if human_replica == '/end':
+                            state_store.remove(chat_id)
+                            del chats[chat_id]
+                        elif human_replica != '' and human_replica != '/start':
+                            chat['pending'] = [
+                                char2id(char, character_positions_in_vocabulary) for char in
+                                self._prepare_replica(human_replica, batch_generator_class,
+                                                      bpe_codes, batch_gen_args) + ['\n']]
+                            chat['reply_after_feeding'] = True
+                            chat['message_time'] = message_time
+                            chat['ingest_start'] = time.time()
+                            stats.add('queue_delay', chat['ingest_start'] - message_time)
+                    elif time.time() - chat['timeshot'] > chat_timeout:
+                        state_store.put(chat_id, chat['states'])
+                        del chats[chat_id]
+
+            active = [chat for chat in chats.values() if len(chat['pending']) > 0 or chat['generating']]
+            if len(active) == 0:
+                continue
+            for chat in active:
+                if len(chat['pending']) > 0:
+                    chat['input_id'] = chat['pending'].pop(0)
+                elif chat['beam_search'] is None:
+                    chat['input_id'] = chat['next_id']
+            predictions = self._serving_step(active, feed_dict_base)
+            for chat, prediction in zip(active, predictions):
+                if chat['beam_search'] is not None:
+                    if chat['beam_search'].done:
+                        ids, chat['states'], _ = chat['beam_search'].result()
+                        chat['beam_search'] = None
+                        chat['generating'] = False
+                        bot_replica = ''.join([id2char(id_, vocabulary) for id_ in ids if id_ != new_line_id])
+                        print_and_log('Bot: ' + bot_replica, _print=False, fn=chat['file_name'])
+                        self._write_answer(writer, chat['chat_id'], bot_replica, partial_replies is not None)
+                        chat['timeshot'] = time.time()
+                        self._add_chat_answer_stats(stats, chat, len(ids))
+                        chat['pending'] = [new_line_id]
+                elif chat['generating']:
+                    fed_id = chat['input_id']
+                    if fed_id != new_line_id:
+                        chat['bot_replica'] += id2char(fed_id, vocabulary)
+                    chat['counter'] += 1
+                    if fed_id == new_line_id or chat['counter'] >= max_replica_length:
+                        bot_replica = chat['bot_replica']
+                        print_and_log('Bot: ' + bot_replica, _print=False, fn=chat['file_name'])
+                        self._write_answer(writer, chat['chat_id'], bot_replica, partial_replies is not None)
+                        chat['timeshot'] = time.time()
+                        self._add_chat_answer_stats(stats, chat, chat['counter'])
+                        chat['generating'] = False
+                        chat['bot_replica'] = ''
+                        chat['counter'] = 0
+                        chat['partial_counter'] = 0
+                        # bot replica end is fed as in _generate_replica method
+                        chat['pending'] = [new_line_id]
+                    else:
+                        if partial_replies is not None and self._partial_reply_is_due(
+                                id2char(fed_id, vocabulary), chat['counter'] - chat['partial_counter'],
+                                partial_replies):
+                            self._write_answer(writer, chat['chat_id'], chat['bot_replica'], True, partial=True)
+                            if chat['partial_counter'] == 0 and chat['message_time'] is not None:
+                                stats.add('first_text_latency', time.time() - chat['message_time'])
+                            chat['partial_counter'] = chat['counter']
+                        chat['next_id'] = self._sample_id(prediction, temperature, top_k=top_k, top_p=top_p)
+                elif len(chat['pending']) == 0 and chat['reply_after_feeding']:
+                    chat['reply_after_feeding'] = False
+                    chat['generation_start'] = time.time()
+                    chat['generating'] = True
+                    if beam_width > 1:
+                        chat['beam_search'] = _BeamSearch(
+                            chat['states'], prediction, beam_width, max_length=max_replica_length,
+                            stop_id=new_line_id)
+                    else:
+                        chat['next_id'] = self._sample_id(prediction, temperature, top_k=top_k, top_p=top_p)
+                if len(chat['pending']) == 0 and chat['prefix_key'] is not None:
+                    self._prefix_cache.put(chat['prefix_key'], chat['states'])
+                    chat['prefix_key'] = None
+
+    def _telegram_batched(self,
+                          kwargs_for_building,
+                          restore_path,
+                          log_path,
+                          vocabulary,
+                          character_positions_in_vocabulary,
+                          batch_generator_class,
+                          additions_to_feed_dict,
+                          gpu_memory,
+                          allow_growth,
+                          temperature,
+                          bpe_codes,
+                          batch_gen_args,
+                          chat_states_path,
+                          chat_states_cache_size,
+                          prefix_states_path,
+                          beam_width,
+                          top_k,
+                          top_p,
+                          sampling_seed,
+                          frozen_graph_path,
+                          partial_replies,
+                          session_threads):
+        if sampling_seed is not None:
+            self.set_sampling_seed(sampling_seed)
+        self._build_or_load_frozen(kwargs_for_building, frozen_graph_path)
+        if self._hooks.get('serving_inputs') is None:
+            raise InvalidArgumentError(
+                'Batched serving requires pupil with serving graph. Use batched=False',
+                None, 'batched', 'False')
+        feed_dict_base = dict()
+        if additions_to_feed_dict is not None:
+            for addition in additions_to_feed_dict:
+                feed_dict_base[self._hooks[addition['placeholder']]] = addition['value']
+        self._start_session(False,
+                            False,
+                            gpu_memory,
+                            allow_growth,
+                            '',
+                            **session_threads)
+        self._initialize_pupil(restore_path)
+        state_store = ChatStateStore(capacity=chat_states_cache_size, path=chat_states_path)
+        if prefix_states_path is not None:
+            self._prefix_cache = PrefixStateCache(prefix_states_path)
+        # keys are the same as in _one_chat method
+        prefix_key_base = self._prefix_key_base(restore_path, frozen_graph_path, additions_to_feed_dict)
+        chats = dict()
+        stats = Stats()
+        try:
+            self._serve_chats(log_path, vocabulary, character_positions_in_vocabulary, batch_generator_class,
+                              feed_dict_base, temperature, bpe_codes, batch_gen_args, state_store, chats,
+                              prefix_key_base, beam_width=beam_width, top_k=top_k, top_p=top_p,
+                              partial_replies=partial_replies, stats=stats)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._save_stats(stats, chats, log_path)
+            print(stats.format_summary(), file=sys.stderr)
+            for chat_id, chat in chats.items():
+                state_store.put(chat_id, chat['states'])
+            state_store.flush()
+            self._close_session()
+
     def telegram(self,
                  kwargs_for_building,
                  restore_path,
@@ -1866,97 +3507,288 @@ class Environment(object):
                  allow_growth=True,
                  temperature=0.,
                  bpe_codes=None,
-                 batch_gen_args=None):
+                 batch_gen_args=None,
+                 batched=False,
+                 chat_states_path=None,
+                 chat_states_cache_size=1000,
+                 prefix_states_path=None,
+                 beam_width=1,
+                 top_k=None,
+                 top_p=None,
+                 sampling_seed=None,
+                 frozen_graph_path=None,
+                 partial_replies=None,
+                 intra_op_parallelism_threads=0,
+                 inter_op_parallelism_threads=0,
+                 use_per_session_threads=False):
+        """Runs chat bot reading messages from stdin and writing answers to stdout in CSV format. By default a
+        process with its own pupil is started for every chat. If batched is True one pupil serves all chats and chats
+        states are stepped together (pupil has to have serving graph). Messages and answers of chat processes are
+        passed by asyncio event loop. Statistics of answers (p50/p95/p99 of latency, queue delay, ingest and generation
+        time, tokens per second) are rewritten in stats.json in log_path directory every minute and printed to
+        stderr on shutdown. States of chats which were idle for too long are kept in LRU cache of size
+        chat_states_cache_size. Least recently used states are saved to chat_states_path directory (if provided), so
+        conversations can be continued after restart. States obtained after feeding greeting are cached and saved
+        to prefix_states_path directory (if provided). If beam_width is greater than 1 replies are generated with
+        beam search. Otherwise replies are sampled with temperature, top_k and top_p (nucleus) filtering. Seed of
+        sampling can be set with sampling_seed. If frozen_graph_path (directory created by export_frozen_graph) is
+        provided, frozen graph is loaded instead of building pupil with kwargs_for_building and restore_path is
+        ignored. If partial_replies is provided (number of tokens or 'word') beginnings of replies are written while
+        reply is generated. Such rows end with 'partial' marker and contain the whole text generated so far. Complete
+        answers then end with 'final' marker. intra_op_parallelism_threads, inter_op_parallelism_threads and
+        use_per_session_threads are passed to sessions of pupils"""
         if len(log_path) > 4 and log_path[-4:] == '.txt':
             create_path(log_path, file_name_is_in_path=True)
         else:
             create_path(log_path, file_name_is_in_path=False)
+        session_threads = dict(intra_op_parallelism_threads=intra_op_parallelism_threads,
+                               inter_op_parallelism_threads=inter_op_parallelism_threads,
+                               use_per_session_threads=use_per_session_threads)
+
+        if batched:
+            self._telegram_batched(kwargs_for_building, restore_path, log_path, vocabulary,
+                                   character_positions_in_vocabulary, batch_generator_class, additions_to_feed_dict,
+                                   gpu_memory, allow_growth, temperature, bpe_codes, batch_gen_args,
+                                   chat_states_path, chat_states_cache_size, prefix_states_path, beam_width,
+                                   top_k, top_p, sampling_seed, frozen_graph_path, partial_replies,
+                                   session_threads)
+            return None
+
+        chat_process_args = (kwargs_for_building, restore_path, vocabulary, character_positions_in_vocabulary,
+                             batch_generator_class, additions_to_feed_dict, gpu_memory, allow_growth, temperature,
+                             bpe_codes, batch_gen_args)
+        chat_process_kwargs = dict(chat_states_path=chat_states_path, prefix_states_path=prefix_states_path,
+                                   beam_width=beam_width, top_k=top_k, top_p=top_p,
+                                   frozen_graph_path=frozen_graph_path, partial_replies=partial_replies,
+                                   session_threads=session_threads)
+        chats = dict()
+        stats = Stats()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        stats_task = loop.create_task(self._stats_loop(stats, chats, log_path))
+        bridge_task = loop.create_task(
+            self._telegram_bridge(loop, chats, stats, chat_process_args, chat_process_kwargs, log_path))
+        try:
+            loop.run_until_complete(bridge_task)
+        except KeyboardInterrupt:
+            bridge_task.cancel()
+        loop.run_until_complete(self._stop_chats(loop, chats))
+        stats_task.cancel()
+        try:
+            loop.run_until_complete(stats_task)
+        except asyncio.CancelledError:
+            pass
+        self._save_stats(stats, chats, log_path)
+        print(stats.format_summary(), file=sys.stderr)
+        loop.close()
 
-        inqs = dict()
-        outqs = dict()
-        ps = dict()
-        file_names = dict()
+    @staticmethod
+    async def _open_stdin_stream(loop):
+        """Returns asyncio stream reading stdin. If stdin can not be read asynchronously (e. g. it is a regular file)
+        None is returned and stdin is read in executor"""
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except ValueError:
+            return None
+        return reader
 
+    @staticmethod
+    async def _read_stdin_line(loop, reader):
+        if reader is None:
+            return await loop.run_in_executor(None, sys.stdin.readline)
+        return (await reader.readline()).decode('utf-8')
+
+    def _start_chat_process(self, loop, chat_id, chat_process_args, chat_process_kwargs, log_path):
+        """Starts _one_chat process. Answers of the process are received through pipe which is watched by event
+        loop, so waiting for answers does not require polling"""
+        if len(log_path) > 4 and log_path[-4:] == '.txt':
+            file_name = add_index_to_filename_if_needed(log_path, index=0)
+        else:
+            file_name = add_index_to_filename_if_needed(log_path + '/chat.txt', index=0)
+        inq = mp.Queue()
+        connection, child_connection = mp.Pipe(duplex=False)
+        outq = asyncio.Queue()
+        process = mp.Process(
+            target=self._one_chat,
+            args=chat_process_args + (inq, _PipeWriter(child_connection), chat_id),
+            kwargs=chat_process_kwargs)
+        process.start()
+        # pipe end is closed in parent process so EOF is received if chat process dies
+        child_connection.close()
+
+        def on_answer():
+            try:
+                while connection.poll():
+                    outq.put_nowait(connection.recv())
+            except (EOFError, OSError):
+                loop.remove_reader(connection.fileno())
+                outq.put_nowait(-1)
+
+        loop.add_reader(connection.fileno(), on_answer)
+        return dict(chat_id=chat_id, file_name=file_name, inq=inq, outq=outq, connection=connection,
+                    process=process, sent=list(), task=None,
+                    streaming=chat_process_kwargs.get('partial_replies') is not None, partial_sent=False)
+
+    async def _telegram_bridge(self, loop, chats, stats, chat_process_args, chat_process_kwargs, log_path):
+        """Reads messages from stdin, starts chat processes and passes messages to them. Answers are written by
+        _chat_answers tasks. Returns when stdin is closed"""
         writer = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
-        read_list = [sys.stdin]
+        stdin_reader = await self._open_stdin_stream(loop)
+        while True:
+            text = await self._read_stdin_line(loop, stdin_reader)
+            if len(text) == 0:
+                break
+            row = csv.reader([text]).__next__()
+            if len(row) < 2 or not is_int(row[0]):
+                continue
+            chat_id, question = int(row[0]), row[1]
+            if chat_id not in chats:
+                chat = self._start_chat_process(loop, chat_id, chat_process_args, chat_process_kwargs, log_path)
+                chat['task'] = loop.create_task(self._chat_answers(loop, chats, chat, writer, stats))
+                chats[chat_id] = chat
+            chat = chats[chat_id]
+            chat['inq'].put(question)
+            # empty messages, '/start' and '/end' are not answered. The first message of new chat is answered
+            # with greeting
+            if question not in ('', '/start', '/end'):
+                chat['sent'].append(time.time())
+            stats.increment('messages')
+            if question != '/start' and question != '/end':
+                print_and_log('Human: ' + question, _print=False, fn=chat['file_name'])
+
+    async def _chat_answers(self, loop, chats, chat, writer, stats, check_interval=600):
+        """Writes answers of chat process to stdout until process sends termination flag. Then process is joined.
+        Every check_interval seconds without answers it is checked that process is alive. Besides answers chat
+        process sends ('partial', text) tuples with beginnings of answers, ('stats', measurements) tuples which
+        are sent before answer and ('greeting', text) tuple which answers the first message. Greeting is not
+        measured as in batched server"""
+        chat_id = chat['chat_id']
+        while True:
+            try:
+                bot_replica = await asyncio.wait_for(chat['outq'].get(), check_interval)
+            except asyncio.TimeoutError:
+                if chat['process'].is_alive():
+                    continue
+                print('WARNING! Process for chat %s stopped without sending termination flag' % chat_id)
+                bot_replica = -1
+            if bot_replica == -1:
+                break
+            if isinstance(bot_replica, tuple) and bot_replica[0] == 'stats':
+                if len(chat['sent']) > 0:
+                    stats.add('queue_delay', bot_replica[1]['received'] - chat['sent'][0])
+                self._add_generation_stats(stats, **bot_replica[1])
+                continue
+            if isinstance(bot_replica, tuple) and bot_replica[0] == 'greeting':
+                if len(chat['sent']) > 0:
+                    chat['sent'].pop(0)
+                print_and_log('Bot: ' + bot_replica[1], _print=False, fn=chat['file_name'])
+                self._write_answer(writer, chat_id, bot_replica[1], chat['streaming'])
+                continue
+            if isinstance(bot_replica, tuple):
+                if not chat['partial_sent'] and len(chat['sent']) > 0:
+                    stats.add('first_text_latency', time.time() - chat['sent'][0])
+                chat['partial_sent'] = True
+                self._write_answer(writer, chat_id, bot_replica[1], True, partial=True)
+                continue
+            if len(chat['sent']) > 0:
+                latency = time.time() - chat['sent'].pop(0)
+                stats.add('latency', latency)
+                if not chat['partial_sent']:
+                    stats.add('first_text_latency', latency)
+            chat['partial_sent'] = False
+            stats.increment('replies')
+            print_and_log('Bot: ' + bot_replica, _print=False, fn=chat['file_name'])
+            self._write_answer(writer, chat_id, bot_replica, chat['streaming'])
+        # new messages for chat_id start new process
+        if chats.get(chat_id) is chat:
+            del chats[chat_id]
+        await loop.run_in_executor(None, chat['process'].join, 1.)
+        if chat['process'].is_alive():
+            print('WARNING! Could not join process for chat %s' % chat_id)
+            chat['process'].terminate()
+            chat['process'].join()
         try:
-            while read_list:
-                # print('entered while loop')
-                ready = select.select(read_list, [], [], 0)[0]
-                if ready:
-                    # print('ready:', ready)
-                    text = ready[0].readline()
-                    # print('text:', text)
-                    row = csv.reader([text]).__next__()
-                    chat_id_has_corr_format = is_int(row[0])
-                    if chat_id_has_corr_format:
-                        chat_id, question = int(row[0]), row[1]
-                        if chat_id not in inqs:
-                            # print('chat_id not in inqs')
-                            if len(log_path) > 4 and log_path[-4:] == '.txt':
-                                file_name = add_index_to_filename_if_needed(log_path, index=0)
-                            else:
-                                file_name = add_index_to_filename_if_needed(log_path + '/chat.txt', index=0)
-                            file_names[chat_id] = file_name
-                            inqs[chat_id] = mp.Queue()
-                            # print('(Environment.telegram)inqs[chat_id]:', inqs[chat_id])
-                            outqs[chat_id] = mp.Queue()
-                            ps[chat_id] = mp.Process(target=self._one_chat,
-                                                     args=(kwargs_for_building, restore_path, vocabulary,
-                                                           character_positions_in_vocabulary,
-                                                           batch_generator_class, additions_to_feed_dict, gpu_memory,
-                                                           allow_growth, temperature, bpe_codes, batch_gen_args,
-                                                           inqs[chat_id], outqs[chat_id]))
-                            # print('(Environment.telegram)question:', question)
-                            inqs[chat_id].put(question)
-                            # print('(Environment.telegram)inqs[chat_id]:', inqs[chat_id])
-                            ps[chat_id].start()
-                            # print('ps:', ps)
-                        else:
-                            inqs[chat_id].put(question)
-
-
-                        if question != '/start' and question != '/end':
-                            print_and_log('Human: ' + question, _print=False, fn=file_names[chat_id])
-                # print('reached outqs loop')
-                for chat_id in list(outqs.keys()):
-                    try:
-                        bot_replica = outqs[chat_id].get(block=False)
-                    except queue.Empty:
-                        bot_replica = -2
-                    if bot_replica == -1:
-                        # print(-1)
-                        ps[chat_id].join()
-                        if ps[chat_id].is_alive():
-                            print('WARNING! Could not join process for chat %s' % chat_id)
-                            ps[chat_id].terminate()
-                            ps[chat_id].join()
-                        del ps[chat_id]
-                        del inqs[chat_id]
-                        del outqs[chat_id]
-                        del file_names[chat_id]
-                    elif bot_replica != -2:
-                        print_and_log('Bot: ' + bot_replica, _print=False, fn=file_names[chat_id])
-                        writer.writerow([chat_id, bot_replica, "", "/start", "Ты дурак.", "/end"])
-                        sys.stdout.flush()
+            loop.remove_reader(chat['connection'].fileno())
+        except (OSError, ValueError):
+            pass
+        chat['connection'].close()
+
+    async def _stop_chats(self, loop, chats, timeout=5.):
+        for chat in chats.values():
+            chat['inq'].put('/end')
+        tasks = [chat['task'] for chat in chats.values()]
+        if len(tasks) > 0:
+            _, not_finished = await asyncio.wait(tasks, timeout=timeout)
+            for task in not_finished:
+                task.cancel()
+        for chat_id, chat in list(chats.items()):
+            print('WARNING! Process termination flag was not received for chat %s' % chat_id)
+            if chat['process'].is_alive():
+                chat['process'].terminate()
+            chat['process'].join()
+            del chats[chat_id]
 
-        except KeyboardInterrupt:
-            for inq in inqs.values():
-                inq.put('/end')
-            for chat_id, outq in outqs.items():
-                try:
-                    flag = outq.get(timeout=.01)
-                    # print('1 try')
-                    while flag != -1:
-                        flag = outq.get(timeout=.01)
-                        # print('another try')
-                except queue.Empty:
-                    print('WARNING! Process termination flag was not received for chat %s' % chat_id)
-                ps[chat_id].join(timeout=.01)
-                if ps[chat_id].is_alive():
-                    print('WARNING! Could not join process for chat %s' % chat_id)
-                    ps[chat_id].terminate()
-                    ps[chat_id].join()
+    @staticmethod
+    def _write_answer(writer, chat_id, text, streaming, partial=False):
+        """Writes answer row in CSV format. If partial replies are streamed row ends with 'partial' marker (text is
+        the beginning of reply which is not finished yet) or 'final' marker"""
+        row = [chat_id, text, "", "/start", "Ты дурак.", "/end"]
+        if streaming:
+            row.append('partial' if partial else 'final')
+        writer.writerow(row)
+        sys.stdout.flush()
+
+    @staticmethod
+    def _partial_reply_is_due(char, num_new_tokens, partial_replies):
+        """Checks if partial reply has to be sent after token char. num_new_tokens is number of tokens generated
+        since the last partial reply"""
+        if partial_replies == 'word':
+            return char.isspace() and num_new_tokens > 1
+        return num_new_tokens >= partial_replies
+
+    @staticmethod
+    def _stats_path(log_path):
+        if len(log_path) > 4 and log_path[-4:] == '.txt':
+            return log_path[:-4] + '_stats.json'
+        return os.path.join(log_path, 'stats.json')
+
+    @staticmethod
+    def _save_stats(stats, chats, log_path):
+        stats.set('active_chats', len(chats))
+        stats.save(Environment._stats_path(log_path))
+
+    def _add_chat_answer_stats(self, stats, chat, tokens):
+        """Adds measurements of answer of batched server chat. Greeting answers are not measured"""
+        if chat['message_time'] is None:
+            return None
+        now = time.time()
+        stats.add('latency', now - chat['message_time'])
+        if chat['partial_counter'] == 0:
+            stats.add('first_text_latency', now - chat['message_time'])
+        stats.increment('replies')
+        self._add_generation_stats(stats, ingest_time=chat['generation_start'] - chat['ingest_start'],
+                                   generation_time=now - chat['generation_start'], tokens=tokens)
+        chat['message_time'] = None
+
+    @staticmethod
+    def _add_generation_stats(stats, ingest_time=None, generation_time=None, tokens=None, **kwargs):
+        """Adds measurements of one answer: time of feeding human replica, time of generation and number of
+        generated tokens"""
+        if ingest_time is not None:
+            stats.add('ingest_time', ingest_time)
+        if generation_time is not None:
+            stats.add('generation_time', generation_time)
+        if tokens is not None:
+            stats.add('tokens', tokens)
+            stats.increment('tokens', tokens)
+            if generation_time is not None and generation_time > 0:
+                stats.add('tokens_per_second', tokens / generation_time)
+
+    async def _stats_loop(self, stats, chats, log_path, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            self._save_stats(stats, chats, log_path)
 
     def generate_discriminator_dataset(self,
                                        num_examples,
@@ -1968,7 +3800,16 @@ class Environment(object):
                                        save_path,
                                        vocabulary=None,
                                        additions_to_feed_dict=None,
-                                       gpu_memory=None):
+                                       gpu_memory=None,
+                                       fuse_batch_size=256,
+                                       shard_size=10000,
+                                       num_workers=1,
+                                       resume=True):
+        """Generates continuations of dataset replicas for discriminator training. Examples are processed in shards
+        of shard_size examples which are saved to save_path/shards directory as soon as they are generated, so
+        interrupted generation is resumed from the first not generated shard (if resume is True). Shards can be
+        processed by num_workers processes. When all shards are ready files 'fuses.txt', 'correct.txt' and
+        'generated.txt' are merged into save_path directory"""
         if additions_to_feed_dict is None:
             additions_to_feed_dict = dict()
         if vocabulary is None and self._vocabulary is None:
@@ -2002,18 +3843,78 @@ class Environment(object):
                 used_answers.append(answers[i*interval][1:])
         # print('used_replicas:', used_replicas)
         # print('used_answers:', used_answers)
-        create_path(save_path, False)
-        fuses_fd = open(add_index_to_filename_if_needed(save_path + '/fuses.txt'), 'w', encoding='utf-8')
-        correct_answers_fd = open(add_index_to_filename_if_needed(save_path + '/correct.txt'), 'w', encoding='utf-8')
+        shards_path = save_path + '/shards'
+        create_path(shards_path, False)
+        shards = [(shard_idx, shard_start, min(shard_start + shard_size, len(used_replicas)))
+                  for shard_idx, shard_start in enumerate(range(0, len(used_replicas), shard_size))]
+        # progress checkpoint is valid only if the same examples are split into shards in the same way
+        shards_specs = {'num_examples': len(used_replicas), 'shard_size': shard_size,
+                        'num_repeats': num_repeats, 'gen_max_length': gen_max_length, 'fuse_stop': fuse_stop,
+                        'restore_path': restore_path, 'examples_hash': hash_nested([used_replicas, used_answers]),
+                        'vocabulary_hash': hash_nested(vocabulary),
+                        'additions_to_feed_dict_hash': hash_nested(additions_to_feed_dict)}
+        specs_file_name = shards_path + '/specs.json'
+        if resume and os.path.exists(specs_file_name):
+            with open(specs_file_name, 'r') as f:
+                old_specs = json.load(f)
+            if old_specs != shards_specs:
+                raise InvalidArgumentError(
+                    'Generation can not be resumed because %s does not match current arguments %s' %
+                    (specs_file_name, shards_specs), resume, 'resume', 'False')
+        with open(specs_file_name, 'w') as f:
+            json.dump(shards_specs, f)
+        shard_tasks = list()
+        for shard_idx, shard_start, shard_end in shards:
+            shard_path = shards_path + '/%s' % shard_idx
+            if not (resume and os.path.exists(shard_path + '/done')):
+                shard_tasks.append(
+                    (shard_path, used_replicas[shard_start:shard_end], used_answers[shard_start:shard_end]))
+        print('%s of %s shards are already generated' % (len(shards) - len(shard_tasks), len(shards)))
+        generation_kwargs = dict(num_repeats=num_repeats, gen_max_length=gen_max_length, fuse_stop=fuse_stop,
+                                 restore_path=restore_path, vocabulary=vocabulary,
+                                 additions_to_feed_dict=additions_to_feed_dict, gpu_memory=gpu_memory,
+                                 fuse_batch_size=fuse_batch_size)
+        if num_workers == 1:
+            self._discriminator_shards_worker(shard_tasks, generation_kwargs)
+        else:
+            workers = list()
+            for worker_idx in range(num_workers):
+                workers.append(mp.Process(target=self._discriminator_shards_worker,
+                                          args=(shard_tasks[worker_idx::num_workers], generation_kwargs)))
+                workers[-1].start()
+            for worker in workers:
+                worker.join()
+        not_generated = [shard_idx for shard_idx, _, _ in shards
+                         if not os.path.exists(shards_path + '/%s/done' % shard_idx)]
+        if len(not_generated) > 0:
+            print('WARNING! Shards %s were not generated. Restart generation to resume' % not_generated)
+            return None
+
+        for file_name in ['fuses.txt', 'correct.txt', 'generated.txt']:
+            with open(add_index_to_filename_if_needed(save_path + '/' + file_name), 'w', encoding='utf-8') as merged:
+                for shard_idx, _, _ in shards:
+                    with open(shards_path + '/%s/%s' % (shard_idx, file_name), 'r', encoding='utf-8') as f:
+                        for line in f:
+                            merged.write(line)
+
+    def _generate_discriminator_shard(self,
+                                      shard_path,
+                                      replicas,
+                                      answers,
+                                      num_repeats,
+                                      gen_max_length,
+                                      fuse_stop,
+                                      restore_path,
+                                      vocabulary,
+                                      additions_to_feed_dict,
+                                      gpu_memory,
+                                      fuse_batch_size):
+        """Generates continuations of replicas and saves fuses, correct answers and generated phrases to shard_path
+        directory. Files are written to temporary files and renamed, 'done' file is created when shard is ready"""
         fuses = list()
-        for replica, answer in zip(used_replicas, used_answers):
+        for replica in replicas:
             fuses.append({'text': replica + '\n', 'num_repeats': num_repeats,
                           'max_num_of_chars': gen_max_length, 'fuse_stop': fuse_stop})
-            fuses_fd.write(replica + '\n')
-            correct_answers_fd.write(answer + '\n')
-        fuses_fd.close()
-        correct_answers_fd.close()
-
         fuse_results, _ = self.test(
             restore_path=restore_path,
             print_results=False,
@@ -2021,30 +3922,27 @@ class Environment(object):
             additions_to_feed_dict=additions_to_feed_dict,
             printed_result_types=None,
             fuses=fuses,
+            fuse_batch_size=fuse_batch_size,
             random=None,
             gpu_memory=gpu_memory)
-
-        generated_fd = open(add_index_to_filename_if_needed(save_path + '/generated.txt'), 'w')
-        generated_text = ''
+        generated = list()
         for fuse_res in fuse_results:
-            for phrase_idx, phrase in enumerate(fuse_res['results']):
-                phrase = re.sub("[\t\n]+", '', phrase)
-                generated_fd.write(phrase[1:])
-                generated_text += phrase[1:]
-                # print('phrase_idx:', phrase_idx, 'length:', len(phrase))
-                if phrase_idx < len(fuse_res['results']) - 1:
-                    # print('phrase_idx:', phrase_idx)
-                    generated_text += '\t'
-                    num_chars = generated_fd.write("\t")
-                    # print('num_chars:', num_chars)
-            generated_fd.write('\n')
-            generated_text += '\n'
-        generated_fd.close()
-        # fd = open(save_path + '/generated.txt', 'r', encoding='utf-8')
-        # file_text = fd.read()
-        # print('file_text:', file_text)
-
-        # print('generated_text:', generated_text)
+            phrases = [re.sub("[\t\n]+", '', phrase)[1:] for phrase in fuse_res['results']]
+            generated.append('\t'.join(phrases))
+        create_path(shard_path, False)
+        for file_name, lines in [('fuses.txt', replicas), ('correct.txt', answers), ('generated.txt', generated)]:
+            tmp_file_name = shard_path + '/' + file_name + '.tmp'
+            with open(tmp_file_name, 'w', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(line + '\n')
+            os.replace(tmp_file_name, shard_path + '/' + file_name)
+        with open(shard_path + '/done', 'w') as f:
+            f.write('%s\n' % len(replicas))
+
+    def _discriminator_shards_worker(self, shard_tasks, generation_kwargs):
+        for shard_path, replicas, answers in shard_tasks:
+            self._generate_discriminator_shard(shard_path, replicas, answers, **generation_kwargs)
+            print('shard %s is generated' % shard_path)
 
     def _store_launch_parameters(self, **kwargs):
         self.current_launch_parameters = kwargs
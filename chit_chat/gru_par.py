@@ -5,6 +5,7 @@ from some_useful_functions import (construct, create_vocabulary,
                                    get_positions_in_vocabulary, char2vec, pred2vec, vec2char,
                                    char2id, id2char, flatten, get_available_gpus, device_name_scope,
                                    average_gradients, get_num_gpus_and_bs_on_gpus)
+from rnn_graphs import accumulation_graph, prefill_graph, generation_graph, serving_graph
 
 
 url = 'http://mattmahoney.net/dc/'
@@ -120,6 +121,14 @@ class Gru(Model):
     def get_name(cls):
         return cls._name
 
+    @classmethod
+    def get_feedable_hyperparameters(cls):
+        """Build hyperparameters which do not change graph structure. They can be fed to placeholders with same
+        names. Values show when hyperparameter has to be fed: 'initialization' (to variables initializer) or
+        'training' (on every training step)"""
+        return {'init_parameter': 'initialization',
+                'regularization_rate': 'training'}
+
     @staticmethod
     def get_special_args():
         return dict()
@@ -327,6 +336,8 @@ class Gru(Model):
             with tf.name_scope(device_name_scope('/cpu:0') + '_gradients'):
                 grads_and_vars = average_gradients(tower_grads)
                 grads, v = zip(*grads_and_vars)
+                if self._gradient_accumulation:
+                    accumulation_graph(optimizer, grads, v, self._hooks)
                 grads, _ = tf.clip_by_global_norm(grads, 1.)
                 self.train_op = optimizer.apply_gradients(zip(grads, v))
                 self._hooks['train_op'] = self.train_op
@@ -364,6 +375,8 @@ class Gru(Model):
                             trainable=False,
                             name='saved_sample_state_%s' % layer_idx))
 
+                self._hooks['validation_state_variables'] = flatten(saved_sample_state)
+
                 reset_list = self._compose_reset_list(saved_sample_state)
 
                 self.reset_sample_state = tf.group(*reset_list)
@@ -385,6 +398,33 @@ class Gru(Model):
                     self.sample_prediction = tf.nn.softmax(sample_logit)
                     self._hooks['validation_predictions'] = self.sample_prediction
 
+                self._prefill_graph(saved_sample_state)
+                generation_graph(saved_sample_state, self._vocabulary_size, self._cell_step, self._logits,
+                                 self._save_states, self._hooks)
+                self.serving_inputs = serving_graph(
+                    saved_sample_state, self._vocabulary_size, self._cell_step, self._logits, self._hooks)
+
+    def _cell_step(self, inputs, states):
+        return self._rnn_iter(self._embed([inputs])[0], states)
+
+    def _logits(self, output):
+        return self._output_module([output])
+
+    def _save_states(self, variables, values):
+        return self._compose_save_list((variables, values))
+
+    def _prefill_graph(self, saved_sample_state):
+        """Creates operation which passes a whole sequence of arbitrary length through validation cell in one
+        session call (tf.while_loop) and saves resulting state to saved_sample_state. prefill_inputs placeholder
+        is a sequence of validation inputs concatenated along 0 axis. prefill_predictions is prediction made after the
+        last input"""
+        with tf.name_scope('prefill'):
+            self.prefill_inputs = tf.placeholder(
+                tf.float32, shape=[None, 1, self._vocabulary_size], name='prefill_inputs')
+            self._hooks['prefill_inputs'] = self.prefill_inputs
+            prefill_graph(self.prefill_inputs, saved_sample_state, self._num_nodes[-1], self._cell_step,
+                          lambda output: tf.nn.softmax(self._logits(output)), self._save_states, self._hooks)
+
     def __init__(self,
                  batch_size=64,
                  num_layers=2,
@@ -398,11 +438,14 @@ class Gru(Model):
                  num_gpus=1,
                  regularization_rate=.000003,
                  regime='train',
-                 going_to_limit_memory=False):
+                 going_to_limit_memory=False,
+                 gradient_accumulation=False):
 
         self._hooks = dict(inputs=None,
                            labels=None,
                            train_op=None,
+                           accumulate_grads=None,
+                           apply_accumulated_grads=None,
                            learning_rate=None,
                            loss=None,
                            predictions=None,
@@ -410,7 +453,22 @@ class Gru(Model):
                            validation_predictions=None,
                            reset_validation_state=None,
                            randomize_sample_state=None,
+                           validation_state_variables=None,
+                           prefill_inputs=None,
+                           prefill_predictions=None,
+                           generation_start_predictions=None,
+                           generation_temperature=None,
+                           generation_max_length=None,
+                           generation_stop_id=None,
+                           generated_ids=None,
+                           generation_predictions=None,
+                           serving_inputs=None,
+                           serving_states=None,
+                           serving_new_states=None,
+                           serving_predictions=None,
                            dropout=None,
+                           init_parameter=None,
+                           regularization_rate=None,
                            saver=None)
 
         self._batch_size = batch_size
@@ -421,8 +479,12 @@ class Gru(Model):
         self._num_output_layers = num_output_layers
         self._num_output_nodes = num_output_nodes
         self._num_unrollings = num_unrollings
-        self._init_parameter = init_parameter
-        self._regularization_rate = regularization_rate
+        self._init_parameter = tf.placeholder_with_default(float(init_parameter), shape=[], name='init_parameter')
+        self._regularization_rate = tf.placeholder_with_default(
+            float(regularization_rate), shape=[], name='regularization_rate')
+        self._hooks['init_parameter'] = self._init_parameter
+        self._hooks['regularization_rate'] = self._regularization_rate
+        self._gradient_accumulation = gradient_accumulation
 
         if not going_to_limit_memory:
             self._gpu_names = get_available_gpus()
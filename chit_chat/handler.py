@@ -352,6 +352,14 @@ class Handler(object):
     def set_processed_fuse_index(self, fuse_idx):
         self._processed_fuse_index = fuse_idx
 
+    def fuse_tensors_are_scheduled(self):
+        if self._fuse_tensor_schedule is None:
+            return False
+        for tensors_schedule in self._fuse_tensor_schedule.values():
+            if len(tensors_schedule) > 0:
+                return True
+        return False
+
     def start_fuse_accumulation(self):
         self._accumulated_text = ''
         self._text_is_being_accumulated = True
@@ -362,6 +370,10 @@ class Handler(object):
         self._accumulated_text = None
         self._text_is_being_accumulated = False
 
+    def add_fuse_result(self, text):
+        """Adds generated text to results of fuse which index was set with set_processed_fuse_index method"""
+        self._fuses[self._processed_fuse_index]['results'].append(text)
+
     def start_example_accumulation(self):
         self._text_is_being_accumulated = True
         if self._batch_generator_class.__name__ == 'BpeBatchGenerator' or \
@@ -614,7 +626,7 @@ class Handler(object):
             if datum is not None:
                 self._accumulated[descriptor].append(datum)
 
-    def get_tensors(self, regime, step, with_meta_optimizer=False):
+    def get_tensors(self, regime, step, with_meta_optimizer=False, with_accumulated_grads=False):
         tensors = list()
         self._last_run_tensor_order = dict()
         pointer = 0
@@ -627,6 +639,10 @@ class Handler(object):
                 tensors.append(self._hooks['train_op_with_meta_optimizer'])
                 current['tensors']['train_op_with_meta_optimizer'] = [pointer, pointer+1]
                 pointer += 1
+            elif with_accumulated_grads:
+                tensors.append(self._hooks['apply_accumulated_grads'])
+                current['tensors']['apply_accumulated_grads'] = [pointer, pointer + 1]
+                pointer += 1
             else:
                 tensors.append(self._hooks['train_op'])
                 current['tensors']['train_op'] = [pointer, pointer + 1]
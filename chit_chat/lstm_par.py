@@ -5,6 +5,7 @@ from some_useful_functions import (construct, create_vocabulary,
                                    get_positions_in_vocabulary, char2vec, pred2vec, pred2vec_fast, vec2char,
                                    vec2char_fast, char2id, id2char, flatten, get_available_gpus, device_name_scope,
                                    average_gradients, get_num_gpus_and_bs_on_gpus)
+from rnn_graphs import accumulation_graph, prefill_graph, generation_graph, serving_graph
 
 
 url = 'http://mattmahoney.net/dc/'
@@ -197,6 +198,14 @@ class Lstm(Model):
     def get_name(cls):
         return cls._name
 
+    @classmethod
+    def get_feedable_hyperparameters(cls):
+        """Build hyperparameters which do not change graph structure. They can be fed to placeholders with same
+        names. Values show when hyperparameter has to be fed: 'initialization' (to variables initializer) or
+        'training' (on every training step)"""
+        return {'init_parameter': 'initialization',
+                'regularization_rate': 'training'}
+
     def get_special_args(self):
         if self._number_of_punctuation_marks is None:
             return dict()
@@ -439,6 +448,8 @@ class Lstm(Model):
                     optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
                     grads_and_vars = average_gradients(tower_grads)
                     grads, v = zip(*grads_and_vars)
+                    if self._gradient_accumulation:
+                        accumulation_graph(optimizer, grads, v, self._hooks)
                     grads, _ = tf.clip_by_global_norm(grads, 1.)
                     self.train_op = optimizer.apply_gradients(zip(grads, v))
                     self._hooks['train_op'] = self.train_op
@@ -508,6 +519,8 @@ class Lstm(Model):
                              name='saved_sample_state_%s_%s' % (layer_idx, 1)))
                     )
 
+                self._hooks['validation_state_variables'] = flatten(saved_sample_state)
+
                 reset_list = self._compose_reset_list(saved_sample_state)
 
                 self.reset_sample_state = tf.group(*reset_list)
@@ -526,27 +539,71 @@ class Lstm(Model):
                 sample_save_ops = self._compose_save_list((saved_sample_state, sample_state))
 
                 with tf.control_dependencies(sample_save_ops):
-                    if self._number_of_punctuation_marks == 0:
-                        self.sample_prediction = tf.nn.softmax(sample_logit)
-                    else:
-                        word_logit, punctuation_logit = tf.split(
-                            sample_logit, [self._vocabulary_size, self._mark_vec_len], axis=1)
-                        word_pred = tf.nn.softmax(word_logit)
-                        if self._punctuation_encoding == 'positional_notation':
-                            punctuation_pred = tf.tanh(punctuation_logit)
-
-                        elif self._punctuation_encoding == 'one_hot':
-                            separate_mark_logits = tf.split(
-                                punctuation_logit, self._max_mark_num, axis=1, name='separate_mark_logits')
-                            separate_mark_logits = tf.concat(
-                                separate_mark_logits, 0, name='separate_mark_logits_concat')
-                            separate_mark_preds = tf.nn.softmax(
-                                separate_mark_logits, name='separate_mark_preds')
-                            separate_mark_preds = tf.split(separate_mark_preds, self._max_mark_num, axis=0)
-                            punctuation_pred = tf.concat(separate_mark_preds, 1)
-                        self.sample_prediction = tf.concat([word_pred, punctuation_pred], 1)
+                    self.sample_prediction = self._sample_prediction(sample_logit)
                     self._hooks['validation_predictions'] = self.sample_prediction
 
+                self._prefill_graph(saved_sample_state)
+                # in-graph generation and serving work only with plain vocabulary predictions
+                if self._number_of_punctuation_marks == 0:
+                    generation_graph(saved_sample_state, self._vocabulary_size, self._cell_step, self._logits,
+                                     self._save_states, self._hooks)
+                    self.serving_inputs = serving_graph(
+                        saved_sample_state, self._vocabulary_size, self._cell_step, self._logits, self._hooks)
+
+    def _sample_prediction(self, sample_logit):
+        if self._number_of_punctuation_marks == 0:
+            return tf.nn.softmax(sample_logit)
+        word_logit, punctuation_logit = tf.split(
+            sample_logit, [self._vocabulary_size, self._mark_vec_len], axis=1)
+        word_pred = tf.nn.softmax(word_logit)
+        if self._punctuation_encoding == 'positional_notation':
+            punctuation_pred = tf.tanh(punctuation_logit)
+
+        elif self._punctuation_encoding == 'one_hot':
+            separate_mark_logits = tf.split(
+                punctuation_logit, self._max_mark_num, axis=1, name='separate_mark_logits')
+            separate_mark_logits = tf.concat(
+                separate_mark_logits, 0, name='separate_mark_logits_concat')
+            separate_mark_preds = tf.nn.softmax(
+                separate_mark_logits, name='separate_mark_preds')
+            separate_mark_preds = tf.split(separate_mark_preds, self._max_mark_num, axis=0)
+            punctuation_pred = tf.concat(separate_mark_preds, 1)
+        return tf.concat([word_pred, punctuation_pred], 1)
+
+    def _cell_step(self, inputs, states):
+        return self._rnn_iter(self._embed([inputs])[0], states)
+
+    def _logits(self, output):
+        return self._output_module([output])
+
+    def _save_states(self, variables, values):
+        return self._compose_save_list((variables, values))
+
+    def _prefill_graph(self, saved_sample_state):
+        """Creates operation which passes a whole sequence of arbitrary length through validation cell in one
+        session call (tf.while_loop) and saves resulting state to saved_sample_state. prefill_inputs placeholder
+        is a sequence of validation inputs concatenated along 0 axis. prefill_predictions is prediction made after the
+        last input"""
+        with tf.name_scope('prefill'):
+            if self._embeddings_in_batch:
+                self.prefill_inputs = tf.placeholder(
+                    tf.float32, shape=[None, 1, self._vec_dim], name='prefill_inputs')
+                prefill_inputs = self.prefill_inputs
+            else:
+                self.prefill_inputs = tf.placeholder(
+                    tf.int32, shape=[None, 1, self._max_mark_num + 1], name='prefill_inputs')
+                if self._max_mark_num > 0:
+                    # only 'one_hot' punctuation encoding is supported as in validation graph
+                    inputs = tf.unstack(self.prefill_inputs, axis=2)
+                    inp0 = tf.one_hot(inputs[0], self._vocabulary_size)
+                    inps = [tf.one_hot(inp, self._number_of_punctuation_marks) for inp in inputs[1:]]
+                    prefill_inputs = tf.concat([inp0] + inps, 2)
+                else:
+                    prefill_inputs = tf.one_hot(tf.reshape(self.prefill_inputs, [-1, 1]), self._vocabulary_size)
+            self._hooks['prefill_inputs'] = self.prefill_inputs
+            prefill_graph(prefill_inputs, saved_sample_state, self._num_nodes[-1], self._cell_step,
+                          lambda output: self._sample_prediction(self._logits(output)), self._save_states, self._hooks)
+
     def __init__(self,
                  batch_size=64,
                  embeddings_in_batch=True,
@@ -564,12 +621,15 @@ class Lstm(Model):
                  going_to_limit_memory=False,
                  number_of_punctuation_marks=0,
                  max_mark_num=0,
-                 punctuation_encoding='one_hot'):
+                 punctuation_encoding='one_hot',
+                 gradient_accumulation=False):
 
         self._hooks = dict(inputs=None,
                            labels=None,
                            labels_prepared=None,
                            train_op=None,
+                           accumulate_grads=None,
+                           apply_accumulated_grads=None,
                            learning_rate=None,
                            loss=None,
                            predictions=None,
@@ -579,7 +639,22 @@ class Lstm(Model):
                            validation_predictions=None,
                            reset_validation_state=None,
                            randomize_sample_state=None,
+                           validation_state_variables=None,
+                           prefill_inputs=None,
+                           prefill_predictions=None,
+                           generation_start_predictions=None,
+                           generation_temperature=None,
+                           generation_max_length=None,
+                           generation_stop_id=None,
+                           generated_ids=None,
+                           generation_predictions=None,
+                           serving_inputs=None,
+                           serving_states=None,
+                           serving_new_states=None,
+                           serving_predictions=None,
                            dropout=None,
+                           init_parameter=None,
+                           regularization_rate=None,
                            saver=None)
 
         self._batch_size = batch_size
@@ -591,8 +666,12 @@ class Lstm(Model):
         self._num_output_layers = num_output_layers
         self._num_output_nodes = num_output_nodes
         self._num_unrollings = num_unrollings
-        self._init_parameter = init_parameter
-        self._regularization_rate = regularization_rate
+        self._init_parameter = tf.placeholder_with_default(float(init_parameter), shape=[], name='init_parameter')
+        self._regularization_rate = tf.placeholder_with_default(
+            float(regularization_rate), shape=[], name='regularization_rate')
+        self._hooks['init_parameter'] = self._init_parameter
+        self._hooks['regularization_rate'] = self._regularization_rate
+        self._gradient_accumulation = gradient_accumulation
 
         if not going_to_limit_memory:
             gpu_names = get_available_gpus()
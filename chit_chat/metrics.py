@@ -0,0 +1,63 @@
+import json
+import os
+import time
+from collections import deque
+import numpy as np
+
+
+class Stats(object):
+    """Collects per message measurements (latencies, numbers of tokens), counters and gauges. Percentiles of
+    measurements are computed over the last max_samples values of every quantity"""
+
+    def __init__(self, max_samples=10000, percentiles=(50, 95, 99)):
+        self._max_samples = max_samples
+        self._percentiles = percentiles
+        self._samples = dict()
+        self._counters = dict()
+        self._gauges = dict()
+        self._start = time.time()
+
+    def add(self, name, value):
+        if name not in self._samples:
+            self._samples[name] = deque(maxlen=self._max_samples)
+        self._samples[name].append(value)
+
+    def increment(self, name, value=1):
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self._gauges[name] = value
+
+    def summary(self):
+        uptime = time.time() - self._start
+        summary = dict(uptime=uptime, gauges=dict(self._gauges.items()), counters=dict(), samples=dict())
+        for name, value in self._counters.items():
+            summary['counters'][name] = dict(total=value, per_second=value / uptime if uptime > 0 else 0.)
+        for name, samples in self._samples.items():
+            values = np.array(samples, dtype=np.float64)
+            description = dict(count=len(values), mean=float(np.mean(values)), max=float(np.max(values)))
+            for percentile, value in zip(self._percentiles, np.percentile(values, self._percentiles)):
+                description['p%s' % percentile] = float(value)
+            summary['samples'][name] = description
+        return summary
+
+    def save(self, path):
+        """Rewrites stats file. New file replaces the old one, so readers never see partially written file"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ['uptime: %.1f s' % summary['uptime']]
+        for name, value in sorted(summary['gauges'].items()):
+            lines.append('%s: %s' % (name, value))
+        for name, counter in sorted(summary['counters'].items()):
+            lines.append('%s: %s (%.3f per second)' % (name, counter['total'], counter['per_second']))
+        for name, description in sorted(summary['samples'].items()):
+            percentiles = ' '.join(['p%s=%.4f' % (p, description['p%s' % p]) for p in self._percentiles])
+            lines.append('%s: mean=%.4f %s max=%.4f (%s samples)' %
+                         (name, description['mean'], percentiles, description['max'], description['count']))
+        return '\n'.join(lines)
+
@@ -0,0 +1,355 @@
+"""CPU inference of trained lstm_par.Lstm, gru_par.Gru and vanilla.Vanilla models without TensorFlow.
+Checkpoint is converted to compact .npz weight file with export_weights (TensorFlow is needed only for export).
+NumpyEngine reproduces 'validation_predictions' of a model (dropout is switched off) for a batch of chats.
+Recurrent and output matrices can be quantized to int8 with one scale per output unit (quantize=True). Quantized
+matrices are dequantized block by block during matmul, so memory traffic is 4 times smaller than for float32."""
+import argparse
+import os
+import tempfile
+import numpy as np
+
+
+def _read_checkpoint(checkpoint_path):
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    return {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+
+
+def quantize_matrix(matrix):
+    """Quantizes matrix of shape [input_dim, output_dim] to int8. Every output unit (column) has its own scale.
+    Returns:
+        int8 matrix and float32 scales of shape [output_dim]"""
+    scale = np.max(np.abs(matrix), axis=0) / 127.
+    scale[scale == 0.] = 1.
+    quantized = np.clip(np.round(matrix / scale), -127, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+
+class QuantizedMatrix(object):
+    """int8 matrix with per column scales. dot dequantizes block_size input rows at a time into preallocated
+    buffer, so only int8 matrix is read from memory and float32 block stays in cache"""
+
+    def __init__(self, quantized, scale, max_batch_size=1, block_size=256):
+        self._quantized = quantized
+        self._scale = scale
+        self._block_size = min(block_size, quantized.shape[0])
+        self._block = np.zeros([self._block_size, quantized.shape[1]], dtype=np.float32)
+        self._partial = np.zeros([max_batch_size, quantized.shape[1]], dtype=np.float32)
+        self.shape = quantized.shape
+
+    def dot(self, x, out):
+        n = x.shape[0]
+        partial = self._partial[:n]
+        out.fill(0.)
+        for start in range(0, self.shape[0], self._block_size):
+            stop = min(start + self._block_size, self.shape[0])
+            block = self._block[:stop - start]
+            np.copyto(block, self._quantized[start:stop], casting='unsafe')
+            np.dot(x[:, start:stop], block, out=partial)
+            out += partial
+        out *= self._scale
+        return out
+
+
+def _dot(x, matrix, out):
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.dot(x, out)
+    return np.dot(x, matrix, out=out)
+
+
+def export_weights(checkpoint_path, save_path, vocabulary=None, quantize=False):
+    """Reads checkpoint saved by Lstm, Gru or Vanilla saver and writes weights to .npz file.
+    Recurrent matrices are split into input and state parts, so engine does not have to concatenate inputs
+    and states.
+    Args:
+        checkpoint_path: path to checkpoint (as passed to restore_path)
+        save_path: path to .npz file
+        vocabulary: list of characters. If provided it is saved together with weights
+        quantize: if True recurrent and output matrices are saved in int8 with '<name>_scale' arrays"""
+    variables = _read_checkpoint(checkpoint_path)
+    weights = dict()
+    if 'lstm_matrix_0' in variables or 'gate_matrix_0' in variables:
+        cell = 'lstm' if 'lstm_matrix_0' in variables else 'gru'
+        weights['embedding_matrix'] = variables['embedding_matrix']
+        layer_idx = 0
+        while '%s_matrix_%s' % ('lstm' if cell == 'lstm' else 'gate', layer_idx) in variables:
+            if cell == 'lstm':
+                matrix = variables['lstm_matrix_%s' % layer_idx]
+                nn = matrix.shape[1] // 4
+                weights['input_matrix_%s' % layer_idx] = matrix[:-nn]
+                weights['state_matrix_%s' % layer_idx] = matrix[-nn:]
+                weights['bias_%s' % layer_idx] = variables['lstm_bias_%s' % layer_idx]
+            else:
+                gate_matrix = variables['gate_matrix_%s' % layer_idx]
+                main_matrix = variables['main_matrix_%s' % layer_idx]
+                nn = main_matrix.shape[1]
+                weights['input_matrix_%s' % layer_idx] = np.concatenate(
+                    [gate_matrix[:-nn], main_matrix[:-nn]], 1)
+                weights['gate_state_matrix_%s' % layer_idx] = gate_matrix[-nn:]
+                weights['main_state_matrix_%s' % layer_idx] = main_matrix[-nn:]
+            layer_idx += 1
+        num_layers = layer_idx
+        output_layer_idx = 0
+        while 'output_matrix_%s' % output_layer_idx in variables:
+            weights['output_matrix_%s' % output_layer_idx] = variables['output_matrix_%s' % output_layer_idx]
+            weights['output_bias_%s' % output_layer_idx] = variables['output_bias_%s' % output_layer_idx]
+            output_layer_idx += 1
+        num_output_layers = output_layer_idx
+    elif 'Variable' in variables:
+        # vanilla.Vanilla variables are not named: weights, bias, output weights, output bias in order of creation
+        cell = 'vanilla'
+        matrix = variables['Variable']
+        nn = matrix.shape[1]
+        weights['embedding_matrix'] = matrix[:-nn]
+        weights['state_matrix_0'] = matrix[-nn:]
+        weights['bias_0'] = variables['Variable_1']
+        weights['output_matrix_0'] = variables['Variable_2']
+        weights['output_bias_0'] = variables['Variable_3']
+        num_layers = 1
+        num_output_layers = 1
+    else:
+        raise ValueError('checkpoint %s was not saved by Lstm, Gru or Vanilla' % checkpoint_path)
+    weights = {name: np.ascontiguousarray(value, dtype=np.float32) for name, value in weights.items()}
+    if quantize:
+        for name in [name for name in weights if 'matrix' in name and name != 'embedding_matrix']:
+            weights[name], weights[name + '_scale'] = quantize_matrix(weights[name])
+    weights['cell'] = np.array(cell)
+    weights['num_layers'] = np.array(num_layers)
+    weights['num_output_layers'] = np.array(num_output_layers)
+    if vocabulary is not None:
+        weights['vocabulary'] = np.array(vocabulary)
+    np.savez(save_path, **weights)
+
+
+def _sigmoid(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    np.reciprocal(x, out=x)
+    return x
+
+
+class NumpyEngine(object):
+    """Step function of exported model. All buffers are allocated for max_batch_size chats when engine is created.
+    States are flat list of arrays [batch_size, num_nodes] ordered like 'serving_states' hook: for LSTM
+    (h_0, c_0, h_1, c_1, ...), for GRU and vanilla (h_0, h_1, ...)"""
+
+    def __init__(self, path, max_batch_size=1):
+        with np.load(path) as data:
+            weights = {name: data[name] for name in data.files}
+        for name in [name for name in weights if name.endswith('_scale')]:
+            matrix_name = name[:-len('_scale')]
+            weights[matrix_name] = QuantizedMatrix(
+                weights[matrix_name], weights.pop(name), max_batch_size=max_batch_size)
+        self._cell = str(weights['cell'])
+        self._num_layers = int(weights['num_layers'])
+        self._num_output_layers = int(weights['num_output_layers'])
+        self.vocabulary = list(weights['vocabulary']) if 'vocabulary' in weights else None
+        self._max_batch_size = max_batch_size
+        self._embedding_matrix = weights['embedding_matrix']
+        self._num_nodes = list()
+        self._layers = list()
+        for layer_idx in range(self._num_layers):
+            layer = {name[:-len('_%s' % layer_idx)]: value for name, value in weights.items()
+                     if name in ['input_matrix_%s' % layer_idx, 'state_matrix_%s' % layer_idx,
+                                 'gate_state_matrix_%s' % layer_idx, 'main_state_matrix_%s' % layer_idx,
+                                 'bias_%s' % layer_idx]}
+            if self._cell == 'lstm':
+                nn = layer['bias'].shape[0] // 4
+            elif self._cell == 'gru':
+                nn = layer['main_state_matrix'].shape[0]
+            else:
+                nn = layer['bias'].shape[0]
+            self._num_nodes.append(nn)
+            width = layer['bias'].shape[0] if 'bias' in layer else 3 * nn
+            layer['linear_res'] = np.zeros([max_batch_size, width], dtype=np.float32)
+            if self._cell == 'gru':
+                layer['buffer'] = np.zeros([max_batch_size, 2 * nn], dtype=np.float32)
+                layer['gated_state'] = np.zeros([max_batch_size, nn], dtype=np.float32)
+                layer['main_buffer'] = np.zeros([max_batch_size, nn], dtype=np.float32)
+            else:
+                layer['buffer'] = np.zeros([max_batch_size, width], dtype=np.float32)
+            self._layers.append(layer)
+        self._output_layers = list()
+        for layer_idx in range(self._num_output_layers):
+            matrix = weights['output_matrix_%s' % layer_idx]
+            self._output_layers.append(
+                dict(
+                    matrix=matrix,
+                    bias=weights['output_bias_%s' % layer_idx],
+                    res=np.zeros([max_batch_size, matrix.shape[1]], dtype=np.float32)))
+        self.vocabulary_size = self._output_layers[-1]['matrix'].shape[1]
+        self._embeddings = np.zeros([max_batch_size, self._embedding_matrix.shape[1]], dtype=np.float32)
+        self.states = self.zero_states(max_batch_size)
+
+    def zero_states(self, batch_size):
+        states = list()
+        for nn in self._num_nodes:
+            states.append(np.zeros([batch_size, nn], dtype=np.float32))
+            if self._cell == 'lstm':
+                states.append(np.zeros([batch_size, nn], dtype=np.float32))
+        return states
+
+    def reset(self):
+        for state in self.states:
+            state.fill(0.)
+
+    def _lstm_layer(self, inp, h, c, layer, n):
+        nn = h.shape[1]
+        linear_res = layer['linear_res'][:n]
+        buffer = layer['buffer'][:n]
+        _dot(inp, layer['input_matrix'], linear_res)
+        _dot(h, layer['state_matrix'], buffer)
+        linear_res += buffer
+        linear_res += layer['bias']
+        _sigmoid(linear_res[:, :3*nn])
+        np.tanh(linear_res[:, 3*nn:], out=linear_res[:, 3*nn:])
+        forget_gate, input_gate, output_gate, transform_vec = [linear_res[:, i*nn:(i+1)*nn] for i in range(4)]
+        c *= forget_gate
+        np.multiply(input_gate, transform_vec, out=transform_vec)
+        c += transform_vec
+        np.tanh(c, out=h)
+        h *= output_gate
+        return h
+
+    def _gru_layer(self, inp, h, layer, n):
+        nn = h.shape[1]
+        linear_res = layer['linear_res'][:n]
+        buffer = layer['buffer'][:n]
+        _dot(inp, layer['input_matrix'], linear_res)
+        _dot(h, layer['gate_state_matrix'], buffer)
+        linear_res[:, :2*nn] += buffer
+        _sigmoid(linear_res[:, :2*nn])
+        z_gate, r_gate, main_res = [linear_res[:, i*nn:(i+1)*nn] for i in range(3)]
+        gated_state = layer['gated_state'][:n]
+        main_buffer = layer['main_buffer'][:n]
+        np.multiply(h, r_gate, out=gated_state)
+        _dot(gated_state, layer['main_state_matrix'], main_buffer)
+        main_res += main_buffer
+        np.tanh(main_res, out=main_res)
+        # h = (1 - z) * h + z * main_res = h + z * (main_res - h)
+        main_res -= h
+        main_res *= z_gate
+        h += main_res
+        return h
+
+    def _vanilla_layer(self, inp, h, layer, n):
+        linear_res = layer['linear_res'][:n]
+        _dot(h, layer['state_matrix'], linear_res)
+        linear_res += inp
+        linear_res += layer['bias']
+        np.tanh(linear_res, out=h)
+        return h
+
+    def step(self, ids, states=None):
+        """Feeds one token to every chat in batch.
+        Args:
+            ids: array of token ids of shape [n]
+            states: flat list of state arrays [n, num_nodes] which are updated in place. If None first n rows
+                of engine states are used
+        Returns:
+            predictions of shape [n, vocabulary_size]. The array is engine buffer and is overwritten on next step"""
+        ids = np.asarray(ids)
+        n = ids.shape[0]
+        if states is None:
+            states = [state[:n] for state in self.states]
+        embeddings = self._embeddings[:n]
+        np.take(self._embedding_matrix, ids, axis=0, out=embeddings)
+        output = embeddings
+        if self._cell == 'lstm':
+            for layer_idx, layer in enumerate(self._layers):
+                output = self._lstm_layer(output, states[2*layer_idx], states[2*layer_idx+1], layer, n)
+        elif self._cell == 'gru':
+            for layer, h in zip(self._layers, states):
+                output = self._gru_layer(output, h, layer, n)
+        else:
+            output = self._vanilla_layer(output, states[0], self._layers[0], n)
+        for layer_idx, layer in enumerate(self._output_layers):
+            res = layer['res'][:n]
+            _dot(output, layer['matrix'], res)
+            res += layer['bias']
+            if layer_idx < self._num_output_layers - 1:
+                np.maximum(res, 0., out=res)
+            output = res
+        output -= np.max(output, axis=1, keepdims=True)
+        np.exp(output, out=output)
+        output /= np.sum(output, axis=1, keepdims=True)
+        return output
+
+    def predict_strings(self, strings, character_positions_in_vocabulary, prefix='\n'):
+        """Same as Environment.predict_strings. Strings are processed in chunks of max_batch_size"""
+        results = list()
+        for start in range(0, len(strings), self._max_batch_size):
+            chunk = strings[start:start + self._max_batch_size]
+            sequences = [[character_positions_in_vocabulary[char] for char in prefix + string] for string in chunk]
+            states = self.zero_states(len(chunk))
+            predictions = [list() for _ in chunk]
+            step = 0
+            active = [row_idx for row_idx, sequence in enumerate(sequences) if len(sequence) > 0]
+            while len(active) > 0:
+                active_states = [state[active] for state in states]
+                res = self.step([sequences[row_idx][step] for row_idx in active], states=active_states)
+                for state, new_state in zip(states, active_states):
+                    state[active] = new_state
+                if step >= len(prefix):
+                    for row_idx, prediction in zip(active, res):
+                        predictions[row_idx].append(prediction.copy())
+                step += 1
+                active = [row_idx for row_idx in active if len(sequences[row_idx]) > step]
+            results.extend([np.array(row_predictions) for row_predictions in predictions])
+        return results
+
+
+def compute_bpc(engine, text, character_positions_in_vocabulary):
+    """Returns bits per character of text. Text is fed to engine character by character starting from zero state"""
+    states = engine.zero_states(1)
+    ids = [character_positions_in_vocabulary[char] for char in text]
+    log_probs = list()
+    for id_, next_id in zip(ids[:-1], ids[1:]):
+        prediction = engine.step([id_], states=states)
+        log_probs.append(np.log2(max(prediction[0, next_id], 1e-30)))
+    return -float(np.mean(log_probs))
+
+
+def quantization_drift(float_path, quantized_path, text, character_positions_in_vocabulary=None):
+    """Compares bpc of float and quantized weights on validation text.
+    Returns:
+        dictionary with 'float_bpc', 'quantized_bpc' and 'drift' items"""
+    float_engine = NumpyEngine(float_path)
+    quantized_engine = NumpyEngine(quantized_path)
+    if character_positions_in_vocabulary is None:
+        character_positions_in_vocabulary = {char: idx for idx, char in enumerate(float_engine.vocabulary)}
+    float_bpc = compute_bpc(float_engine, text, character_positions_in_vocabulary)
+    quantized_bpc = compute_bpc(quantized_engine, text, character_positions_in_vocabulary)
+    return dict(float_bpc=float_bpc, quantized_bpc=quantized_bpc, drift=quantized_bpc - float_bpc)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--restore", help="path to checkpoint")
+    parser.add_argument("-o", "--output", help="path to .npz file with exported weights")
+    parser.add_argument(
+        "-v", "--vocabulary", help="path to vocabulary file which will be saved with weights", default=None)
+    parser.add_argument(
+        "-q", "--quantize", help="if specified matrices are quantized to int8", action='store_true')
+    parser.add_argument(
+        "-t", "--validation_text", help="path to text on which bpc of quantized and float models are compared. "
+                                        "Requires --quantize and --vocabulary", default=None)
+    args = parser.parse_args()
+    if args.vocabulary is not None:
+        with open(args.vocabulary, 'r') as f:
+            lines = f.read().split('\n')
+        # same format as in some_useful_functions.load_vocabulary
+        vocabulary = [eval('"' + l + '"') if l != '"' else eval("'" + l + "'") for l in lines]
+    else:
+        vocabulary = None
+    export_weights(args.restore, args.output, vocabulary=vocabulary, quantize=args.quantize)
+    if args.quantize and args.validation_text is not None:
+        with open(args.validation_text, 'r', encoding='utf-8') as f:
+            validation_text = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            float_path = os.path.join(tmp_dir, 'float.npz')
+            export_weights(args.restore, float_path, vocabulary=vocabulary)
+            drift = quantization_drift(float_path, args.output, validation_text)
+        print('float bpc: %.4f\nquantized bpc: %.4f\ndrift: %.4f' %
+              (drift['float_bpc'], drift['quantized_bpc'], drift['drift']))
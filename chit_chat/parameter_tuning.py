@@ -95,4 +95,7 @@ env.grid_search(evaluation,
                      results_collect_interval=999,
                      validation_dataset_texts=[valid_text],
                      additions_to_feed_dict=[{'placeholder': 'dropout', 'value': {'type': 'fixed', 'name': 'dropout', 'value': .9}}],
-                     no_validation=True)
\ No newline at end of file
+                     no_validation=True,
+                     use_results_cache=True,
+                     datasets_registry_path='datasets/registry',
+                     results_cache_path='residuals_no_authors_no_sampling/parameter_tuning/results_cache.jsonl')
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""Graph parts shared by lstm_par.Lstm and gru_par.Gru. Model specific computations are passed as functions:
+    step(inputs, states) -> (output, new_states) runs cell on one batch of (not embedded) inputs,
+    logits(output) -> logits of output module,
+    save_states(variables, values) -> list of assign ops (pupil's _compose_save_list).
+States are nested lists and tuples of tensors as in pupil's saved_sample_state"""
+import tensorflow as tf
+from some_useful_functions import flatten
+
+
+def _extract_op_name(full_name):
+    scopes_stripped = full_name.split('/')[-1]
+    return scopes_stripped.split(':')[0]
+
+
+def map_states(function, states):
+    """Applies function to every tensor in nested lists and tuples of states keeping structure"""
+    if isinstance(states, (list, tuple)):
+        return type(states)([map_states(function, s) for s in states])
+    return function(states)
+
+
+def accumulation_graph(optimizer, grads, v, hooks):
+    """Creates ops for accumulating gradients over several sub-batches. accumulate_grads op adds grads
+    to accumulators. apply_accumulated_grads op adds grads of current sub-batch, applies mean of accumulated grads
+    and resets accumulators"""
+    with tf.name_scope('gradient_accumulation'):
+        accumulators = list()
+        for var in v:
+            accumulators.append(
+                tf.Variable(tf.zeros(var.get_shape()), trainable=False,
+                            name='%s_grad_accumulator' % _extract_op_name(var.name)))
+        accumulated_num = tf.Variable(0., trainable=False, name='accumulated_num')
+        grads = [tf.convert_to_tensor(g) for g in grads]
+        accumulate_ops = [tf.assign_add(acc, g) for acc, g in zip(accumulators, grads)]
+        accumulate_ops.append(tf.assign_add(accumulated_num, 1.))
+        hooks['accumulate_grads'] = tf.group(*accumulate_ops)
+
+        mean_grads = [tf.divide(acc_op, accumulate_ops[-1]) for acc_op in accumulate_ops[:-1]]
+        mean_grads, _ = tf.clip_by_global_norm(mean_grads, 1.)
+        apply_op = optimizer.apply_gradients(zip(mean_grads, v))
+        with tf.control_dependencies([apply_op]):
+            reset_ops = [tf.assign(acc, tf.zeros(acc.get_shape())) for acc in accumulators]
+            reset_ops.append(tf.assign(accumulated_num, 0.))
+        hooks['apply_accumulated_grads'] = tf.group(*reset_ops)
+
+
+def prefill_graph(prefill_inputs, saved_sample_state, output_size, step, predict, save_states, hooks):
+    """Creates operation which passes a whole sequence of arbitrary length through validation cell in one
+    session call (tf.while_loop) and saves resulting state to saved_sample_state. prefill_inputs is a sequence of
+    prepared validation inputs concatenated along 0 axis. 'prefill_predictions' is prediction (predict(output))
+    made after the last input"""
+    length = tf.shape(prefill_inputs)[0]
+
+    def cond(idx, output, states):
+        return idx < length
+
+    def body(idx, output, states):
+        output, states = step(prefill_inputs[idx], states)
+        return idx + 1, output, states
+
+    init_states = map_states(tf.identity, saved_sample_state)
+    _, last_output, prefill_states = tf.while_loop(
+        cond, body, [tf.constant(0), tf.zeros([1, output_size]), init_states])
+    with tf.control_dependencies(save_states(saved_sample_state, prefill_states)):
+        hooks['prefill_predictions'] = predict(last_output)
+
+
+def generation_graph(saved_sample_state, vocabulary_size, step, logits, save_states, hooks):
+    """Creates operation which generates a sequence in one session call. First token is sampled from
+    'generation_start_predictions', then tokens are fed back to validation cell and sampled from its predictions
+    until 'generation_stop_id' token is fed or 'generation_max_length' tokens are fed. If
+    'generation_temperature' is 0 argmax is used instead of sampling. 'generated_ids' are ids of fed tokens and
+    'generation_predictions' is prediction made after the last fed token"""
+    with tf.name_scope('generation'):
+        start_predictions = tf.placeholder(
+            tf.float32, shape=[1, vocabulary_size], name='start_predictions')
+        temperature = tf.placeholder_with_default(0., [], name='temperature')
+        max_length = tf.placeholder_with_default(250, [], name='max_length')
+        stop_id = tf.placeholder_with_default(-1, [], name='stop_id')
+        hooks['generation_start_predictions'] = start_predictions
+        hooks['generation_temperature'] = temperature
+        hooks['generation_max_length'] = max_length
+        hooks['generation_stop_id'] = stop_id
+
+        def sample_id(predictions):
+            return tf.cond(
+                temperature > 0.,
+                lambda: tf.to_int32(tf.multinomial(tf.log(predictions + 1e-20) / temperature, 1)[0, 0]),
+                lambda: tf.to_int32(tf.argmax(predictions, 1)[0]))
+
+        def cond(idx, token_id, ids, predictions, states, finished):
+            return tf.logical_and(idx < max_length, tf.logical_not(finished))
+
+        def body(idx, token_id, ids, predictions, states, finished):
+            ids = ids.write(idx, token_id)
+            output, states = step(tf.one_hot([token_id], vocabulary_size), states)
+            predictions = tf.nn.softmax(logits(output))
+            return idx + 1, sample_id(predictions), ids, predictions, states, tf.equal(token_id, stop_id)
+
+        init_states = map_states(tf.identity, saved_sample_state)
+        _, _, ids, last_predictions, generation_states, _ = tf.while_loop(
+            cond, body,
+            [tf.constant(0), sample_id(start_predictions),
+             tf.TensorArray(tf.int32, size=0, dynamic_size=True, element_shape=[]),
+             start_predictions, init_states, tf.constant(False)])
+        with tf.control_dependencies(save_states(saved_sample_state, generation_states)):
+            hooks['generated_ids'] = ids.stack()
+            hooks['generation_predictions'] = tf.identity(last_predictions)
+
+
+def serving_graph(saved_sample_state, vocabulary_size, step, logits, hooks):
+    """Creates stateless one step graph used for serving many chats by one pupil. States of a batch of chats
+    are fed to 'serving_states' placeholders (they have the same structure as saved_sample_state), 'serving_inputs'
+    are ids of tokens fed to chats. 'serving_new_states' and 'serving_predictions' are computed for the whole batch"""
+    with tf.name_scope('serving'):
+        serving_inputs = tf.placeholder(tf.int32, shape=[None], name='serving_inputs')
+        serving_states = map_states(
+            lambda variable: tf.placeholder(
+                tf.float32,
+                shape=[None, variable.get_shape().as_list()[1]],
+                name=_extract_op_name(variable.name).replace('saved_sample_state', 'serving_state')),
+            saved_sample_state)
+        output, new_states = step(tf.one_hot(serving_inputs, vocabulary_size), serving_states)
+        hooks['serving_inputs'] = serving_inputs
+        hooks['serving_states'] = flatten(serving_states)
+        hooks['serving_new_states'] = flatten(new_states)
+        hooks['serving_predictions'] = tf.nn.softmax(logits(output))
+    return serving_inputs
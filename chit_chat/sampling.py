@@ -0,0 +1,92 @@
+import numpy as np
+
+
+def get_rng(rng=None):
+    """Returns numpy random generator. rng can be None (generator with random seed), int seed or generator"""
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return np.random.RandomState(rng)
+
+
+def to_logits(array, from_logits=False):
+    """Converts probabilities to logits (logarithms). Zero probabilities are converted to -inf"""
+    if from_logits:
+        return np.array(array, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        return np.log(np.array(array, dtype=np.float64))
+
+
+def softmax(logits, axis=-1):
+    logits = logits - np.max(logits, axis=axis, keepdims=True)
+    exp = np.exp(logits)
+    return exp / np.sum(exp, axis=axis, keepdims=True)
+
+
+def filter_top_k(logits, k, axis=-1):
+    """Sets all logits except k largest along axis to -inf"""
+    if k is None or k >= logits.shape[axis]:
+        return logits
+    kth_largest = -np.partition(-logits, k - 1, axis=axis).take([k - 1], axis=axis)
+    return np.where(logits < kth_largest, -np.inf, logits)
+
+
+def filter_top_p(logits, p, axis=-1):
+    """Nucleus filtering. Keeps the smallest set of most probable tokens which total probability is not less than p.
+    Other logits are set to -inf"""
+    if p is None or p >= 1.:
+        return logits
+    order = np.argsort(-logits, axis=axis)
+    sorted_probs = np.take_along_axis(softmax(logits, axis=axis), order, axis=axis)
+    cumulative = np.cumsum(sorted_probs, axis=axis)
+    # token is kept if probability of more probable tokens is less than p. The most probable token is always kept
+    sorted_mask = cumulative - sorted_probs < p
+    mask = np.zeros(logits.shape, dtype=bool)
+    np.put_along_axis(mask, order, sorted_mask, axis=axis)
+    return np.where(mask, logits, -np.inf)
+
+
+def sample_ids(array, axis=-1, temperature=1., top_k=None, top_p=None, from_logits=False, rng=None):
+    """Samples ids along axis.
+    Args:
+        array: probabilities or logits (if from_logits is True)
+        axis: axis along which ids are sampled
+        temperature: logits are divided by temperature. If temperature is 0 argmax is returned
+        top_k: if provided sampling is done only among top_k most probable tokens
+        top_p: if provided sampling is done among the smallest set of most probable tokens which probability is not
+            less than top_p (nucleus sampling)
+        from_logits: whether array contains logits
+        rng: None, int seed or numpy.random.RandomState
+    Returns:
+        numpy array of ids which shape is shape of array without axis"""
+    logits = to_logits(array, from_logits=from_logits)
+    if temperature == 0.:
+        return np.argmax(logits, axis=axis)
+    logits = filter_top_k(logits / temperature, top_k, axis=axis)
+    logits = filter_top_p(logits, top_p, axis=axis)
+    cumulative = np.cumsum(softmax(logits, axis=axis), axis=axis)
+    r_shape = list(logits.shape)
+    r_shape[axis] = 1
+    r = get_rng(rng).rand(*r_shape) * cumulative.take([-1], axis=axis)
+    ids = np.sum(cumulative <= r, axis=axis)
+    # protection against rounding errors
+    return np.minimum(ids, logits.shape[axis] - 1)
+
+
+def ids_to_one_hot(ids, depth, axis=-1):
+    """Returns one hot vectors of ids. New axis of length depth is inserted at position axis"""
+    one_hot = np.expand_dims(np.arange(depth), tuple(range(np.ndim(ids))))
+    one_hot = (np.expand_dims(ids, -1) == one_hot).astype(np.float32)
+    return np.moveaxis(one_hot, -1, axis)
+
+
+def sample_one_hot(array, axis=-1, temperature=1., top_k=None, top_p=None, from_logits=False, rng=None):
+    """Same as sample_ids but returns one hot vectors of the same shape as array"""
+    ids = sample_ids(
+        array, axis=axis, temperature=temperature, top_k=top_k, top_p=top_p, from_logits=from_logits, rng=rng)
+    return ids_to_one_hot(ids, np.shape(array)[axis], axis=axis)
+
+
+def apply_temperature(array, axis, temperature):
+    """Returns probabilities after applying temperature. Computed in logarithmic space, so low temperatures do not
+    cause underflow"""
+    return softmax(to_logits(array) / temperature, axis=axis)
@@ -1,9 +1,17 @@
+import argparse
 from environment import Environment
 import re
 # from residuals_no_authors_no_sampling import Lstm, LstmBatchGenerator
 from lstm_par import Lstm, LstmBatchGenerator
 from some_useful_functions import create_vocabulary, get_positions_in_vocabulary
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--chat_states",
+    help="directory where states of chats are saved, so conversations are continued after restart. By default"
+         " states are not saved")
+args = parser.parse_args()
+
 f = open('datasets/scipop_v3.0/scipop_train.txt', 'r', encoding='utf-8')
 text = f.read()
 text = re.sub('<[^>]*>', '', text)
@@ -48,4 +56,5 @@ env.telegram(
     vocabulary,
     cpiv,
     LstmBatchGenerator,
-    additions_to_feed_dict=valid_add_feed)
+    additions_to_feed_dict=valid_add_feed,
+    chat_states_path=args.chat_states)
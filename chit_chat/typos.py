@@ -1,47 +1,41 @@
 import argparse
-from environment import Environment
-from lstm_par import Lstm, LstmBatchGenerator
-from some_useful_functions import create_vocabulary, get_positions_in_vocabulary, load_vocabulary
+import json
+import socket
+import numpy as np
+from typos_common import (VOCABULARY, RESTORE, DATASET, ADDRESS, VALID_ADD_FEED, get_vocabulary,
+                          predictions_to_results, parse_address)
 
-VOCABULARY = 'typos/voc.txt'
-RESTORE = 'typos/checkpoints/final'
-DATASET = 'typos/all_scipop.txt'
+BUILD_KWARGS = dict(
+    batch_size=64,
+    num_layers=2,
+    num_nodes=[1300, 1300],
+    num_output_layers=2,
+    num_output_nodes=[2048],
+    embedding_size=512,
+    num_unrollings=100,
+    init_parameter=3.,
+    regime='inference',
+    num_gpus=1)
 
 
-def predict(string, vocabulary=VOCABULARY, dataset=DATASET, restore=RESTORE):
-    # print('BEGIN' + string + 'END')
-    if vocabulary is None:
-        if dataset is not None:
-            with open(dataset, 'r') as f:
-                text = f.read()
-            vocabulary = create_vocabulary(text)
-    else:
-        vocabulary = load_vocabulary(vocabulary)
-    vocabulary_size = len(vocabulary)
-    # print('(typos.predict)vocabulary_size:', vocabulary_size)
-    # print('(typos.predict)vocabulary:\n', vocabulary)
-
+def build_environment(vocabulary):
+    # TensorFlow is imported only when model is loaded in this process, so clients of typos service do not import it
+    from environment import Environment
+    from lstm_par import Lstm, LstmBatchGenerator
     env = Environment(Lstm, LstmBatchGenerator, vocabulary=vocabulary)
-
-    valid_add_feed = [# {'placeholder': 'sampling_prob', 'value': 1.},
-                      {'placeholder': 'dropout', 'value': 1.}]
+    env.build(vocabulary_size=len(vocabulary), **BUILD_KWARGS)
+    return env
 
 
-    env.build(batch_size=64,
-              num_layers=2,
-              num_nodes=[1300, 1300],
-              num_output_layers=2,
-              num_output_nodes=[2048],
-              vocabulary_size=vocabulary_size,
-              embedding_size=512,
-              num_unrollings=100,
-              init_parameter=3.,
-              regime='inference',
-              num_gpus=1)
-
+def predict_in_process(string, vocabulary=VOCABULARY, dataset=DATASET, restore=RESTORE):
+    # print('BEGIN' + string + 'END')
+    vocabulary = get_vocabulary(vocabulary=vocabulary, dataset=dataset)
+    # print('(typos.predict)vocabulary_size:', len(vocabulary))
+    # print('(typos.predict)vocabulary:\n', vocabulary)
+    env = build_environment(vocabulary)
     _, example_res = env.test(
         restore_path=restore,
-        additions_to_feed_dict=valid_add_feed,
+        additions_to_feed_dict=VALID_ADD_FEED,
         validation_dataset_texts=[string],
         printed_result_types=[],
         example_length=len(string),
@@ -52,6 +46,37 @@ def predict(string, vocabulary=VOCABULARY, dataset=DATASET, restore=RESTORE):
     return example_res[0]['input'][1:], example_res[0]['output'][1:], example_res[0]['prob_vecs'][1:]
 
 
+def request_service(strings, address=ADDRESS, timeout=None):
+    """Sends strings to typos service (typos_service.py) and returns list of (input, output, prob_vecs) tuples.
+    Raises OSError if service is not available"""
+    with socket.create_connection(parse_address(address), timeout=timeout) as sock:
+        stream = sock.makefile('rw', encoding='utf-8')
+        for string in strings:
+            stream.write(json.dumps({'string': string}) + '\n')
+        stream.flush()
+        results = list()
+        for _ in strings:
+            line = stream.readline()
+            if len(line) == 0:
+                raise ConnectionError('typos service closed connection')
+            response = json.loads(line)
+            if 'error' in response:
+                raise RuntimeError('typos service error: %s' % response['error'])
+            results.append((response['input'], response['output'], [np.array(vec) for vec in response['prob_vecs']]))
+    return results
+
+
+def predict(string, vocabulary=VOCABULARY, dataset=DATASET, restore=RESTORE, address=ADDRESS):
+    """Processes string with typos model. If address is not None typos service running on address is used.
+    If service is not available model is loaded in this process"""
+    if address is not None:
+        try:
+            return request_service([string], address=address)[0]
+        except OSError:
+            pass
+    return predict_in_process(string, vocabulary=vocabulary, dataset=dataset, restore=restore)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -67,6 +92,10 @@ if __name__ == '__main__':
         "-d", "--dataset", help="path to dataset which will be used for vocabulary creation", default=DATASET)
     parser.add_argument(
         "-p", "--probabilities", help="if specified print probabilities", action='store_true')
+    parser.add_argument(
+        "-a", "--address", help="host:port of typos service started with typos_service.py", default=ADDRESS)
+    parser.add_argument(
+        "--no-service", help="if specified model is loaded in this process", action='store_true')
     args = parser.parse_args()
 
     if args.file2parse is not None:
@@ -76,9 +105,10 @@ if __name__ == '__main__':
         string = args.string
 
     inp, out, prob_vecs = predict(string, vocabulary=args.vocabulary,
-                          dataset=args.dataset, restore=args.restore)
+                                  dataset=args.dataset, restore=args.restore,
+                                  address=None if args.no_service else args.address)
 
     print('@input:\n' + inp)
     print('@output:\n' + out)
     if args.probabilities:
-        print('@prob_vecs:\n', prob_vecs)
\ No newline at end of file
+        print('@prob_vecs:\n', prob_vecs)
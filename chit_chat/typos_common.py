@@ -0,0 +1,42 @@
+"""Settings and helpers of typos model which do not require TensorFlow. They are shared by typos.py and
+typos_service.py, so typos service running NumpyEngine does not import TensorFlow"""
+import numpy as np
+
+VOCABULARY = 'typos/voc.txt'
+RESTORE = 'typos/checkpoints/final'
+DATASET = 'typos/all_scipop.txt'
+ADDRESS = 'localhost:8765'
+
+VALID_ADD_FEED = [# {'placeholder': 'sampling_prob', 'value': 1.},
+                  {'placeholder': 'dropout', 'value': 1.}]
+
+
+def get_vocabulary(vocabulary=VOCABULARY, dataset=DATASET):
+    if vocabulary is None:
+        if dataset is not None:
+            with open(dataset, 'r') as f:
+                text = f.read()
+            # the same as some_useful_functions.create_vocabulary
+            vocabulary = sorted(set(text), key=lambda char: ord(char))
+    else:
+        with open(vocabulary, 'r') as f:
+            lines = f.read().split('\n')
+        # same format as in some_useful_functions.load_vocabulary
+        vocabulary = [eval('"' + l + '"') if l != '"' else eval("'" + l + "'") for l in lines]
+    return vocabulary
+
+
+def get_positions_in_vocabulary(vocabulary):
+    return {char: idx for idx, char in enumerate(vocabulary)}
+
+
+def predictions_to_results(string, predictions, vocabulary):
+    """Converts predictions made by Environment.predict_strings to (input, output, prob_vecs) tuple returned by
+    typos.predict"""
+    output = ''.join([vocabulary[id_] for id_ in np.argmax(predictions, axis=-1)]) if len(string) > 0 else ''
+    return string, output, [prediction for prediction in predictions]
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
@@ -0,0 +1,177 @@
+import argparse
+import json
+import queue
+import socketserver
+import sys
+import threading
+import time
+from typos_common import (VOCABULARY, RESTORE, DATASET, ADDRESS, VALID_ADD_FEED, get_vocabulary,
+                          get_positions_in_vocabulary, predictions_to_results, parse_address)
+from numpy_engine import NumpyEngine
+
+
+class TyposService(object):
+    """Keeps typos model loaded and processes requests in micro batches. Requests submitted from different threads
+    during max_wait seconds are processed together (not more than max_batch_size strings in one batch).
+    If numpy_weights (file created by numpy_engine.export_weights) is provided TensorFlow graph is not built and
+    NumpyEngine is used"""
+
+    def __init__(self, vocabulary=VOCABULARY, dataset=DATASET, restore=RESTORE, max_batch_size=64, max_wait=.01,
+                 gpu_memory=None, allow_growth=False, numpy_weights=None, intra_op_parallelism_threads=0,
+                 inter_op_parallelism_threads=0):
+        self._vocabulary = get_vocabulary(vocabulary=vocabulary, dataset=dataset)
+        self._character_positions_in_vocabulary = get_positions_in_vocabulary(self._vocabulary)
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        if numpy_weights is None:
+            # TensorFlow is imported only if it is needed
+            from typos import build_environment
+            self._env = build_environment(self._vocabulary)
+            self._env.start_serving_session(restore, gpu_memory=gpu_memory, allow_growth=allow_growth,
+                                            intra_op_parallelism_threads=intra_op_parallelism_threads,
+                                            inter_op_parallelism_threads=inter_op_parallelism_threads)
+            self._engine = None
+        else:
+            self._env = None
+            self._engine = NumpyEngine(numpy_weights, max_batch_size=max_batch_size)
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def _collect_batch(self):
+        batch = [self._requests.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.time() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            strings = [string for string, _ in batch]
+            try:
+                if self._engine is None:
+                    predictions = self._env.predict_strings(
+                        strings, self._character_positions_in_vocabulary, additions_to_feed_dict=VALID_ADD_FEED)
+                else:
+                    predictions = self._engine.predict_strings(strings, self._character_positions_in_vocabulary)
+                results = [predictions_to_results(string, string_predictions, self._vocabulary)
+                           for string, string_predictions in zip(strings, predictions)]
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, result_queue), result in zip(batch, results):
+                result_queue.put(result)
+
+    def predict(self, string):
+        """Returns (input, output, prob_vecs) tuple. Can be called from several threads simultaneously"""
+        result_queue = queue.Queue(maxsize=1)
+        self._requests.put((string, result_queue))
+        result = result_queue.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def process_line(self, line):
+        """Processes one JSON line {"string": ...} and returns JSON response line"""
+        try:
+            inp, out, prob_vecs = self.predict(json.loads(line)['string'])
+            response = {'input': inp, 'output': out, 'prob_vecs': [vec.tolist() for vec in prob_vecs]}
+        except Exception as e:
+            response = {'error': repr(e)}
+        return json.dumps(response) + '\n'
+
+    def close(self):
+        self._requests.put(None)
+        self._worker.join()
+        if self._env is not None:
+            self._env.close_serving_session()
+
+
+class _TyposRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8')
+            if len(line.strip()) == 0:
+                continue
+            self.wfile.write(self.server.typos_service.process_line(line).encode('utf-8'))
+            self.wfile.flush()
+
+
+class _ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(service, address=ADDRESS):
+    """Serves JSON lines requests on address. Every connection is handled in separate thread, so strings from
+    different clients are batched together"""
+    server = _ThreadedTCPServer(parse_address(address), _TyposRequestHandler)
+    server.typos_service = service
+    print('typos service is listening on %s' % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve_stdin(service):
+    """Reads JSON lines requests from stdin and writes responses to stdout"""
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+        sys.stdout.write(service.process_line(line))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-v", "--vocabulary", help="path to file with vocabulary corresponding to loaded model", default=VOCABULARY)
+    parser.add_argument("-r", "--restore", help="path to file with checkpoint", default=RESTORE)
+    parser.add_argument(
+        "-d", "--dataset", help="path to dataset which will be used for vocabulary creation", default=DATASET)
+    parser.add_argument("-a", "--address", help="host:port service is listening on", default=ADDRESS)
+    parser.add_argument(
+        "--stdin", help="if specified requests are read from stdin instead of socket", action='store_true')
+    parser.add_argument("-b", "--max_batch_size", help="maximum number of strings in one batch", type=int, default=64)
+    parser.add_argument(
+        "-w", "--max_wait", help="time in seconds service waits for requests to fill batch", type=float, default=.01)
+    parser.add_argument(
+        "-n", "--numpy_weights", help="path to weights exported with numpy_engine.py. If specified model is run "
+                                      "without TensorFlow", default=None)
+    parser.add_argument(
+        "--intra_op_threads", help="number of threads used by one TensorFlow op (0 means TensorFlow chooses)",
+        type=int, default=0)
+    parser.add_argument(
+        "--inter_op_threads", help="number of TensorFlow ops run in parallel (0 means TensorFlow chooses)",
+        type=int, default=0)
+    args = parser.parse_args()
+
+    typos_service = TyposService(vocabulary=args.vocabulary, dataset=args.dataset, restore=args.restore,
+                                 max_batch_size=args.max_batch_size, max_wait=args.max_wait,
+                                 numpy_weights=args.numpy_weights, intra_op_parallelism_threads=args.intra_op_threads,
+                                 inter_op_parallelism_threads=args.inter_op_threads)
+    try:
+        if args.stdin:
+            serve_stdin(typos_service)
+        else:
+            serve(typos_service, address=args.address)
+    finally:
+        typos_service.close()
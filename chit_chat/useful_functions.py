@@ -1,8 +1,13 @@
 import numpy as np
 import inspect
 import os
+import glob
 import ast
+import json
+import hashlib
+import pickle
 from collections import OrderedDict
+import sampling
 import tensorflow as tf
 from tensorflow.python.client import device_lib
 
@@ -173,6 +178,164 @@ def check_not_one_byte(text):
     return not_one_byte_counter, min_character_order_index, max_character_order_index, number_of_characters, present_characters
 
 
+class DatasetHandle(object):
+    """Reference to dataset text saved on disk. Only path, name and length are pickled when launch specifications
+    are passed to other processes, so launch cost does not depend on dataset size. Text is read on first request and
+    cached in process"""
+    _texts = dict()
+
+    def __init__(self, path, length, digest):
+        self.path = path
+        self.length = length
+        self.digest = digest
+
+    def get_text(self):
+        if self.path not in DatasetHandle._texts:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                DatasetHandle._texts[self.path] = f.read()
+        return DatasetHandle._texts[self.path]
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return 'DatasetHandle(%s)' % self.path
+
+
+class ChatStateStore(object):
+    """LRU cache of chat recurrent states. State of a chat is a list of numpy arrays. If number of states kept in
+    memory exceeds capacity least recently used states are saved to disk (if path is provided) and removed from
+    memory. States saved to disk are loaded when requested"""
+    def __init__(self, capacity=1000, path=None):
+        self._capacity = capacity
+        self._path = path
+        self._states = OrderedDict()
+        if path is not None:
+            create_path(path)
+
+    def _file_name(self, key):
+        return self._path + '/' + str(key) + '.npz'
+
+    def _spill(self, key, states):
+        if self._path is not None:
+            tmp_file_name = self._file_name(key) + '.tmp%s.npz' % os.getpid()
+            np.savez(tmp_file_name, *states)
+            os.replace(tmp_file_name, self._file_name(key))
+
+    def put(self, key, states):
+        self._states[key] = [np.array(state) for state in states]
+        self._states.move_to_end(key)
+        while len(self._states) > self._capacity:
+            old_key, old_states = self._states.popitem(last=False)
+            self._spill(old_key, old_states)
+
+    def pop(self, key):
+        """Returns state of chat and removes it from cache. If there is no such state returns None"""
+        if key in self._states:
+            return self._states.pop(key)
+        if self._path is not None and os.path.exists(self._file_name(key)):
+            with np.load(self._file_name(key)) as data:
+                states = [data['arr_%s' % idx] for idx in range(len(data.files))]
+            os.remove(self._file_name(key))
+            return states
+        return None
+
+    def remove(self, key):
+        if key in self._states:
+            del self._states[key]
+        if self._path is not None and os.path.exists(self._file_name(key)):
+            os.remove(self._file_name(key))
+
+    def flush(self):
+        """Saves all states kept in memory to disk"""
+        if self._path is not None:
+            while len(self._states) > 0:
+                key, states = self._states.popitem(last=False)
+                self._spill(key, states)
+
+    def __contains__(self, key):
+        return key in self._states or (self._path is not None and os.path.exists(self._file_name(key)))
+
+    def __len__(self):
+        return len(self._states)
+
+
+class PrefixStateCache(object):
+    """Maps prefixes to pupil states obtained after feeding prefix from zero state. Key can be any nested structure
+    which can be hashed with hash_nested function. State is a list of numpy arrays. If path is provided states are
+    also saved to disk and can be loaded by other processes"""
+    def __init__(self, path=None):
+        self.path = path
+        self._states = dict()
+        if path is not None:
+            create_path(path)
+
+    def _file_name(self, digest):
+        return self.path + '/' + digest + '.npz'
+
+    def get(self, key):
+        """Returns copy of cached state or None if prefix was not cached"""
+        digest = hash_nested(key)
+        if digest not in self._states and self.path is not None and os.path.exists(self._file_name(digest)):
+            with np.load(self._file_name(digest)) as data:
+                self._states[digest] = [data['arr_%s' % idx] for idx in range(len(data.files))]
+        if digest in self._states:
+            return [np.array(state) for state in self._states[digest]]
+        return None
+
+    def put(self, key, states):
+        digest = hash_nested(key)
+        self._states[digest] = [np.array(state) for state in states]
+        if self.path is not None:
+            tmp_file_name = self._file_name(digest) + '.tmp%s.npz' % os.getpid()
+            np.savez(tmp_file_name, *self._states[digest])
+            os.replace(tmp_file_name, self._file_name(digest))
+
+    def clear(self):
+        """Removes states kept in memory. States saved on disk are not removed"""
+        self._states = dict()
+
+
+def model_fingerprint(path):
+    """Returns names, sizes and modification times of files model is loaded from: checkpoint files which names start
+    with path or files in directory path (frozen graph). Keys of cached states include fingerprint, so states are
+    not reused when model is saved to the same path again"""
+    if os.path.isdir(path):
+        file_names = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        file_names = sorted(glob.glob(glob.escape(path) + '.*'))
+    fingerprint = list()
+    for file_name in file_names:
+        if os.path.isfile(file_name):
+            file_stat = os.stat(file_name)
+            fingerprint.append([os.path.basename(file_name), file_stat.st_size, file_stat.st_mtime_ns])
+    return fingerprint
+
+
+def register_dataset(text, registry_path):
+    """Saves text to registry directory (file name is text hash, so every text is saved once) and returns handle
+    referencing it"""
+    if isinstance(text, DatasetHandle):
+        return text
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    path = registry_path + '/' + digest + '.txt'
+    if not os.path.exists(path):
+        create_path(registry_path)
+        tmp_path = path + '.tmp%s' % os.getpid()
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    DatasetHandle._texts[path] = text
+    return DatasetHandle(path, len(text), digest)
+
+
+def dataset_text(dataset):
+    """Returns text of dataset which is either a text or a DatasetHandle"""
+    if isinstance(dataset, DatasetHandle):
+        return dataset.get_text()
+    return dataset
+
+
 def construct(obj):
     """Used for preventing of not expected changing of class attributes"""
     if isinstance(obj, OrderedDict):
@@ -198,6 +361,8 @@ def construct(obj):
         new_obj = np.copy(obj)
     elif isinstance(obj, (int, float, complex, type(None))) or inspect.isclass(obj):
         new_obj = obj
+    elif isinstance(obj, DatasetHandle):
+        new_obj = obj
     else:
         raise TypeError("Object of unsupported type was passed to construct function: %s" % type(obj))
     return new_obj
@@ -277,6 +442,76 @@ def add_index_to_filename_if_needed(filename, index=None):
     return filename
 
 
+def canonical_form(obj):
+    """Converts nested structure into structure which JSON representation does not depend on dictionary order.
+    Supported values are dicts, lists, tuples, sets, strings, numbers, None, numpy arrays and scalars, DatasetHandle,
+    classes and module level functions (they are replaced by their qualified names) and objects which can be
+    pickled. Strings are replaced by their hashes, so a dataset passed as a text and as a DatasetHandle has the same
+    canonical form. TypeError is raised for lambdas, nested functions and objects which can not be pickled because
+    they can not be identified reliably"""
+    if isinstance(obj, dict):
+        return [[canonical_form(key), canonical_form(value)]
+                for key, value in sorted(obj.items(), key=lambda item: repr(item[0]))]
+    elif isinstance(obj, (list, tuple)):
+        return [canonical_form(value) for value in obj]
+    elif isinstance(obj, (set, frozenset)):
+        return sorted([canonical_form(value) for value in obj], key=json.dumps)
+    elif isinstance(obj, str):
+        return 'sha1:%s:%s' % (hashlib.sha1(obj.encode('utf-8')).hexdigest(), len(obj))
+    elif isinstance(obj, DatasetHandle):
+        return 'sha1:%s:%s' % (obj.digest, obj.length)
+    elif isinstance(obj, np.ndarray):
+        return 'sha1:%s:%s' % (hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest(), list(obj.shape))
+    elif isinstance(obj, (np.integer, np.floating)):
+        return obj.item()
+    elif isinstance(obj, (int, float, complex, bool, type(None))):
+        return repr(obj) if isinstance(obj, complex) else obj
+    elif inspect.isclass(obj) or inspect.isfunction(obj):
+        # all lambdas and nested functions with the same name would get the same canonical form
+        if '<' in obj.__qualname__:
+            raise TypeError("canonical_form can not identify %s. Use module level function instead" % obj.__qualname__)
+        return '%s.%s' % (obj.__module__, obj.__qualname__)
+    else:
+        try:
+            return 'pickle:%s' % hashlib.sha1(pickle.dumps(obj)).hexdigest()
+        except Exception:
+            raise TypeError("Object of unsupported type was passed to canonical_form function: %s" % type(obj))
+
+
+def hash_nested(nested):
+    """Returns sha1 hex digest of nested structure. Equal structures have equal hashes regardless of dictionary
+    order"""
+    return hashlib.sha1(json.dumps(canonical_form(nested)).encode('utf-8')).hexdigest()
+
+
+def _to_json_serializable(obj):
+    if isinstance(obj, (np.integer, np.floating)):
+        return obj.item()
+    return str(obj)
+
+
+def load_results_cache(file_name):
+    """Loads append only results cache. Returns dictionary which keys are hashes and values are results. Broken
+    last line (written by interrupted process) is ignored"""
+    cache = dict()
+    if not os.path.exists(file_name):
+        return cache
+    with open(file_name, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            cache[record['hash']] = record['results']
+    return cache
+
+
+def append_to_results_cache(file_name, hash_value, results):
+    create_path(file_name, file_name_is_in_path=True)
+    with open(file_name, 'a') as f:
+        f.write(json.dumps({'hash': hash_value, 'results': results}, default=_to_json_serializable) + '\n')
+
+
 def split_to_path_and_name(path):
     parts = path.split('/')
     name = parts[-1]
@@ -428,51 +663,11 @@ def print_and_log(*inputs, log=True, _print=True, fn=None):
 
 
 def apply_temperature(array, axis, temperature):
-    array = np.power(array, 1/temperature)
-    norm = np.sum(array, axis=axis, keepdims=True)
-    return array / norm
-
-
-def compute_num_of_repeats(start_axis, last_axis_plus_1, removed_axis, shape):
-    num_of_repeats = 1
-    for ax_num in range(start_axis, last_axis_plus_1):
-        if ax_num != removed_axis:
-            num_of_repeats *= shape[ax_num]
-    return num_of_repeats
-
-
-def construct_indices(constructed_axis, removed_axis, shape):
-    num_one_value_repeats = compute_num_of_repeats(constructed_axis+1, len(shape), removed_axis, shape)
-    num_pattern_repeats = compute_num_of_repeats(0, constructed_axis, removed_axis, shape)
-    pattern = list()
-    for i in range(shape[constructed_axis]):
-        pattern.extend([i] * num_one_value_repeats)
-    pattern = pattern * num_pattern_repeats
-    return np.array(pattern)
+    return sampling.apply_temperature(array, axis, temperature)
 
 
 def sample(array, axis):
-    shape = array.shape
-    if axis == -1:
-        axis = len(shape) - 1
-    c = array.cumsum(axis=axis)
-    r_shape = list(shape)
-    r_shape[axis] = 1
-    r = np.random.rand(*r_shape)
-    mask = (r < c).argmax(axis)
-    axis_indices = np.reshape(mask, (-1))
-    all_indices = list()
-    for ax_num in range(len(shape)):
-        if ax_num != axis:
-            all_indices.append(construct_indices(ax_num, axis, shape))
-        else:
-            all_indices.append(axis_indices)
-    answer = np.zeros(shape)
-    for ax_num in range(len(shape)):
-        exec("i%s = all_indices[%s]" % (ax_num, ax_num))
-    init_string = ('answer[' + 'i%s' + ', i%s'*(len(shape)-1) + '] = 1.') % tuple([i for i in range(len(shape))])
-    exec(init_string)
-    return answer
+    return sampling.sample_one_hot(array, axis=axis)
 
 
 def get_available_gpus():
@@ -486,6 +681,32 @@ def device_name_scope(device_name):
     return device_name[1:4] + device_name[5:]
 
 
+def op_time_by_name_scope(step_stats):
+    """Sums op execution times collected with full trace RunOptions over all name scopes. Time of every op is added
+    to each of its enclosing scopes, so 'train/gpu0' includes 'train/gpu0/rnn_module/rnn_iter_3'. GPU stream
+    records duplicate kernel records and are skipped
+    Args:
+        step_stats: step_stats attribute of tf.RunMetadata
+    Returns:
+        dictionary which keys are name scopes and values are pairs (time in microseconds, number of ops)"""
+    scope_times = dict()
+    for dev_stats in step_stats.dev_stats:
+        if '/stream:' in dev_stats.device or '/memcpy' in dev_stats.device:
+            continue
+        for node_stats in dev_stats.node_stats:
+            name = node_stats.node_name.split(':')[0]
+            duration = node_stats.all_end_rel_micros
+            scopes = name.split('/')
+            for depth in range(1, len(scopes) + 1):
+                scope = '/'.join(scopes[:depth])
+                if scope in scope_times:
+                    scope_times[scope][0] += duration
+                    scope_times[scope][1] += 1
+                else:
+                    scope_times[scope] = [duration, 1]
+    return scope_times
+
+
 def average_gradients(tower_grads):
     """Calculate the average gradient for each shared variable across all towers.
     Note that this function provides a synchronization point across all towers.